@@ -1,14 +1,33 @@
 import os
-from typing import Dict, Optional
-
-from aiogram import Bot, Dispatcher, F
+import re
+import tempfile
+from decimal import Decimal, InvalidOperation
+from time import perf_counter
+
+from aiogram import BaseMiddleware, Bot, Dispatcher, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
-from aiogram.types import Message, CallbackQuery
+from aiogram.types import Message, CallbackQuery, FSInputFile
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
-from sqlalchemy import select, func
-from app.database import AsyncSessionLocal
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from app.database import AsyncSessionLocal, pool_status
+from app.metrics import Histogram
 from app.models import Trader, Order, Ticket, Payout  # если каких-то моделей нет — скажи, подстрою
+from app.services.pool import commit_trader_state
+from app.services.orders import close_order
+from app.services.export import EXPORTS, FORMATS, export_filename, export_text, parse_day
+from app.services.ledger import ACCOUNTS, adjust_balance, pending_entries, reconcile_balances, trader_balances
+from app.services.rates import USDT_RUB, parse_rate, rates
+from app.services.payouts import approve_payouts, mark_payouts_paid, reject_payouts
+from app.services.turnover import turnover_summary
+from app.services.trader_cache import trader_cache
+from app.services.pagination import keyset_page
+from app.services.render_cache import render_cache, render_edits_total, render_hash, tap_coalescer
+from app.services.state_store import state_store  # что ждём от пользователя следующим сообщением
 
 # -------------------- CONFIG --------------------
 
@@ -22,12 +41,69 @@ ADMIN_IDS = set(x.strip() for x in os.getenv("ADMIN_IDS", "").split(",") if x.st
 def is_admin(tg_id: int) -> bool:
     return str(tg_id) in ADMIN_IDS
 
-bot = Bot(token=BOT_TOKEN)
+# свой Bot API сервер (локальный telegram-bot-api или фейк из bench/)
+TELEGRAM_API_URL = (os.getenv("TELEGRAM_API_URL") or "").strip()
+
+bot = Bot(
+    token=BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None,
+)
 dp = Dispatcher()
 
-# Простая память для ввода (для 1 реплики Railway норм)
-# mode: "requisites" | "ticket" | "payout"
-WAITING_INPUT: Dict[int, str] = {}
+# -------------------- METRICS --------------------
+
+handler_seconds = Histogram("bot_handler_seconds", "aiogram handler latency by action", ("action",))
+
+# лейбл action приходит от пользователя (callback_data), поэтому число вариантов ограничено
+_ACTION_RE = re.compile(r"^[a-z_]{1,32}$")
+_MAX_ACTIONS = 200
+_seen_actions = set()
+
+def handler_action(event) -> str:
+    if isinstance(event, CallbackQuery):
+        parts = (event.data or "").split(":")
+        action = ":".join(p for p in parts[:2] if _ACTION_RE.match(p)) or "callback"
+    else:
+        text = (getattr(event, "text", None) or "").strip()
+        action = text.split()[0].split("@")[0] if text.startswith("/") else "text"
+    if action not in _seen_actions:
+        if len(_seen_actions) >= _MAX_ACTIONS:
+            return "other"
+        _seen_actions.add(action)
+    return action
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        start = perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            handler_seconds.observe(perf_counter() - start, handler_action(event))
+
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
+
+# /export режет файл на части: лимит документа у Bot API — 50 МБ
+EXPORT_PART_BYTES = int(os.getenv("EXPORT_PART_BYTES", str(45 * 1024 * 1024)))
+
+# Пагинация списков: размер страницы и фильтры (код в callback_data, подпись)
+ADMIN_PAGE_SIZE = 20
+DEALS_PAGE_SIZE = 10
+TRADER_FILTERS = (("all", "Все"), ("on", "ON"), ("off", "OFF"))
+ORDER_FILTERS = (("all", "Все"), ("new", "new"), ("in_work", "in_work"), ("done", "done"), ("cancel", "cancel"))
+PAYOUT_FILTERS = (("all", "Все"), ("new", "new"), ("approved", "approved"), ("rejected", "rejected"), ("paid", "paid"))
+TICKET_FILTERS = (("all", "Все"), ("open", "open"), ("closed", "closed"))
+
+# a:pay_*: (функция сервиса, текст итога, к какому списку вернуться)
+PAYOUT_ACTIONS = {
+    "pay_ok": (
+        approve_payouts,
+        lambda r: f"Одобрено {r['approved']} на {r['amount']:.2f} USDT ({r['traders']} трейдеров), без покрытия: {r['skipped']}",
+        "new",
+    ),
+    "pay_rej": (reject_payouts, lambda r: f"Отклонено {r['rejected']}", "new"),
+    "pay_paid": (mark_payouts_paid, lambda r: f"Отмечено выплаченными {r['paid']}", "approved"),
+}
 
 # -------------------- KEYBOARDS --------------------
 
@@ -57,6 +133,41 @@ def admin_menu_kb() -> InlineKeyboardBuilder:
     kb.adjust(1, 1, 1, 1, 1)
     return kb
 
+# меню не зависят от данных — собираем один раз, а не на каждый показ
+TRADER_MENU = {enabled: trader_menu_kb(enabled).as_markup() for enabled in (True, False)}
+ADMIN_MENU = admin_menu_kb().as_markup()
+
+def page_nav_kb(base: str, filt: str, page, filters=(), with_menu: bool = True, actions=()) -> InlineKeyboardBuilder:
+    # callback_data: <base>:<filter>:<n|p>:<cursor id> (укладывается в 64 байта)
+    # actions: [(text, callback_data), ...] — кнопки действий над списком, по одной в ряд
+    kb = InlineKeyboardBuilder()
+    nav = 0
+    if page.has_newer:
+        kb.button(text="⬅️ Новее", callback_data=f"{base}:{filt}:p:{page.first_id}")
+        nav += 1
+    if page.has_older:
+        kb.button(text="Старее ➡️", callback_data=f"{base}:{filt}:n:{page.last_id}")
+        nav += 1
+    for code, label in filters:
+        kb.button(text=f"• {label}" if code == filt else label, callback_data=f"{base}:{code}")
+    sizes = ([nav] if nav else []) + ([len(filters)] if filters else [])
+    for text, data in actions:
+        kb.button(text=text, callback_data=data)
+        sizes.append(1)
+    if with_menu:
+        kb.button(text="⬅️ Меню", callback_data="a:menu")
+        sizes.append(1)
+    kb.adjust(*sizes)
+    return kb
+
+def parse_page_args(parts, filters=()):
+    # parts = callback_data.split(":") -> (filter, direction, cursor)
+    codes = [code for code, _ in filters]
+    filt = parts[2] if len(parts) > 2 and parts[2] in codes else "all"
+    if len(parts) > 4 and parts[3] in ("n", "p") and parts[4].isdigit():
+        return filt, parts[3], int(parts[4])
+    return filt, "n", None
+
 def admin_trader_actions_kb(trader_id: int, enabled: bool) -> InlineKeyboardBuilder:
     kb = InlineKeyboardBuilder()
     kb.button(text="✏️ Изменить реквизиты", callback_data=f"a:trader_edit_req:{trader_id}")
@@ -64,134 +175,236 @@ def admin_trader_actions_kb(trader_id: int, enabled: bool) -> InlineKeyboardBuil
         kb.button(text="⛔️ Выключить реквизиты", callback_data=f"a:trader_disable:{trader_id}")
     else:
         kb.button(text="✅ Включить реквизиты", callback_data=f"a:trader_enable:{trader_id}")
+    kb.button(text="💱 Сменить валюту", callback_data=f"a:trader_currency:{trader_id}")
     kb.button(text="⬅️ Назад", callback_data="a:traders")
-    kb.adjust(1, 1, 1)
+    kb.adjust(1, 1, 1, 1)
+    return kb
+
+def admin_trader_text(tr) -> str:
+    return (
+        f"👤 Трейдер {tr.id}\n"
+        f"tg_id: {tr.tg_id}\n"
+        f"currency: {tr.currency or 'RUB'}\n"
+        f"requisites_enabled: {tr.requisites_enabled}\n"
+        f"requisites: {(tr.requisites or '')[:300]}\n"
+    )
+
+def parse_currency(text: str):
+    # код валюты заявок трейдера: 3-8 латинских букв (как currency у заявки мерчанта)
+    code = text.strip().upper()
+    if 3 <= len(code) <= 8 and code.isascii() and code.isalpha():
+        return code
+    return None
+
+def rates_kb() -> InlineKeyboardBuilder:
+    kb = InlineKeyboardBuilder()
+    kb.button(text=f"✏️ Задать {USDT_RUB}", callback_data=f"a:rate_set:{USDT_RUB}")
+    kb.button(text="↩️ Сбросить ручной курс", callback_data=f"a:rate_clear:{USDT_RUB}")
+    kb.button(text="🔄 Обновить у провайдера", callback_data="a:rate_refresh")
+    kb.button(text="⬅️ Меню", callback_data="a:menu")
+    kb.adjust(1, 1, 1, 1)
     return kb
 
+def rates_text() -> str:
+    lines = ["💱 Курсы:", ""]
+    for pair, item in sorted(rates.snapshot().items()):
+        line = f"{pair}: {float(item['rate']):.4f} ({item['source']})"
+        if item["override"] is not None:
+            line += f" → ручной {float(item['override']):.4f}"
+        lines.append(line)
+    if len(lines) == 2:
+        lines.append("курсов ещё нет")
+    age = rates.age()
+    lines.append("")
+    lines.append(f"обновлено {age:.0f} с назад" if age != float("inf") else "провайдер ещё не отвечал")
+    if rates.is_stale():
+        lines.append("⚠️ Курс провайдера устарел")
+    return "\n".join(lines)
+
+def payout_actions(filt: str, page):
+    # пакетные действия над выплатами: над страницей (диапазон id) или над всеми в статусе
+    if not page.rows:
+        return []
+    ids = [p.id for p in page.rows]
+    page_range = f"{min(ids)}:{max(ids)}"
+    if filt == "new":
+        return [
+            ("✅ Одобрить страницу", f"a:pay_ok:{page_range}"),
+            ("✅ Одобрить все new", "a:pay_ok:all"),
+            ("⛔️ Отклонить страницу", f"a:pay_rej:{page_range}"),
+        ]
+    if filt == "approved":
+        return [
+            ("💵 Страница выплачена", f"a:pay_paid:{page_range}"),
+            ("💵 Все approved выплачены", "a:pay_paid:all"),
+        ]
+    return []
+
 # -------------------- HELPERS (DB) --------------------
 
-async def get_or_create_trader(tg_id: int) -> Trader:
+async def _upsert_trader(tg_id: int, **values) -> Trader:
+    # один INSERT ... ON CONFLICT (tg_id) ... RETURNING вместо select-then-insert
+    stmt = insert(Trader).values(tg_id=str(tg_id), **values)
     async with AsyncSessionLocal() as session:
-        r = await session.execute(select(Trader).where(Trader.tg_id == str(tg_id)))
-        t = r.scalar()
-        if t:
+        if values:
+            stmt = stmt.on_conflict_do_update(index_elements=[Trader.tg_id], set_=values).returning(Trader)
+            t = (await session.execute(select(Trader).from_statement(stmt))).scalar_one()
+            await commit_trader_state(session, t)
             return t
-        t = Trader(tg_id=str(tg_id))
-        session.add(t)
+        # только создать, если нет: DO NOTHING не пишет (и не блокирует) существующую строку,
+        # но и не возвращает её — тогда читаем обычным SELECT
+        stmt = stmt.on_conflict_do_nothing(index_elements=[Trader.tg_id]).returning(Trader)
+        t = (await session.execute(select(Trader).from_statement(stmt))).scalar()
+        if t is None:
+            t = (await session.execute(select(Trader).where(Trader.tg_id == str(tg_id)))).scalar_one()
         await session.commit()
-        await session.refresh(t)
+    trader_cache.put(t)
+    return t
+
+async def get_or_create_trader(tg_id: int) -> Trader:
+    t = trader_cache.get(tg_id)
+    if t:
         return t
+    return await _upsert_trader(tg_id)
 
-async def set_trader_requisites(tg_id: int, text: str) -> None:
-    async with AsyncSessionLocal() as session:
-        r = await session.execute(select(Trader).where(Trader.tg_id == str(tg_id)))
-        t = r.scalar()
-        if not t:
-            t = Trader(tg_id=str(tg_id))
-            session.add(t)
-        t.requisites = text
-        await session.commit()
+async def set_trader_requisites(tg_id: int, text: str) -> Trader:
+    return await _upsert_trader(tg_id, requisites=text)
 
-async def set_requisites_enabled(tg_id: int, enabled: bool) -> None:
-    async with AsyncSessionLocal() as session:
-        r = await session.execute(select(Trader).where(Trader.tg_id == str(tg_id)))
-        t = r.scalar()
-        if not t:
-            t = Trader(tg_id=str(tg_id))
-            session.add(t)
-        t.requisites_enabled = enabled
-        await session.commit()
+async def set_requisites_enabled(tg_id: int, enabled: bool) -> Trader:
+    return await _upsert_trader(tg_id, requisites_enabled=enabled)
 
 async def trader_stats_text(t: Trader) -> str:
-    # Простейший “курс” и обороты (можно позже заменить на реальный)
-    rate = 80.74
+    # курс из памяти процесса (app.services.rates), без запроса к БД/провайдеру
+    rate = rates.get(USDT_RUB)
 
-    # Оборот за всё время: сумма done по заявкам
-    async with AsyncSessionLocal() as session:
-        total_q = await session.execute(
-            select(func.coalesce(func.sum(Order.amount), 0)).where(
-                Order.trader_id == t.id,
-                Order.status == "done",
-            )
-        )
-        all_time = float(total_q.scalar() or 0)
+    # Обороты по done-заявкам — из дневных роллапов, а не SUM по всей истории
+    turnover = await turnover_summary(t.id)
+    # балансы — снапшот трейдера + несвёрнутые записи журнала
+    balances = await trader_balances(t.id)
 
     return (
         f"Приветствую {t.tg_id}\n"
-        f"🇷🇺 Курс - {rate}\n\n"
-        f"💰 Рабочий Депозит - {float(getattr(t, 'deposit_rub', 0) or 0):.2f}RUB\n"
-        f"❄️ Заморожено - {float(getattr(t, 'frozen_rur', 0) or 0):.2f}RUR\n"
-        f"🧊 Зарезервировано - {float(getattr(t, 'reserved_usdt', 0) or 0):.2f}USDT\n"
-        f"💎 Реферальный Баланс - {float(getattr(t, 'referral_usdt', 0) or 0):.2f}USDT\n\n"
-        f"⚙️ Оборот за Сегодня - 0.00RUR\n"
-        f"⚙️ Оборот за Неделю - 0.00RUR\n"
-        f"⚙️ Оборот за Месяц - 0.00RUR\n"
-        f"⚙️ Оборот за Все Время - {all_time:.2f}RUR\n"
+        f"🇷🇺 Курс - {f'{float(rate):.2f}' if rate is not None else '—'}\n\n"
+        f"💰 Рабочий Депозит - {float(balances['deposit_rub']):.2f}RUB\n"
+        f"❄️ Заморожено - {float(balances['frozen_rur']):.2f}RUR\n"
+        f"🧊 Зарезервировано - {float(balances['reserved_usdt']):.2f}USDT\n"
+        f"💎 Реферальный Баланс - {float(balances['referral_usdt']):.2f}USDT\n\n"
+        f"⚙️ Оборот за Сегодня - {turnover['today']:.2f}RUR\n"
+        f"⚙️ Оборот за Неделю - {turnover['week']:.2f}RUR\n"
+        f"⚙️ Оборот за Месяц - {turnover['month']:.2f}RUR\n"
+        f"⚙️ Оборот за Все Время - {turnover['all_time']:.2f}RUR\n"
     )
 
+# -------------------- RENDER --------------------
+
+def _markup_json(markup) -> str:
+    return markup.model_dump_json(exclude_none=True) if markup is not None else ""
+
+def _shows_markup(message: Message, markup) -> bool:
+    return _markup_json(message.reply_markup) == _markup_json(markup)
+
+async def edit_dashboard(message: Message, text: str, markup=None) -> bool:
+    # edit только если текст или клавиатура отличаются от показанных; False — пропустили.
+    # Telegram обрезает пробелы по краям текста, поэтому хэшируем без них.
+    digest = render_hash(text.strip(), _markup_json(markup))
+    if render_cache.get(message.chat.id, message.message_id) is None and message.text is not None:
+        # сообщение ещё не видели (рестарт, другой процесс) — берём то, что на экране
+        render_cache.remember(message.chat.id, message.message_id, render_hash(message.text.strip(), _markup_json(message.reply_markup)))
+    if render_cache.unchanged(message.chat.id, message.message_id, digest):
+        render_edits_total.inc("skipped")
+        return False
+    try:
+        await message.edit_text(text, reply_markup=markup)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise
+        render_edits_total.inc("skipped")
+        render_cache.remember(message.chat.id, message.message_id, digest)
+        return False
+    render_edits_total.inc("sent")
+    render_cache.remember(message.chat.id, message.message_id, digest)
+    return True
+
 # -------------------- TRADER: START --------------------
 
 @dp.message(Command("start"))
 async def cmd_start(msg: Message):
     t = await get_or_create_trader(msg.from_user.id)
     text = await trader_stats_text(t)
-    kb = trader_menu_kb(bool(getattr(t, "requisites_enabled", False))).as_markup()
-    await msg.answer(text, reply_markup=kb)
+    kb = TRADER_MENU[bool(getattr(t, "requisites_enabled", False))]
+    sent = await msg.answer(text, reply_markup=kb)
+    render_cache.remember(sent.chat.id, sent.message_id, render_hash(text.strip(), _markup_json(kb)))
 
 # -------------------- TRADER: CALLBACKS --------------------
 
 @dp.callback_query(F.data.startswith("t:"))
 async def trader_callbacks(cb: CallbackQuery):
     t = await get_or_create_trader(cb.from_user.id)
-    action = cb.data.split(":", 1)[1]
+    parts = cb.data.split(":")
+    action = parts[1]
 
-    if action == "req_on":
-        if not (t.requisites or "").strip():
+    if action in ("req_on", "req_off"):
+        enabled = action == "req_on"
+        if enabled and not (t.requisites or "").strip():
             await cb.answer("Сначала добавь реквизиты", show_alert=True)
-            WAITING_INPUT[cb.from_user.id] = "requisites"
+            await state_store.set(cb.from_user.id, "requisites")
             await cb.message.answer("✂️ Отправь реквизиты одним сообщением (банк/карта/ФИО).")
             return
-        await set_requisites_enabled(cb.from_user.id, True)
-        await cb.answer("Реквизиты включены ✅")
-
-    elif action == "req_off":
-        await set_requisites_enabled(cb.from_user.id, False)
-        await cb.answer("Реквизиты отключены ❌")
+        async with tap_coalescer.latest(cb.from_user.id) as is_latest:
+            if not is_latest:
+                # пока обрабатывали прошлое нажатие, пришло ещё одно — применится оно
+                render_edits_total.inc("superseded")
+                await cb.answer()
+                return
+            t = await get_or_create_trader(cb.from_user.id)
+            await cb.answer("Реквизиты включены ✅" if enabled else "Реквизиты отключены ❌")
+            if bool(t.requisites_enabled) == enabled and _shows_markup(cb.message, TRADER_MENU[enabled]):
+                # состояние уже такое и на экране актуальное меню — ни записи, ни перерисовки
+                render_edits_total.inc("skipped")
+                return
+            if bool(t.requisites_enabled) != enabled:
+                t = await set_requisites_enabled(cb.from_user.id, enabled)
+            await edit_dashboard(cb.message, await trader_stats_text(t), TRADER_MENU[enabled])
+        return
 
     elif action == "requisites":
-        WAITING_INPUT[cb.from_user.id] = "requisites"
+        await state_store.set(cb.from_user.id, "requisites")
         await cb.answer()
         await cb.message.answer("✂️ Отправь реквизиты одним сообщением (банк/карта/ФИО).")
         return
 
     elif action == "appeals":
-        WAITING_INPUT[cb.from_user.id] = "ticket"
+        await state_store.set(cb.from_user.id, "ticket")
         await cb.answer()
         await cb.message.answer("📌 Опиши апелляцию/проблему одним сообщением. Я создам тикет.")
         return
 
     elif action == "deals":
-        # Показать последние 10 заявок трейдера
+        # сделки трейдера постранично (keyset по индексу orders(trader_id, id))
+        _, direction, cursor = parse_page_args(parts)
         async with AsyncSessionLocal() as session:
-            r = await session.execute(
-                select(Order).where(Order.trader_id == t.id).order_by(Order.id.desc()).limit(10)
+            page = await keyset_page(
+                session, select(Order).where(Order.trader_id == t.id), Order.id, cursor, direction, DEALS_PAGE_SIZE
             )
-            orders = r.scalars().all()
 
-        if not orders:
-            await cb.answer()
-            await cb.message.answer("🗂 Сделок пока нет.")
+        await cb.answer()
+        if not page.rows:
+            if cursor is None:
+                await cb.message.answer("🗂 Сделок пока нет.")
             return
 
-        lines = ["🗂 Последние сделки:"]
-        for o in orders:
+        lines = ["🗂 Последние сделки:" if cursor is None else "🗂 Сделки:"]
+        for o in page.rows:
             lines.append(f"#{o.id} | {o.merchant_order_id} | {float(o.amount):.2f} {o.currency} | {o.status}")
-        await cb.answer()
-        await cb.message.answer("\n".join(lines))
+        kb = page_nav_kb("t:deals", "all", page, with_menu=False).as_markup()
+        if cursor is None:
+            await cb.message.answer("\n".join(lines), reply_markup=kb)
+        else:
+            await edit_dashboard(cb.message, "\n".join(lines), kb)
         return
 
     elif action == "payouts":
-        WAITING_INPUT[cb.from_user.id] = "payout"
+        await state_store.set(cb.from_user.id, "payout")
         await cb.answer()
         await cb.message.answer("💸 Напиши сумму выплаты (числом). Например: 50")
         return
@@ -201,17 +414,37 @@ async def trader_callbacks(cb: CallbackQuery):
         await cb.message.answer("📦 Баланс: пока без детализации (добавим следующим шагом).")
         return
 
-    # обновим дашборд после действий
-    t2 = await get_or_create_trader(cb.from_user.id)
-    text = await trader_stats_text(t2)
-    kb = trader_menu_kb(bool(getattr(t2, "requisites_enabled", False))).as_markup()
-    await cb.message.edit_text(text, reply_markup=kb)
+    # прочие нажатия — просто обновить дашборд
+    await cb.answer()
+    await edit_dashboard(cb.message, await trader_stats_text(t), TRADER_MENU[bool(getattr(t, "requisites_enabled", False))])
+
+# -------------------- TRADER: ORDERS --------------------
+
+@dp.callback_query(F.data.startswith("o:"))
+async def order_callbacks(cb: CallbackQuery):
+    # формат: o:done:<order_id> / o:cancel:<order_id> (кнопки из уведомления о заявке)
+    parts = cb.data.split(":")
+    if len(parts) != 3 or parts[1] not in ("done", "cancel") or not parts[2].isdigit():
+        await cb.answer()
+        return
+
+    t = await get_or_create_trader(cb.from_user.id)
+    row = await close_order(int(parts[2]), parts[1], trader_id=t.id)
+    if not row:
+        await cb.answer("Заявка уже закрыта или не найдена", show_alert=True)
+        return
+    # балансы поменялись — снапшот в кэше больше не актуален
+    trader_cache.invalidate(cb.from_user.id)
+
+    status_text = "✅ Оплата подтверждена" if parts[1] == "done" else "❌ Заявка отменена"
+    await cb.answer(status_text)
+    await cb.message.edit_text(f"{cb.message.text}\n\n{status_text}")
 
 # -------------------- TRADER: TEXT INPUT --------------------
 
-@dp.message(F.text)
+@dp.message(F.text, ~F.text.startswith("/"))
 async def trader_text_input(msg: Message):
-    mode = WAITING_INPUT.get(msg.from_user.id)
+    mode = await state_store.get(msg.from_user.id)
     if not mode:
         return
 
@@ -221,7 +454,7 @@ async def trader_text_input(msg: Message):
 
     if mode == "requisites":
         await set_trader_requisites(msg.from_user.id, text)
-        WAITING_INPUT.pop(msg.from_user.id, None)
+        await state_store.pop(msg.from_user.id)
         await msg.answer("✅ Реквизиты сохранены. Теперь можешь нажать «Включить Реквизиты».")
         return
 
@@ -230,7 +463,7 @@ async def trader_text_input(msg: Message):
         async with AsyncSessionLocal() as session:
             session.add(Ticket(trader_id=t.id, text=text, status="open"))
             await session.commit()
-        WAITING_INPUT.pop(msg.from_user.id, None)
+        await state_store.pop(msg.from_user.id)
         await msg.answer("💬 Тикет создан и отправлен в поддержку.")
         return
 
@@ -240,15 +473,52 @@ async def trader_text_input(msg: Message):
         except ValueError:
             await msg.answer("Напиши число, например: 50")
             return
+        if amount <= 0:
+            await msg.answer("Сумма должна быть больше нуля, например: 50")
+            return
 
         t = await get_or_create_trader(msg.from_user.id)
         async with AsyncSessionLocal() as session:
             session.add(Payout(trader_id=t.id, amount=amount, currency="USDT", status="new"))
             await session.commit()
-        WAITING_INPUT.pop(msg.from_user.id, None)
+        await state_store.pop(msg.from_user.id)
         await msg.answer("💸 Заявка на выплату создана. Ожидай подтверждения админа.")
         return
 
+    if mode.startswith("rate:"):
+        if not is_admin(msg.from_user.id):
+            await state_store.pop(msg.from_user.id)
+            return
+        rate = parse_rate(text)
+        if rate is None:
+            await msg.answer("Напиши положительное число, например: 81.5")
+            return
+        await rates.set_override(mode.split(":", 1)[1], rate, msg.from_user.id)
+        await state_store.pop(msg.from_user.id)
+        await msg.answer(rates_text(), reply_markup=rates_kb().as_markup())
+        return
+
+    if mode.startswith("currency:"):
+        if not is_admin(msg.from_user.id):
+            await state_store.pop(msg.from_user.id)
+            return
+        currency = parse_currency(text)
+        if currency is None:
+            await msg.answer("Напиши код валюты латиницей, например: RUB")
+            return
+        async with AsyncSessionLocal() as session:
+            tr = (await session.execute(select(Trader).where(Trader.id == int(mode.split(":", 1)[1])))).scalar()
+            if tr is not None:
+                tr.currency = currency
+                # пул подбора и кэш бота в других процессах узнают о смене через уведомление
+                await commit_trader_state(session, tr)
+        await state_store.pop(msg.from_user.id)
+        if tr is None:
+            await msg.answer("Трейдер не найден.")
+            return
+        await msg.answer(admin_trader_text(tr), reply_markup=admin_trader_actions_kb(tr.id, tr.requisites_enabled).as_markup())
+        return
+
 # -------------------- ADMIN --------------------
 
 @dp.message(Command("admin"))
@@ -256,7 +526,7 @@ async def cmd_admin(msg: Message):
     if not is_admin(msg.from_user.id):
         await msg.answer("⛔ Нет доступа.")
         return
-    await msg.answer("Администрирование бота", reply_markup=admin_menu_kb().as_markup())
+    await msg.answer("Администрирование бота", reply_markup=ADMIN_MENU)
 
 @dp.callback_query(F.data.startswith("a:"))
 async def admin_callbacks(cb: CallbackQuery):
@@ -266,62 +536,132 @@ async def admin_callbacks(cb: CallbackQuery):
 
     parts = cb.data.split(":")
     action = parts[1]
+    # действие могло уже ответить на callback итогом перед показом списка
+    answered = False
+
+    if action == "menu":
+        await cb.answer()
+        await edit_dashboard(cb.message, "Администрирование бота", ADMIN_MENU)
+        return
 
     if action == "traders":
+        filt, direction, cursor = parse_page_args(parts, TRADER_FILTERS)
+        stmt = select(Trader)
+        if filt != "all":
+            stmt = stmt.where(Trader.requisites_enabled.is_(filt == "on"))
         async with AsyncSessionLocal() as session:
-            r = await session.execute(select(Trader).order_by(Trader.id.desc()).limit(20))
-            traders = r.scalars().all()
+            page = await keyset_page(session, stmt, Trader.id, cursor, direction, ADMIN_PAGE_SIZE)
 
-        lines = ["👤 Трейдеры (последние 20):", ""]
-        for t in traders:
+        lines = [f"👤 Трейдеры ({filt}):", ""]
+        for t in page.rows:
             lines.append(f"ID {t.id} | tg {t.tg_id} | req {'ON' if t.requisites_enabled else 'OFF'}")
         lines.append("")
         lines.append("Открыть трейдера: /trader <id>")
         await cb.answer()
-        await cb.message.edit_text("\n".join(lines), reply_markup=admin_menu_kb().as_markup())
+        await edit_dashboard(cb.message, "\n".join(lines), page_nav_kb("a:traders", filt, page, TRADER_FILTERS).as_markup())
         return
 
     if action == "orders":
+        filt, direction, cursor = parse_page_args(parts, ORDER_FILTERS)
+        stmt = select(Order)
+        if filt != "all":
+            stmt = stmt.where(Order.status == filt)
         async with AsyncSessionLocal() as session:
-            r = await session.execute(select(Order).order_by(Order.id.desc()).limit(20))
-            orders = r.scalars().all()
+            page = await keyset_page(session, stmt, Order.id, cursor, direction, ADMIN_PAGE_SIZE)
 
-        lines = ["📄 Заявки (последние 20):", ""]
-        for o in orders:
+        lines = [f"📄 Заявки ({filt}):", ""]
+        for o in page.rows:
             lines.append(f"#{o.id} | {o.merchant_order_id} | {float(o.amount):.2f} {o.currency} | {o.status}")
         await cb.answer()
-        await cb.message.edit_text("\n".join(lines), reply_markup=admin_menu_kb().as_markup())
+        await edit_dashboard(cb.message, "\n".join(lines), page_nav_kb("a:orders", filt, page, ORDER_FILTERS).as_markup())
         return
 
+    if action in PAYOUT_ACTIONS:
+        # формат: a:pay_ok:all или a:pay_ok:<min id>:<max id> (выплаты текущей страницы)
+        id_range = (int(parts[2]), int(parts[3])) if len(parts) == 4 and parts[2].isdigit() and parts[3].isdigit() else None
+        if id_range is None and parts[2:] != ["all"]:
+            await cb.answer()
+            return
+        run, summary, back = PAYOUT_ACTIONS[action]
+        res = await run(id_range=id_range)
+        await cb.answer(summary(res), show_alert=True)
+        # возвращаемся к списку, из которого пришли (callback уже отвечен итогом)
+        parts, action, answered = ["a", "payouts", back], "payouts", True
+
     if action == "payouts":
+        filt, direction, cursor = parse_page_args(parts, PAYOUT_FILTERS)
+        stmt = select(Payout)
+        if filt != "all":
+            stmt = stmt.where(Payout.status == filt)
         async with AsyncSessionLocal() as session:
-            r = await session.execute(select(Payout).order_by(Payout.id.desc()).limit(20))
-            payouts = r.scalars().all()
-
-        lines = ["💸 Выплаты (последние 20):", ""]
-        for p in payouts:
-            lines.append(f"#{p.id} | trader {p.trader_id} | {float(p.amount):.2f} {p.currency} | {p.status}")
-        await cb.answer()
-        await cb.message.edit_text("\n".join(lines), reply_markup=admin_menu_kb().as_markup())
+            page = await keyset_page(session, stmt, Payout.id, cursor, direction, ADMIN_PAGE_SIZE)
+
+        lines = [f"💸 Выплаты ({filt}):", ""]
+        for p in page.rows:
+            rub = rates.convert(p.amount) if p.currency == "USDT" else None
+            rub_text = f" (≈ {float(rub):.0f} RUB)" if rub is not None else ""
+            lines.append(f"#{p.id} | trader {p.trader_id} | {float(p.amount):.2f} {p.currency}{rub_text} | {p.status}")
+        if not answered:
+            await cb.answer()
+        await edit_dashboard(
+            cb.message,
+            "\n".join(lines),
+            page_nav_kb("a:payouts", filt, page, PAYOUT_FILTERS, actions=payout_actions(filt, page)).as_markup(),
+        )
         return
 
     if action == "tickets":
+        filt, direction, cursor = parse_page_args(parts, TICKET_FILTERS)
+        stmt = select(Ticket)
+        if filt != "all":
+            stmt = stmt.where(Ticket.status == filt)
         async with AsyncSessionLocal() as session:
-            r = await session.execute(select(Ticket).order_by(Ticket.id.desc()).limit(20))
-            tickets = r.scalars().all()
+            page = await keyset_page(session, stmt, Ticket.id, cursor, direction, ADMIN_PAGE_SIZE)
 
-        lines = ["💬 Тикеты (последние 20):", ""]
-        for t in tickets:
+        lines = [f"💬 Тикеты ({filt}):", ""]
+        for t in page.rows:
             lines.append(f"#{t.id} | trader {t.trader_id} | {t.status}")
         lines.append("")
         lines.append("Открыть тикет: /ticket <id>")
         await cb.answer()
-        await cb.message.edit_text("\n".join(lines), reply_markup=admin_menu_kb().as_markup())
+        await edit_dashboard(cb.message, "\n".join(lines), page_nav_kb("a:tickets", filt, page, TICKET_FILTERS).as_markup())
+        return
+
+    if action == "rate_set" and len(parts) == 3:
+        # формат: a:rate_set:<pair>; сам курс придёт следующим сообщением
+        await state_store.set(cb.from_user.id, f"rate:{parts[2]}")
+        await cb.answer()
+        await cb.message.answer(f"💱 Напиши курс {parts[2]} числом, например: 81.5")
         return
 
+    if action in ("rate_clear", "rate_refresh"):
+        if action == "rate_clear":
+            if len(parts) != 3:
+                await cb.answer()
+                return
+            await rates.set_override(parts[2], None, cb.from_user.id)
+            await cb.answer("Ручной курс сброшен")
+        else:
+            try:
+                updated = await rates.refresh(force=True)
+            except Exception as e:
+                await cb.answer(f"Провайдер недоступен: {e}"[:200], show_alert=True)
+                return
+            await cb.answer("Курсы обновлены" if updated else "Обновление уже идёт в другом процессе")
+        action = "rates"
+        answered = True
+
     if action == "rates":
+        if not answered:
+            await cb.answer()
+        await edit_dashboard(cb.message, rates_text(), rates_kb().as_markup())
+        return
+
+    if action == "trader_currency" and len(parts) == 3 and parts[2].isdigit():
+        # формат: a:trader_currency:<id>; код валюты придёт следующим сообщением
+        await state_store.set(cb.from_user.id, f"currency:{parts[2]}")
         await cb.answer()
-        await cb.message.edit_text("💱 Курсы: пока заглушка. Сделаем редактирование кнопками.", reply_markup=admin_menu_kb().as_markup())
+        await cb.message.answer(f"💱 Напиши валюту заявок трейдера {parts[2]}, например: RUB")
         return
 
     if action in ("trader_edit_req", "trader_enable", "trader_disable"):
@@ -337,31 +677,159 @@ async def admin_callbacks(cb: CallbackQuery):
 
             if action == "trader_enable":
                 tr.requisites_enabled = True
-                await session.commit()
+                await commit_trader_state(session, tr)
                 await cb.answer("Включено ✅")
             elif action == "trader_disable":
                 tr.requisites_enabled = False
-                await session.commit()
+                await commit_trader_state(session, tr)
                 await cb.answer("Выключено ❌")
             elif action == "trader_edit_req":
                 await cb.answer("Редактирование сделаем следующим шагом через FSM.", show_alert=True)
 
-        # обновим карточку
-        async with AsyncSessionLocal() as session:
-            r = await session.execute(select(Trader).where(Trader.id == trader_id))
-            tr = r.scalar()
-
-        text = (
-            f"👤 Трейдер {tr.id}\n"
-            f"tg_id: {tr.tg_id}\n"
-            f"requisites_enabled: {tr.requisites_enabled}\n"
-            f"requisites: {(tr.requisites or '')[:300]}\n"
-        )
-        await cb.message.edit_text(text, reply_markup=admin_trader_actions_kb(tr.id, tr.requisites_enabled).as_markup())
+        # обновим карточку (tr актуален: expire_on_commit=False)
+        await edit_dashboard(cb.message, admin_trader_text(tr), admin_trader_actions_kb(tr.id, tr.requisites_enabled).as_markup())
         return
 
     await cb.answer()
 
+@dp.message(Command("cache"))
+async def cmd_cache_stats(msg: Message):
+    if not is_admin(msg.from_user.id):
+        await msg.answer("⛔ Нет доступа.")
+        return
+
+    st = trader_cache.stats()
+    await msg.answer(
+        f"🗃 Кэш трейдеров: {st['size']}/{st['maxsize']}\n"
+        f"hit: {st['hits']} | miss: {st['misses']} | hit ratio: {st['hit_ratio']:.1%}\n"
+        f"evictions: {st['evictions']}"
+    )
+
+@dp.message(Command("dbpool"))
+async def cmd_db_pool(msg: Message):
+    if not is_admin(msg.from_user.id):
+        await msg.answer("⛔ Нет доступа.")
+        return
+
+    st = pool_status()
+    await msg.answer(
+        f"🛢 Пул БД: {st['checked_out']}/{st['size']} занято, overflow {st['overflow']}\n"
+        f"overflow событий: {st['overflow_events']} | таймаутов: {st['timeouts']}\n"
+        f"подключений: {st['connects']} | инвалидаций: {st['invalidations']}\n"
+        f"ожидание соединения: {st['acquire_count']} раз, в среднем {st['acquire_avg_ms']:.2f} мс"
+    )
+
+@dp.message(Command("ledger"))
+async def cmd_ledger(msg: Message):
+    if not is_admin(msg.from_user.id):
+        await msg.answer("⛔ Нет доступа.")
+        return
+
+    pending = await pending_entries()
+    mismatches = await reconcile_balances(limit=10)
+    lines = [f"📒 Журнал балансов: несвёрнутых записей {pending}"]
+    if not mismatches:
+        lines.append("✅ Снапшоты сходятся с журналом")
+    else:
+        lines.append(f"⚠️ Расхождения (первые {len(mismatches)}):")
+        for m in mismatches:
+            diffs = [
+                f"{account} {float(m[account]):.2f} ≠ {float(m['journal_' + account]):.2f}"
+                for account in ACCOUNTS
+                if m[account] != m["journal_" + account]
+            ]
+            lines.append(f"trader {m['trader_id']}: " + ", ".join(diffs))
+    await msg.answer("\n".join(lines))
+
+@dp.message(Command("deposit"))
+async def cmd_deposit(msg: Message):
+    # /deposit <trader_id> <сумма RUB>: пополнение (или списание со знаком минус) рабочего депозита через журнал
+    if not is_admin(msg.from_user.id):
+        await msg.answer("⛔ Нет доступа.")
+        return
+
+    parts = (msg.text or "").split()
+    try:
+        amount = Decimal(parts[2].replace(",", ".")) if len(parts) == 3 and parts[1].isdigit() else None
+    except InvalidOperation:
+        amount = None
+    if amount is None or not amount.is_finite():
+        await msg.answer("Формат: /deposit <trader_id> <сумма>, например: /deposit 12 5000 или /deposit 12 -500")
+        return
+
+    try:
+        tr = await adjust_balance(int(parts[1]), "deposit_rub", amount, "adjustment")
+    except ValueError:
+        await msg.answer("Нельзя: сумма нулевая, слишком большая или депозит станет меньше замороженной суммы.")
+        return
+    if tr is None:
+        await msg.answer("Трейдер не найден.")
+        return
+    await msg.answer(f"💰 Депозит трейдера {tr.id}: {float(tr.deposit_rub):.2f} RUB")
+
+@dp.message(Command("export"))
+async def cmd_export(msg: Message):
+    if not is_admin(msg.from_user.id):
+        await msg.answer("⛔ Нет доступа.")
+        return
+
+    usage = f"Формат: /export <{'|'.join(EXPORTS)}> [с YYYY-MM-DD] [по YYYY-MM-DD] [{'|'.join(FORMATS)}]"
+    args = msg.text.split()[1:]
+    if not args or args[0] not in EXPORTS:
+        await msg.answer(usage)
+        return
+    kind, fmt, days = args[0], "csv", []
+    try:
+        for arg in args[1:]:
+            if arg in FORMATS:
+                fmt = arg
+            else:
+                days.append(parse_day(arg))
+    except ValueError:
+        await msg.answer(usage)
+        return
+    if len(days) > 2:
+        await msg.answer(usage)
+        return
+    date_from = days[0] if days else None
+    date_to = days[1] if len(days) > 1 else None
+
+    await msg.answer(f"📤 Выгружаю {kind}…")
+    # пишем потоком во временный файл и отправляем частями по EXPORT_PART_BYTES:
+    # в памяти только текущая пачка строк, на диске — только текущая часть
+    parts = 0
+    with tempfile.TemporaryDirectory(prefix="export-") as tmp:
+        path = os.path.join(tmp, "part")
+        f = open(path, "wb")
+        written = 0
+        has_rows = False
+        head = b""
+        try:
+            async for chunk in export_text(kind, fmt, date_from, date_to):
+                data = chunk.encode()
+                if not head and fmt == "csv":
+                    head = data
+                    f.write(data)
+                    written = len(data)
+                    continue
+                if has_rows and written + len(data) > EXPORT_PART_BYTES:
+                    f.close()
+                    parts += 1
+                    await msg.answer_document(FSInputFile(path, filename=export_filename(kind, fmt, date_from, date_to, parts)))
+                    f = open(path, "wb")
+                    f.write(head)
+                    written = len(head)
+                f.write(data)
+                written += len(data)
+                has_rows = has_rows or bool(data)
+        finally:
+            f.close()
+        if has_rows or not parts:
+            name = export_filename(kind, fmt, date_from, date_to, parts + 1 if parts else 0)
+            await msg.answer_document(FSInputFile(path, filename=name))
+            parts += 1
+    await msg.answer(f"✅ Готово, файлов: {parts}")
+
 @dp.message(Command("trader"))
 async def cmd_open_trader(msg: Message):
     if not is_admin(msg.from_user.id):
@@ -382,13 +850,7 @@ async def cmd_open_trader(msg: Message):
         await msg.answer("Трейдер не найден.")
         return
 
-    text = (
-        f"👤 Трейдер {tr.id}\n"
-        f"tg_id: {tr.tg_id}\n"
-        f"requisites_enabled: {tr.requisites_enabled}\n"
-        f"requisites: {(tr.requisites or '')[:300]}\n"
-    )
-    await msg.answer(text, reply_markup=admin_trader_actions_kb(tr.id, tr.requisites_enabled).as_markup())
+    await msg.answer(admin_trader_text(tr), reply_markup=admin_trader_actions_kb(tr.id, tr.requisites_enabled).as_markup())
 
 @dp.message(Command("ticket"))
 async def cmd_open_ticket(msg: Message):
@@ -1,21 +1,172 @@
+import asyncio
 import os
+import time
+
+from sqlalchemy import event, exc, text
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from app.metrics import Counter, Gauge, Histogram
+
+
+def database_url() -> str:
+    url = os.getenv("DB_URL")
+    if not url:
+        raise RuntimeError("DB_URL is not set")
+
+    # важно: должен быть asyncpg
+    if not url.startswith("postgresql+asyncpg://"):
+        raise RuntimeError("DB_URL must start with postgresql+asyncpg://")
+    return url
+
+
+def asyncpg_dsn() -> str:
+    # asyncpg без диалекта sqlalchemy (для LISTEN/NOTIFY)
+    return database_url().replace("postgresql+asyncpg://", "postgresql://", 1)
+
+
+# -------------------- POOL CONFIG --------------------
 
-DATABASE_URL = os.getenv("DB_URL")
-if not DATABASE_URL:
-    raise RuntimeError("DB_URL is not set")
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+POOL_MAX_OVERFLOW = int(os.getenv("DB_POOL_MAX_OVERFLOW", "10"))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"
+# кэш подготовленных выражений адаптера sqlalchemy (на соединение)
+PREPARED_STATEMENT_CACHE_SIZE = int(os.getenv("DB_PREPARED_STATEMENT_CACHE_SIZE", "500"))
+# кэш самого asyncpg; за pgbouncer в transaction mode оба ставить в 0
+STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
 
-# важно: должен быть asyncpg
-if not DATABASE_URL.startswith("postgresql+asyncpg://"):
-    raise RuntimeError("DB_URL must start with postgresql+asyncpg://")
+# -------------------- POOL METRICS --------------------
 
-engine = create_async_engine(DATABASE_URL, echo=False)
+pool_acquire_seconds = Histogram("db_pool_acquire_seconds", "Time waiting for a pooled connection")
+pool_overflow_total = Counter("db_pool_overflow_total", "Connections opened beyond pool_size")
+pool_timeouts_total = Counter("db_pool_timeouts_total", "Checkouts that hit pool_timeout")
+pool_connects_total = Counter("db_pool_connects_total", "New DBAPI connections")
+pool_invalidations_total = Counter("db_pool_invalidations_total", "Connections invalidated (pre-ping/disconnect)")
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    # QueuePool с замером ожидания соединения и счётчиком overflow
+
+    def _do_get(self):
+        start = time.perf_counter()
+        overflow_before = self._overflow
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            pool_timeouts_total.inc()
+            raise
+        finally:
+            pool_acquire_seconds.observe(time.perf_counter() - start)
+            if self._overflow > max(overflow_before, 0):
+                pool_overflow_total.inc()
+
+
+# Движок создаётся лениво (init_engine): импорт моделей/сервисов не требует DB_URL
+# и ничего не подключает; пул открывает и прогревает lifespan приложения.
+engine = None
 
 AsyncSessionLocal = async_sessionmaker(
-    bind=engine,
     class_=AsyncSession,
     expire_on_commit=False
 )
 
+
+def init_engine():
+    global engine
+    if engine is not None:
+        return engine
+
+    engine = create_async_engine(
+        database_url(),
+        echo=False,
+        poolclass=InstrumentedPool,
+        pool_size=POOL_SIZE,
+        max_overflow=POOL_MAX_OVERFLOW,
+        pool_timeout=POOL_TIMEOUT,
+        pool_recycle=POOL_RECYCLE,
+        pool_pre_ping=POOL_PRE_PING,
+        connect_args={
+            "prepared_statement_cache_size": PREPARED_STATEMENT_CACHE_SIZE,
+            "statement_cache_size": STATEMENT_CACHE_SIZE,
+        },
+    )
+    event.listen(engine.sync_engine, "connect", _on_connect)
+    event.listen(engine.sync_engine, "invalidate", _on_invalidate)
+    AsyncSessionLocal.configure(bind=engine)
+    return engine
+
+
+def get_engine():
+    return engine if engine is not None else init_engine()
+
+
+async def dispose_engine() -> None:
+    global engine
+    if engine is not None:
+        await engine.dispose()
+        engine = None
+
+
+async def prewarm_pool(warmup=None, size: int = POOL_SIZE) -> None:
+    # открываем size соединений одновременно (барьер не даёт вернуть соединение в пул раньше времени,
+    # иначе все сессии получили бы одно и то же) и на каждом готовим горячие запросы warmup(session).
+    # Всё откатывается: прогрев ничего не меняет в данных.
+    barrier = asyncio.Barrier(size)
+
+    async def warm_one():
+        async with AsyncSessionLocal() as session:
+            try:
+                await session.execute(text("SELECT 1"))
+                await barrier.wait()
+                if warmup is not None:
+                    await warmup(session)
+            except BaseException:
+                await barrier.abort()
+                raise
+            finally:
+                await session.rollback()
+
+    await asyncio.gather(*(warm_one() for _ in range(size)))
+
+
+def _on_connect(dbapi_conn, record):
+    pool_connects_total.inc()
+
+
+def _on_invalidate(dbapi_conn, record, exception):
+    pool_invalidations_total.inc()
+
+
+pool_checked_out = Gauge("db_pool_checked_out", "Connections currently checked out", fn=lambda: engine.pool.checkedout() if engine is not None else 0)
+pool_overflow = Gauge("db_pool_overflow", "Current overflow connections", fn=lambda: max(engine.pool.overflow(), 0) if engine is not None else 0)
+
+
+def pool_status() -> dict:
+    acquire = pool_acquire_seconds.snapshot()
+    if engine is None:
+        return {"size": 0, "checked_out": 0, "checked_in": 0, "overflow": 0, **_pool_counters(acquire)}
+    return {
+        "size": engine.pool.size(),
+        "checked_out": pool_checked_out.get(),
+        "checked_in": engine.pool.checkedin(),
+        "overflow": pool_overflow.get(),
+        **_pool_counters(acquire),
+    }
+
+
+def _pool_counters(acquire: dict) -> dict:
+    return {
+        "overflow_events": pool_overflow_total.get(),
+        "timeouts": pool_timeouts_total.get(),
+        "connects": pool_connects_total.get(),
+        "invalidations": pool_invalidations_total.get(),
+        "acquire_count": acquire["count"],
+        "acquire_avg_ms": acquire["sum"] / acquire["count"] * 1000 if acquire["count"] else 0.0,
+        "acquire_buckets": acquire["buckets"],
+    }
+
+
 Base = declarative_base()
@@ -1,15 +1,290 @@
-from fastapi import FastAPI
-from app.services.dispatcher import dispatch_order
-from pydantic import BaseModel
+import hmac
+import json
+import os
+from contextlib import asynccontextmanager
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from app.database import dispose_engine, init_engine, prewarm_pool
+from app.services.admission import INTAKE_RETRY_AFTER, intake_gate, intake_rejected_total, merchant_burst, throttle
+from app.services.dispatcher import dispatch_order, dispatch_orders_batch
+from app.services.deadlines import deadline_scheduler
+from app.services.events import listener
+from app.services.export import EXPORTS, FORMATS, export_filename, export_text, parse_day
+from app.services.ledger import adjust_balance, start_ledger_compactor, stop_ledger_compactor
+from app.services.merchants import MERCHANT_AUTH, create_merchant, deactivate_merchant, verify_request
+from app.services.rates import rates, start_rates
+from app.services.pool import start_trader_pool, trader_pool
+from app.services.trader_cache import start_trader_cache
+from app.services.order_watch import load_order_status, start_order_watch, status_query, stream_status, wait_status_change
+from app.services.trader import MAX_ORDER_AMOUNT, reserve_trader
+from app.models import check_schema
+from app.metrics import render_prometheus
+from app.services import webhook
+from pydantic import BaseModel, Field, field_validator
+
+router = APIRouter()
+
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "5000"))
+# сколько максимум держим соединение в ожидании смены статуса
+LONGPOLL_MAX_SECONDS = float(os.getenv("LONGPOLL_MAX_SECONDS", "60"))
+SSE_MAX_SECONDS = float(os.getenv("SSE_MAX_SECONDS", "600"))
+SSE_HEARTBEAT_SECONDS = float(os.getenv("SSE_HEARTBEAT_SECONDS", "15"))
+# токен админских эндпоинтов (Authorization: Bearer ...); пустой — эндпоинты выключены
+ADMIN_API_TOKEN = os.getenv("ADMIN_API_TOKEN", "")
+# открыть и прогреть пул до приёма трафика (DB_PREWARM=0 — отключить)
+DB_PREWARM = os.getenv("DB_PREWARM", "1") == "1"
+# сумма больше любого депозита: прогрев проходит оба запроса резерва, не замораживая ничего
+WARMUP_AMOUNT = 10 ** 15
+
+
+async def _warm_statements(session):
+    await session.execute(status_query(""))
+    await reserve_trader(session, WARMUP_AMOUNT)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    init_engine()
+    # схему мигрирует одноразовый шаг до старта воркеров (app.models.migrate), здесь — только сверка
+    await check_schema()
+    await start_trader_pool()
+    await start_trader_cache()
+    if DB_PREWARM:
+        await prewarm_pool(_warm_statements)
+    await start_order_watch()
+    await start_ledger_compactor()
+    await start_rates()
+    await deadline_scheduler.start()
+    if webhook.BOT_MODE == "webhook":
+        await webhook.update_queue.start()
+    yield
+    await webhook.update_queue.stop()
+    await deadline_scheduler.stop()
+    await stop_ledger_compactor()
+    await rates.stop()
+    await trader_pool.stop()
+    await listener.stop()
+    await dispose_engine()
 
-app = FastAPI()
 
 class MerchantOrder(BaseModel):
     id: str
-    amount: int
+    amount: int = Field(gt=0, le=MAX_ORDER_AMOUNT)
     currency: str
 
-@app.post("/merchant/order")
-async def receive_order(order: MerchantOrder):
-    success = await dispatch_order(order.dict())
-    return {"status": "ok" if success else "no_trader"}
+    @field_validator("currency")
+    @classmethod
+    def _currency(cls, value: str) -> str:
+        # код валюты (RUB, KZT, ...) — в индексе подбора и в БД всегда в верхнем регистре
+        value = value.strip().upper()
+        if not (3 <= len(value) <= 8 and value.isascii() and value.isalpha()):
+            raise ValueError("currency must be a 3-8 letter code")
+        return value
+
+
+async def _admit(request: Request, tokens: int) -> Optional[dict]:
+    # подпись (app.services.merchants) и лимит мерчанта; тело уже прочитано FastAPI и закэшировано
+    merchant = None
+    if MERCHANT_AUTH:
+        merchant = await verify_request(request.headers, request.method, request.url.path, await request.body())
+        if merchant is None:
+            intake_rejected_total.inc("auth")
+            raise HTTPException(status_code=401, detail="invalid merchant signature")
+        key = merchant["id"]
+    else:
+        key = request.client.host if request.client else ""
+    burst = merchant_burst(merchant)
+    if tokens > burst:
+        # такую пачку бакет не пропустит никогда — повтор не поможет, только деление на части
+        intake_rejected_total.inc("batch_over_burst")
+        raise HTTPException(status_code=429, detail=f"batch is larger than the merchant burst ({burst:g} orders)")
+    wait = throttle(key, merchant, tokens)
+    if wait:
+        raise HTTPException(status_code=429, detail="rate limit exceeded", headers={"Retry-After": str(wait)})
+    return merchant
+
+
+async def admit_merchant(request: Request) -> Optional[dict]:
+    return await _admit(request, 1)
+
+
+async def batch_size(request: Request) -> int:
+    # размер пачки до валидации: FastAPI уже разобрал JSON (request.json() кэширован),
+    # но каждую заявку слишком большой пачки проверять не будем
+    try:
+        body = await request.json()
+    except ValueError:
+        return 0  # битый JSON — 422 от валидации тела
+    size = len(body) if isinstance(body, list) else 0
+    if size > BATCH_MAX_SIZE:
+        raise HTTPException(status_code=413, detail=f"batch is limited to {BATCH_MAX_SIZE} orders")
+    return size
+
+
+async def admit_batch(request: Request, size: int = Depends(batch_size)) -> Optional[dict]:
+    # пачка расходует лимит мерчанта по заявке на каждую, а не один запрос
+    return await _admit(request, max(size, 1))
+
+
+async def _admitted(fn, *args):
+    # глобальный лимит одновременных dispatch: сверх него — сразу 503, без очереди
+    if not intake_gate.try_enter():
+        raise HTTPException(status_code=503, detail="overloaded", headers={"Retry-After": str(INTAKE_RETRY_AFTER)})
+    try:
+        return await fn(*args)
+    finally:
+        intake_gate.leave()
+
+
+def _merchant_id(merchant: Optional[dict]) -> Optional[int]:
+    return merchant["id"] if merchant is not None else None
+
+
+@router.post("/merchant/order")
+async def receive_order(order: MerchantOrder, merchant: Optional[dict] = Depends(admit_merchant)):
+    return await _admitted(dispatch_order, {**order.model_dump(), "merchant_id": _merchant_id(merchant)})
+
+
+@router.post("/merchant/orders/batch")
+async def receive_orders_batch(orders: List[MerchantOrder], merchant: Optional[dict] = Depends(admit_batch)):
+    merchant_id = _merchant_id(merchant)
+    results = await _admitted(dispatch_orders_batch, [{**o.model_dump(), "merchant_id": merchant_id} for o in orders])
+    return {"results": results}
+
+
+@router.get("/merchant/order/{merchant_order_id}")
+async def order_status(
+    merchant_order_id: str, wait: float = 0, since: Optional[str] = None,
+    merchant: Optional[dict] = Depends(admit_merchant),
+):
+    # wait > 0 — long-poll: держим запрос, пока статус не станет отличным от since
+    # (по умолчанию — от текущего), но не дольше wait секунд
+    merchant_id = _merchant_id(merchant)
+    if wait > 0:
+        current = await wait_status_change(merchant_order_id, since, min(wait, LONGPOLL_MAX_SECONDS), merchant_id)
+    else:
+        current = await load_order_status(merchant_order_id, merchant_id)
+    if current is None:
+        raise HTTPException(status_code=404, detail="order not found")
+    return current
+
+
+@router.get("/merchant/order/{merchant_order_id}/events")
+async def order_status_events(
+    merchant_order_id: str, request: Request, merchant: Optional[dict] = Depends(admit_merchant)
+):
+    merchant_id = _merchant_id(merchant)
+    if await load_order_status(merchant_order_id, merchant_id) is None:
+        raise HTTPException(status_code=404, detail="order not found")
+
+    async def events():
+        async for current in stream_status(merchant_order_id, SSE_MAX_SECONDS, SSE_HEARTBEAT_SECONDS, merchant_id):
+            if await request.is_disconnected():
+                return
+            if current is None:
+                yield ": ping\n\n"
+            else:
+                yield f"event: status\ndata: {json.dumps(current)}\n\n"
+        yield "event: end\ndata: {}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+def require_admin(request: Request) -> None:
+    token = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+    if not ADMIN_API_TOKEN or not hmac.compare_digest(token, ADMIN_API_TOKEN):
+        raise HTTPException(status_code=403)
+
+
+@router.get("/admin/export/{kind}")
+async def admin_export(
+    kind: str, request: Request, format: str = "csv", date_from: Optional[str] = None, date_to: Optional[str] = None
+):
+    # выгрузка orders/payouts/tickets за период (даты включительно) потоком из серверного курсора
+    require_admin(request)
+    if kind not in EXPORTS:
+        raise HTTPException(status_code=404, detail=f"unknown export {kind!r}")
+    if format not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(FORMATS)}")
+    try:
+        start, end = parse_day(date_from), parse_day(date_to)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="dates must be YYYY-MM-DD")
+
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    filename = export_filename(kind, format, start, end)
+    return StreamingResponse(
+        export_text(kind, format, start, end),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+class NewMerchant(BaseModel):
+    name: str
+    rate_limit: Optional[float] = None
+    burst: Optional[int] = None
+
+
+@router.post("/admin/merchants")
+async def admin_create_merchant(body: NewMerchant, request: Request):
+    # secret отдаётся один раз — при создании
+    require_admin(request)
+    merchant = await create_merchant(body.name, body.rate_limit, body.burst)
+    return {"id": merchant["id"], "name": merchant["name"], "api_key": merchant["api_key"], "secret": merchant["secret"]}
+
+
+@router.delete("/admin/merchants/{api_key}")
+async def admin_deactivate_merchant(api_key: str, request: Request):
+    require_admin(request)
+    if not await deactivate_merchant(api_key):
+        raise HTTPException(status_code=404, detail="merchant not found")
+    return {"ok": True}
+
+
+class BalanceAdjustment(BaseModel):
+    account: str = "deposit_rub"
+    # положительная — пополнение, отрицательная — списание
+    amount: float
+    reason: str = "adjustment"
+    ref_id: Optional[int] = None
+
+
+@router.post("/admin/traders/{trader_id}/balance")
+async def admin_adjust_balance(trader_id: int, body: BalanceAdjustment, request: Request):
+    # балансы меняются только через журнал — иначе сверка (reconcile_balances) покажет расхождение
+    require_admin(request)
+    try:
+        trader = await adjust_balance(trader_id, body.account, body.amount, body.reason, body.ref_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if trader is None:
+        raise HTTPException(status_code=404, detail="trader not found")
+    return {"trader_id": trader.id, body.account: float(getattr(trader, body.account))}
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4")
+
+
+async def telegram_webhook(request: Request):
+    if not webhook.check_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token")):
+        raise HTTPException(status_code=403)
+    if not webhook.update_queue.submit(await request.json()):
+        # очередь полна — Telegram повторит доставку позже
+        return Response(status_code=503, headers={"Retry-After": "1"})
+    return {"ok": True}
+
+
+def create_app() -> FastAPI:
+    app = FastAPI(lifespan=lifespan)
+    app.include_router(router)
+    if webhook.BOT_MODE == "webhook":
+        app.add_api_route(webhook.WEBHOOK_PATH, telegram_webhook, methods=["POST"], include_in_schema=False)
+    return app
+
+
+app = create_app()
@@ -0,0 +1,135 @@
+from bisect import bisect_left
+from typing import Callable, Dict, Sequence, Tuple
+
+# Примитивы метрик для горячих путей: без блокировок (всё в одном event loop),
+# бакеты гистограмм выделяются один раз на набор лейблов.
+
+# все созданные метрики, в порядке создания — для /metrics
+REGISTRY = []
+
+# секунды: от 0.5мс до 10с
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values: Dict[Tuple, float] = {}
+        REGISTRY.append(self)
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, *labels) -> float:
+        return self.values.get(labels, 0)
+
+
+class Gauge:
+    # значение либо выставляется set(), либо читается из fn в момент чтения
+    def __init__(self, name: str, documentation: str, fn: Callable[[], float] = None) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.fn = fn
+        self.value = 0.0
+        REGISTRY.append(self)
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def get(self) -> float:
+        return self.fn() if self.fn is not None else self.value
+
+
+class _HistogramData:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, size: int) -> None:
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.data: Dict[Tuple, _HistogramData] = {}
+        REGISTRY.append(self)
+
+    def observe(self, value: float, *labels) -> None:
+        d = self.data.get(labels)
+        if d is None:
+            # последний слот — +Inf
+            d = self.data[labels] = _HistogramData(len(self.buckets) + 1)
+        d.counts[bisect_left(self.buckets, value)] += 1
+        d.sum += value
+        d.count += 1
+
+    def snapshot(self, *labels) -> dict:
+        d = self.data.get(labels)
+        if d is None:
+            return {"count": 0, "sum": 0.0, "buckets": {}}
+        cumulative = 0
+        buckets = {}
+        for le, n in zip(self.buckets + (float("inf"),), d.counts):
+            cumulative += n
+            buckets[le] = cumulative
+        return {"count": d.count, "sum": d.sum, "buckets": buckets}
+
+
+# -------------------- PROMETHEUS TEXT FORMAT --------------------
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_prometheus() -> str:
+    lines = []
+    for m in REGISTRY:
+        lines.append(f"# HELP {m.name} {m.documentation}")
+        if isinstance(m, Counter):
+            lines.append(f"# TYPE {m.name} counter")
+            for labels, value in list(m.values.items()):
+                lines.append(f"{m.name}{_labels(m.labelnames, labels)} {_number(value)}")
+        elif isinstance(m, Gauge):
+            lines.append(f"# TYPE {m.name} gauge")
+            try:
+                value = m.get()
+            except Exception:
+                continue
+            lines.append(f"{m.name} {_number(value)}")
+        elif isinstance(m, Histogram):
+            lines.append(f"# TYPE {m.name} histogram")
+            for labels in list(m.data):
+                snap = m.snapshot(*labels)
+                for le, n in snap["buckets"].items():
+                    le_label = 'le="%s"' % _number(le)
+                    lines.append(f"{m.name}_bucket{_labels(m.labelnames, labels, le_label)} {n}")
+                lines.append(f"{m.name}_sum{_labels(m.labelnames, labels)} {_number(snap['sum'])}")
+                lines.append(f"{m.name}_count{_labels(m.labelnames, labels)} {snap['count']}")
+    return "\n".join(lines) + "\n"
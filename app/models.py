@@ -1,9 +1,13 @@
-from app.database import Base
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Numeric, Boolean
+import logging
+import os
+
+from app.database import Base, get_engine
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Date, ForeignKey, Numeric, Boolean, Text, Index
+from sqlalchemy import inspect, text
 from sqlalchemy.sql import func
-from sqlalchemy.orm import declarative_base
 
-Base = declarative_base()
+log = logging.getLogger(__name__)
+
 
 class Trader(Base):
     __tablename__ = "traders"
@@ -23,21 +27,44 @@ class Trader(Base):
     reserved_usdt = Column(Numeric(18, 2), default=0)
     referral_usdt = Column(Numeric(18, 2), default=0)
 
+    # валюта заявок, которые трейдер принимает (подбор в app.services.matching)
+    currency = Column(String, nullable=False, default="RUB", server_default="RUB")
+
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
+    __table_args__ = (
+        Index("ix_traders_enabled_id", "requisites_enabled", "id"),
+    )
+
 
 class Order(Base):
     __tablename__ = "orders"
 
     id = Column(Integer, primary_key=True)
-    merchant_order_id = Column(String, unique=True, index=True)
+    merchant_order_id = Column(String)
     amount = Column(Numeric(18, 2))
     currency = Column(String, default="RUB")
 
     status = Column(String, default="new")  # new / in_work / done / cancel
     trader_id = Column(Integer, ForeignKey("traders.id"), nullable=True)
+    # кто прислал заявку; статус видит только он (NULL — приём без подписи, MERCHANT_AUTH=0)
+    merchant_id = Column(Integer, ForeignKey("merchants.id"), nullable=True)
 
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    # до какого момента трейдер должен обработать new-заявку (app.services.deadlines)
+    expires_at = Column(DateTime(timezone=True), nullable=True)
+    reassign_count = Column(Integer, nullable=False, default=0, server_default="0")
+
+    __table_args__ = (
+        Index("ix_orders_trader_status_created", "trader_id", "status", "created_at"),
+        # keyset-пагинация: сделки трейдера и фильтр по статусу в админке
+        Index("ix_orders_trader_id_id", "trader_id", "id"),
+        Index("ix_orders_status_id", "status", "id"),
+        Index("ix_orders_new_expires", "expires_at", postgresql_where=text("status = 'new'")),
+        # идемпотентность в пределах мерчанта: один merchant_order_id у разных мерчантов — разные заявки;
+        # coalesce — чтобы приём без подписи (merchant_id NULL) тоже не принимал повторы
+        Index("uq_orders_merchant_order", merchant_order_id, func.coalesce(merchant_id, 0), unique=True),
+    )
 
 
 class Ticket(Base):
@@ -48,6 +75,10 @@ class Ticket(Base):
     status = Column(String, default="open")  # open/closed
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
+    __table_args__ = (
+        Index("ix_tickets_status_id", "status", "id"),
+    )
+
 
 class Payout(Base):
     __tablename__ = "payouts"
@@ -57,25 +88,269 @@ class Payout(Base):
     currency = Column(String, default="USDT")
     status = Column(String, default="new")  # new/approved/rejected/paid
     created_at = Column(DateTime(timezone=True), server_default=func.now())
-from sqlalchemy import Column, Integer, String, Float, Boolean, ForeignKey, Text
-from sqlalchemy.orm import relationship
-from app.database import Base
+    processed_at = Column(DateTime(timezone=True), nullable=True)  # последняя смена статуса админом
 
+    __table_args__ = (
+        Index("ix_payouts_status_id", "status", "id"),
+    )
 
-class Ticket(Base):
-    __tablename__ = "tickets"
+
+class Notification(Base):
+    # outbox сообщений в Telegram, пишется в одной транзакции с заявкой
+    __tablename__ = "notifications"
 
     id = Column(Integer, primary_key=True)
-    trader_id = Column(Integer, ForeignKey("traders.id"))
-    text = Column(Text)
-    status = Column(String, default="open")
+    chat_id = Column(String, nullable=False)
+    text = Column(Text, nullable=False)
+    reply_markup = Column(Text, nullable=True)  # JSON InlineKeyboardMarkup
 
+    status = Column(String, default="pending")  # pending / sent / failed
+    attempts = Column(Integer, default=0)
+    # когда можно (пере)отправлять; для взятых в работу — конец аренды
+    next_attempt_at = Column(DateTime(timezone=True), server_default=func.now())
+    last_error = Column(String, nullable=True)
 
-class Payout(Base):
-    __tablename__ = "payouts"
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    sent_at = Column(DateTime(timezone=True), nullable=True)
+
+    __table_args__ = (
+        Index("ix_notifications_status_next_attempt", "status", "next_attempt_at"),
+    )
+
+
+class BotState(Base):
+    # состояние диалога бота (STATE_BACKEND=postgres), общее для всех реплик
+    __tablename__ = "bot_states"
+
+    user_id = Column(BigInteger, primary_key=True)
+    mode = Column(String, nullable=False)
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)
+
+
+class BalanceEntry(Base):
+    # журнал движений балансов трейдера (app.services.ledger); суммы не меняются,
+    # applied=true — запись уже отражена в колонках traders (снапшоте)
+    __tablename__ = "balance_entries"
+
+    id = Column(BigInteger, primary_key=True)
+    trader_id = Column(Integer, ForeignKey("traders.id"), nullable=False)
+    account = Column(String, nullable=False)  # deposit_rub / frozen_rur / reserved_usdt / referral_usdt
+    amount = Column(Numeric(18, 2), nullable=False)  # со знаком
+    reason = Column(String, nullable=False)  # opening / order_freeze / order_done / order_cancel / payout / adjustment
+    ref_id = Column(Integer, nullable=True)  # id заявки или выплаты
+    applied = Column(Boolean, nullable=False, default=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        # несвёрнутый хвост журнала: дельта к снапшоту трейдера и очередь свёртки
+        Index("ix_balance_entries_pending", "trader_id", postgresql_where=text("NOT applied")),
+        Index("ix_balance_entries_trader_id", "trader_id", "id"),
+    )
+
+
+class ExchangeRate(Base):
+    # текущий курс по паре (app.services.rates); override_rate — ручной курс админа, действует до сброса
+    __tablename__ = "exchange_rates"
+
+    pair = Column(String, primary_key=True)  # USDT_RUB
+    rate = Column(Numeric(18, 6), nullable=False)
+    source = Column(String, nullable=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    override_rate = Column(Numeric(18, 6), nullable=True)
+    override_by = Column(String, nullable=True)
+
+
+class ExchangeRateHistory(Base):
+    __tablename__ = "exchange_rate_history"
+
+    id = Column(BigInteger, primary_key=True)
+    pair = Column(String, nullable=False)
+    rate = Column(Numeric(18, 6), nullable=False)
+    source = Column(String, nullable=False)  # провайдер / admin:<tg id> / admin_clear:<tg id>
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        Index("ix_exchange_rate_history_pair_id", "pair", "id"),
+    )
+
+
+class Merchant(Base):
+    # ключи приёма заявок (app.services.merchants); secret нужен в открытом виде — им проверяется HMAC
+    __tablename__ = "merchants"
 
     id = Column(Integer, primary_key=True)
-    trader_id = Column(Integer, ForeignKey("traders.id"))
-    amount = Column(Float)
-    currency = Column(String, default="USDT")
-    status = Column(String, default="new")
+    name = Column(String, nullable=False)
+    api_key = Column(String, unique=True, nullable=False)
+    secret = Column(String, nullable=False)
+    # заявок в секунду и запас на всплеск; NULL — значения по умолчанию (MERCHANT_RATE / MERCHANT_BURST)
+    rate_limit = Column(Numeric(10, 2), nullable=True)
+    burst = Column(Integer, nullable=True)
+    active = Column(Boolean, nullable=False, default=True, server_default="true")
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class DeadlineLease(Base):
+    # бакет дедлайнов заявок (order.id % число бакетов) и процесс, который его обслуживает
+    __tablename__ = "deadline_leases"
+
+    bucket = Column(Integer, primary_key=True)
+    owner = Column(String, nullable=True)
+    lease_until = Column(DateTime(timezone=True), nullable=True)
+
+
+class DeadlineWorker(Base):
+    # живые планировщики дедлайнов — для честного деления бакетов
+    __tablename__ = "deadline_workers"
+
+    owner = Column(String, primary_key=True)
+    seen_at = Column(DateTime(timezone=True), nullable=False)
+
+
+# день оборота считаем по дате создания заявки в этой таймзоне
+TURNOVER_TZ = os.getenv("TURNOVER_TZ", "Europe/Moscow")
+
+
+class TraderTurnoverDaily(Base):
+    # оборот трейдера по done-заявкам за день, обновляется инкрементально в close_order
+    __tablename__ = "trader_turnover_daily"
+
+    trader_id = Column(Integer, ForeignKey("traders.id"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    amount = Column(Numeric(18, 2), nullable=False, default=0)
+    orders_count = Column(Integer, nullable=False, default=0)
+
+
+class TraderTurnoverTotal(Base):
+    # оборот за всё время, чтобы не суммировать всю историю дней
+    __tablename__ = "trader_turnover_total"
+
+    trader_id = Column(Integer, ForeignKey("traders.id"), primary_key=True)
+    amount = Column(Numeric(18, 2), nullable=False, default=0)
+    orders_count = Column(Integer, nullable=False, default=0)
+
+
+# create_all не меняет существующие таблицы — новые колонки и заполнения докатываем идемпотентным DDL
+# (ADD COLUMN с константным DEFAULT не переписывает таблицу), индексы — отдельно, см. SCHEMA_INDEXES
+SCHEMA_PATCHES = [
+    "ALTER TABLE notifications ADD COLUMN IF NOT EXISTS reply_markup TEXT",
+    "ALTER TABLE orders ADD COLUMN IF NOT EXISTS expires_at TIMESTAMPTZ",
+    "ALTER TABLE orders ADD COLUMN IF NOT EXISTS reassign_count INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE payouts ADD COLUMN IF NOT EXISTS processed_at TIMESTAMPTZ",
+    "ALTER TABLE traders ADD COLUMN IF NOT EXISTS currency VARCHAR NOT NULL DEFAULT 'RUB'",
+    "ALTER TABLE orders ADD COLUMN IF NOT EXISTS merchant_id INTEGER REFERENCES merchants (id)",
+    # уникальность merchant_order_id — в пределах мерчанта; старый глобальный ключ снимается
+    # в той же транзакции, чтобы не было окна без уникального индекса
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_orders_merchant_order "
+    "ON orders (merchant_order_id, (coalesce(merchant_id, 0)))",
+    "DROP INDEX IF EXISTS ix_orders_merchant_order_id",
+    # начальные записи журнала балансов из текущих колонок traders (только пока журнал пуст)
+    """
+    INSERT INTO balance_entries (trader_id, account, amount, reason, applied)
+    SELECT t.id, a.account, a.amount, 'opening', true
+    FROM traders t
+    CROSS JOIN LATERAL (VALUES
+        ('deposit_rub', t.deposit_rub), ('frozen_rur', t.frozen_rur),
+        ('reserved_usdt', t.reserved_usdt), ('referral_usdt', t.referral_usdt)
+    ) AS a (account, amount)
+    WHERE coalesce(a.amount, 0) <> 0 AND NOT EXISTS (SELECT 1 FROM balance_entries)
+    """,
+    # первичное заполнение роллапов из истории (только пока таблицы пустые)
+    f"""
+    INSERT INTO trader_turnover_daily (trader_id, day, amount, orders_count)
+    SELECT trader_id, (created_at AT TIME ZONE '{TURNOVER_TZ}')::date, SUM(amount), COUNT(*)
+    FROM orders
+    WHERE status = 'done' AND trader_id IS NOT NULL
+      AND NOT EXISTS (SELECT 1 FROM trader_turnover_daily)
+    GROUP BY 1, 2
+    ON CONFLICT DO NOTHING
+    """,
+    """
+    INSERT INTO trader_turnover_total (trader_id, amount, orders_count)
+    SELECT trader_id, SUM(amount), SUM(orders_count)
+    FROM trader_turnover_daily
+    WHERE NOT EXISTS (SELECT 1 FROM trader_turnover_total)
+    GROUP BY 1
+    ON CONFLICT DO NOTHING
+    """,
+]
+
+
+# индексы на существующих таблицах: CREATE INDEX CONCURRENTLY вне транзакции, запись в таблицу не блокируется
+SCHEMA_INDEXES = [
+    ("ix_orders_trader_status_created", "ON orders (trader_id, status, created_at)"),
+    ("ix_orders_trader_id_id", "ON orders (trader_id, id)"),
+    ("ix_orders_status_id", "ON orders (status, id)"),
+    ("ix_traders_enabled_id", "ON traders (requisites_enabled, id)"),
+    ("ix_tickets_status_id", "ON tickets (status, id)"),
+    ("ix_payouts_status_id", "ON payouts (status, id)"),
+    ("ix_orders_new_expires", "ON orders (expires_at) WHERE status = 'new'"),
+]
+
+# при DB_SCHEMA_STRICT=1 расхождение схемы с моделями — ошибка старта, иначе предупреждение
+SCHEMA_STRICT = os.getenv("DB_SCHEMA_STRICT", "0") == "1"
+# DB_MIGRATE=0 — run.py / supervisor не мигрируют схему перед стартом (миграция делается отдельно)
+DB_MIGRATE = os.getenv("DB_MIGRATE", "1") == "1"
+# миграцию в каждый момент выполняет один процесс
+MIGRATE_LOCK_ID = 7340001
+
+
+def _missing_columns(sync_conn) -> list:
+    insp = inspect(sync_conn)
+    missing = []
+    for table in Base.metadata.sorted_tables:
+        if not insp.has_table(table.name):
+            missing.append(table.name)
+            continue
+        existing = {c["name"] for c in insp.get_columns(table.name)}
+        missing.extend(f"{table.name}.{c.name}" for c in table.columns if c.name not in existing)
+    return missing
+
+
+async def migrate():
+    # Одноразовый шаг до запуска воркеров (run.py, supervisor.py), не в lifespan каждого процесса.
+    # Таблицы, колонки и заполнения — одной транзакцией, индексы — CONCURRENTLY.
+    engine = get_engine()
+    async with engine.begin() as conn:
+        await conn.execute(text(f"SELECT pg_advisory_xact_lock({MIGRATE_LOCK_ID})"))
+        await conn.run_sync(Base.metadata.create_all)
+        for ddl in SCHEMA_PATCHES:
+            await conn.execute(text(ddl))
+
+    async with engine.connect() as conn:
+        await conn.execution_options(isolation_level="AUTOCOMMIT")
+        # try: ждущий на локе запрос держал бы снимок, а CONCURRENTLY ждёт все старые снимки
+        if not (await conn.execute(text(f"SELECT pg_try_advisory_lock({MIGRATE_LOCK_ID})"))).scalar():
+            log.info("indexes are being built by another process, skipping")
+            return
+        try:
+            for name, definition in SCHEMA_INDEXES:
+                # прерванная сборка CONCURRENTLY оставляет невалидный индекс — IF NOT EXISTS его не заменит
+                invalid = (await conn.execute(
+                    text(
+                        "SELECT NOT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                        "WHERE c.relname = :name AND pg_table_is_visible(c.oid)"
+                    ),
+                    {"name": name},
+                )).scalar()
+                if invalid:
+                    await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+                await conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} {definition}"))
+        finally:
+            await conn.execute(text(f"SELECT pg_advisory_unlock({MIGRATE_LOCK_ID})"))
+
+
+async def check_schema():
+    # воркеры схему не меняют — только сверяют колонки с моделями
+    async with get_engine().connect() as conn:
+        missing = await conn.run_sync(_missing_columns)
+
+    if missing:
+        if SCHEMA_STRICT:
+            raise RuntimeError(f"DB schema is missing columns: {', '.join(missing)}")
+        log.warning("DB schema is missing columns: %s", ", ".join(missing))
+
+
+async def init_models():
+    # миграция + сверка: для одноразового старта (run.py, supervisor.py), тестов и бенчмарка
+    await migrate()
+    await check_schema()
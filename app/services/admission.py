@@ -0,0 +1,62 @@
+import math
+import os
+from typing import Optional
+
+from app.database import POOL_MAX_OVERFLOW, POOL_SIZE
+from app.metrics import Counter, Gauge
+from app.services.ratelimit import BucketMap
+
+# Допуск заявок на приём. Перегрузку отклоняем сразу (429/503 + Retry-After), а не ставим в очередь:
+# ожидающий запрос всё равно занял бы соединение из пула и задержал остальных мерчантов.
+
+# лимит мерчанта по умолчанию: запросов в секунду и запас на всплеск (свои — merchants.rate_limit/burst)
+MERCHANT_RATE = float(os.getenv("MERCHANT_RATE", "50"))
+MERCHANT_BURST = float(os.getenv("MERCHANT_BURST", "100"))
+# одновременно обрабатываемых запросов приёма на процесс; по умолчанию — вдвое больше пула БД
+INTAKE_MAX_INFLIGHT = int(os.getenv("INTAKE_MAX_INFLIGHT", str(2 * (POOL_SIZE + POOL_MAX_OVERFLOW))))
+INTAKE_RETRY_AFTER = int(os.getenv("INTAKE_RETRY_AFTER", "1"))
+
+intake_rejected_total = Counter("intake_rejected_total", "Order intake requests rejected by admission control", ("reason",))
+
+merchant_buckets = BucketMap(MERCHANT_RATE, MERCHANT_BURST)
+
+
+def merchant_burst(merchant: Optional[dict] = None) -> float:
+    # запас бакета мерчанта: больше заявок за раз не пропустить никогда
+    return (merchant["burst"] if merchant is not None else None) or merchant_buckets.capacity
+
+
+def throttle(key, merchant: Optional[dict] = None, tokens: int = 1) -> int:
+    # tokens — число заявок в запросе (пачка списывает по токену на заявку).
+    # 0 — пропускаем, иначе через сколько секунд (целых, для Retry-After) повторить
+    rate = burst = None
+    if merchant is not None:
+        rate, burst = merchant["rate_limit"], merchant["burst"]
+    wait = merchant_buckets.get(key, rate, burst).try_acquire(tokens)
+    if not wait:
+        return 0
+    intake_rejected_total.inc("rate_limit")
+    return max(1, math.ceil(wait))
+
+
+class InflightGate:
+    # счётчик без ожидания: всё в одном event loop, блокировки не нужны
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.inflight = 0
+
+    def try_enter(self) -> bool:
+        if self.inflight >= self.limit:
+            intake_rejected_total.inc("overload")
+            return False
+        self.inflight += 1
+        return True
+
+    def leave(self) -> None:
+        self.inflight -= 1
+
+
+intake_gate = InflightGate(INTAKE_MAX_INFLIGHT)
+
+Gauge("intake_inflight", "Order intake requests currently being dispatched", fn=lambda: intake_gate.inflight)
@@ -0,0 +1,348 @@
+import asyncio
+import heapq
+import logging
+import math
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import Integer, column, delete, func, select, update, values
+from sqlalchemy.dialects.postgresql import insert
+
+from app.database import AsyncSessionLocal
+from app.metrics import Counter, Gauge
+from app.models import DeadlineLease, DeadlineWorker, Order, Trader
+from app.services.events import ORDER_DEADLINES_CHANNEL, ORDER_STATUS_CHANNEL, listener, notify, notify_many
+from app.services.idempotency import recent_orders
+from app.services.ledger import entry, record
+from app.services.outbox import enqueue_notifications
+from app.services.trader import freeze_batch, lock_traders_for_batch, order_notification_kb, order_notification_text
+
+log = logging.getLogger(__name__)
+
+# сколько трейдер может держать new-заявку, потом она переназначается или отменяется
+ORDER_TTL = float(os.getenv("ORDER_TTL_SECONDS", "900"))
+ORDER_EXPIRE_ACTION = os.getenv("ORDER_EXPIRE_ACTION", "reassign")  # reassign | cancel
+# после стольких переназначений заявка отменяется
+ORDER_MAX_REASSIGN = int(os.getenv("ORDER_MAX_REASSIGN", "2"))
+
+# Дедлайны делятся на бакеты по order.id % DEADLINE_BUCKETS; каждый бакет арендует один процесс
+# и держит его заявки в своей куче. Аренда продлевается раз в треть DEADLINE_LEASE_SECONDS.
+DEADLINE_BUCKETS = int(os.getenv("DEADLINE_BUCKETS", "64"))
+DEADLINE_LEASE_SECONDS = float(os.getenv("DEADLINE_LEASE_SECONDS", "30"))
+DEADLINE_BATCH = int(os.getenv("DEADLINE_BATCH", "500"))
+# id в одном NOTIFY (payload ограничен 8000 байт)
+ANNOUNCE_CHUNK = 500
+
+order_deadlines_total = Counter("order_deadlines_total", "Expired orders by action", ("action",))
+
+
+def order_deadline() -> datetime:
+    return datetime.now(timezone.utc) + timedelta(seconds=ORDER_TTL)
+
+
+async def announce_deadlines(session, order_ids, expires_at: datetime) -> None:
+    # в транзакции вызывающего: планировщики узнают о новых дедлайнах после commit
+    ts = expires_at.timestamp()
+    for i in range(0, len(order_ids), ANNOUNCE_CHUNK):
+        await notify(session, ORDER_DEADLINES_CHANNEL, {"expires_at": ts, "ids": order_ids[i:i + ANNOUNCE_CHUNK]})
+
+
+async def expire_orders(order_ids) -> list:
+    # Просроченные new-заявки пачкой: переназначить другому трейдеру (пока не исчерпан лимит
+    # и есть свободный остаток) или отменить. Истина — в БД: заявки, которые уже закрыты,
+    # пропускаются, а ещё не просроченные (дедлайн сдвинулся) возвращаются вызывающему.
+    async with AsyncSessionLocal() as session:
+        rows = (await session.execute(
+            select(
+                Order.id, Order.merchant_id, Order.merchant_order_id, Order.trader_id, Order.amount, Order.currency,
+                Order.reassign_count, Order.expires_at, (Order.expires_at <= func.now()).label("due"),
+            )
+            .where(Order.id.in_(order_ids), Order.status == "new", Order.expires_at.is_not(None))
+            .order_by(Order.id)
+            .with_for_update(of=Order)
+        )).all()
+        not_due = [(row.id, row.expires_at.timestamp()) for row in rows if not row.due]
+        due = [row for row in rows if row.due]
+        if not due:
+            await session.rollback()
+            return not_due
+
+        candidates = []
+        if ORDER_EXPIRE_ACTION == "reassign":
+            candidates = [row for row in due if row.reassign_count < ORDER_MAX_REASSIGN]
+        assigned = []
+        if candidates:
+            assigned = await lock_traders_for_batch(
+                session,
+                [row.amount for row in candidates],
+                [row.currency for row in candidates],
+                exclude=[row.trader_id for row in candidates],
+            )
+        reassigned = [(row, trader) for row, trader in zip(candidates, assigned) if trader is not None]
+        moved = {row.id for row, _ in reassigned}
+        cancelled = [row for row in due if row.id not in moved]
+
+        entries = []
+        messages = []
+        if reassigned:
+            deadline = order_deadline()
+            v = values(column("id", Integer), column("trader_id", Integer), name="v").data(
+                [(row.id, trader.id) for row, trader in reassigned]
+            )
+            await session.execute(
+                update(Order)
+                .where(Order.id == v.c.id)
+                .values(trader_id=v.c.trader_id, expires_at=deadline, reassign_count=Order.reassign_count + 1)
+                .execution_options(synchronize_session=False)
+            )
+            await freeze_batch(session, [(trader.id, row.amount) for row, trader in reassigned])
+            for row, trader in reassigned:
+                entries.append(entry(trader.id, "frozen_rur", row.amount, "order_freeze", row.id, applied=True))
+                entries.append(entry(row.trader_id, "frozen_rur", -row.amount, "order_reassign", row.id))
+                order = {"id": row.merchant_order_id, "amount": row.amount, "currency": row.currency}
+                messages.append((trader.tg_id, order_notification_text(order), order_notification_kb(row.id)))
+            await announce_deadlines(session, [row.id for row, _ in reassigned], deadline)
+            # кэш повторов (app.services.idempotency) во всех процессах должен узнать нового трейдера
+            await notify_many(session, ORDER_STATUS_CHANNEL, [
+                {
+                    "merchant_id": row.merchant_id, "merchant_order_id": row.merchant_order_id,
+                    "order_id": row.id, "status": "new", "trader_id": trader.id,
+                }
+                for row, trader in reassigned
+            ])
+
+        if cancelled:
+            await session.execute(
+                update(Order)
+                .where(Order.id.in_([row.id for row in cancelled]))
+                .values(status="cancel")
+                .execution_options(synchronize_session=False)
+            )
+            entries.extend(
+                entry(row.trader_id, "frozen_rur", -row.amount, "order_expire", row.id)
+                for row in cancelled if row.trader_id is not None
+            )
+            await notify_many(session, ORDER_STATUS_CHANNEL, [
+                {
+                    "merchant_id": row.merchant_id, "merchant_order_id": row.merchant_order_id,
+                    "order_id": row.id, "status": "cancel",
+                }
+                for row in cancelled
+            ])
+
+        # прежним трейдерам — что заявка у них больше не висит
+        tg_ids = await _tg_ids(session, {row.trader_id for row in due if row.trader_id is not None})
+        for row in due:
+            if row.trader_id in tg_ids:
+                outcome = "передана другому трейдеру" if row.id in moved else "отменена"
+                text = f"⌛ Заявка {row.merchant_order_id} не обработана вовремя и {outcome}"
+                messages.append((tg_ids[row.trader_id], text, None))
+
+        await record(session, entries)
+        await enqueue_notifications(session, messages)
+        await session.commit()
+
+    for row, trader in reassigned:
+        recent_orders.update_status(row.merchant_id, row.merchant_order_id, "new", trader.id)
+    for row in cancelled:
+        recent_orders.update_status(row.merchant_id, row.merchant_order_id, "cancel")
+    order_deadlines_total.inc("reassign", amount=len(reassigned))
+    order_deadlines_total.inc("cancel", amount=len(cancelled))
+    return not_due
+
+
+async def _tg_ids(session, trader_ids) -> dict:
+    if not trader_ids:
+        return {}
+    r = await session.execute(select(Trader.id, Trader.tg_id).where(Trader.id.in_(trader_ids)))
+    return {row.id: row.tg_id for row in r}
+
+
+class DeadlineScheduler:
+    # Одна куча (expires_at, order_id) на процесс и одна задача, которая спит до ближайшего дедлайна.
+    # Записи в куче — подсказки: закрытые заявки отсеивает expire_orders, поэтому удалять их не нужно.
+
+    def __init__(self) -> None:
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._heap = []
+        self._buckets = set()
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+
+    def push(self, order_id: int, ts: float) -> None:
+        if order_id % DEADLINE_BUCKETS not in self._buckets:
+            return
+        heapq.heappush(self._heap, (ts, order_id))
+        if self._heap[0][1] == order_id:
+            self._wakeup.set()
+
+    def _on_event(self, data: dict) -> None:
+        for order_id in data["ids"]:
+            self.push(order_id, data["expires_at"])
+
+    def size(self) -> int:
+        return len(self._heap)
+
+    def buckets(self) -> int:
+        return len(self._buckets)
+
+    async def _load(self, buckets) -> None:
+        async with AsyncSessionLocal() as session:
+            r = await session.execute(
+                select(Order.id, Order.expires_at)
+                .where(
+                    Order.status == "new",
+                    Order.expires_at.is_not(None),
+                    (Order.id % DEADLINE_BUCKETS).in_(sorted(buckets)),
+                )
+            )
+            rows = r.all()
+        self._heap.extend((row.expires_at.timestamp(), row.id) for row in rows)
+        heapq.heapify(self._heap)
+        self._wakeup.set()
+
+    async def reload(self) -> None:
+        # после переподключения LISTEN события могли потеряться — перечитываем свои бакеты
+        if self._buckets:
+            self._heap = []
+            await self._load(self._buckets)
+
+    async def _renew(self) -> None:
+        lease = timedelta(seconds=DEADLINE_LEASE_SECONDS)
+        async with AsyncSessionLocal() as session:
+            stmt = insert(DeadlineWorker).values(owner=self.owner, seen_at=func.now())
+            await session.execute(stmt.on_conflict_do_update(
+                index_elements=[DeadlineWorker.owner], set_={"seen_at": stmt.excluded.seen_at}
+            ))
+            await session.execute(delete(DeadlineWorker).where(DeadlineWorker.seen_at < func.now() - 3 * lease))
+            live = (await session.execute(
+                select(func.count()).select_from(DeadlineWorker).where(DeadlineWorker.seen_at > func.now() - lease)
+            )).scalar()
+            target = math.ceil(DEADLINE_BUCKETS / max(live, 1))
+
+            mine = set((await session.execute(
+                update(DeadlineLease)
+                .where(DeadlineLease.owner == self.owner, DeadlineLease.bucket < DEADLINE_BUCKETS)
+                .values(lease_until=func.now() + lease)
+                .returning(DeadlineLease.bucket)
+            )).scalars())
+            if len(mine) > target:
+                # пришёл новый процесс — отдаём лишнее, он заберёт на своём продлении
+                extra = sorted(mine)[target:]
+                await session.execute(
+                    update(DeadlineLease)
+                    .where(DeadlineLease.owner == self.owner, DeadlineLease.bucket.in_(extra))
+                    .values(owner=None, lease_until=None)
+                )
+                mine -= set(extra)
+            elif len(mine) < target:
+                free = (
+                    select(DeadlineLease.bucket)
+                    .where(
+                        DeadlineLease.bucket < DEADLINE_BUCKETS,
+                        (DeadlineLease.owner.is_(None)) | (DeadlineLease.lease_until < func.now()),
+                    )
+                    .order_by(DeadlineLease.bucket)
+                    .limit(target - len(mine))
+                    .with_for_update(skip_locked=True)
+                )
+                mine |= set((await session.execute(
+                    update(DeadlineLease)
+                    .where(DeadlineLease.bucket.in_(free))
+                    .values(owner=self.owner, lease_until=func.now() + lease)
+                    .returning(DeadlineLease.bucket)
+                )).scalars())
+            await session.commit()
+
+        acquired = mine - self._buckets
+        # потерянные бакеты просто перестают обслуживаться: их записи отсеются при срабатывании
+        self._buckets = mine
+        if acquired:
+            await self._load(acquired)
+
+    async def _lease_loop(self) -> None:
+        while True:
+            try:
+                await self._renew()
+            except Exception:
+                log.exception("deadline lease renewal failed")
+            await asyncio.sleep(DEADLINE_LEASE_SECONDS / 3)
+
+    async def _fire_loop(self) -> None:
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            now = time.time()
+            due = {}
+            while self._heap and self._heap[0][0] <= now and len(due) < DEADLINE_BATCH:
+                ts, order_id = heapq.heappop(self._heap)
+                if order_id % DEADLINE_BUCKETS in self._buckets:
+                    due[order_id] = ts
+            if not due:
+                continue
+            try:
+                for order_id, ts in await expire_orders(list(due)):
+                    self.push(order_id, ts)
+            except Exception:
+                log.exception("order expiry failed, retrying later")
+                for order_id in due:
+                    self.push(order_id, now + 5)
+
+    async def start(self) -> None:
+        if self._tasks:
+            return
+        async with AsyncSessionLocal() as session:
+            await session.execute(
+                insert(DeadlineLease)
+                .from_select(["bucket"], select(func.generate_series(0, DEADLINE_BUCKETS - 1)))
+                .on_conflict_do_nothing(index_elements=[DeadlineLease.bucket])
+            )
+            # new-заявки до появления дедлайнов получают срок от даты создания
+            await session.execute(
+                update(Order)
+                .where(Order.status == "new", Order.expires_at.is_(None))
+                .values(expires_at=Order.created_at + timedelta(seconds=ORDER_TTL))
+                .execution_options(synchronize_session=False)
+            )
+            await session.commit()
+        await listener.subscribe(ORDER_DEADLINES_CHANNEL, self._on_event)
+        await listener.on_connect(self.reload)
+        await listener.start()
+        await self._renew()
+        self._tasks = [asyncio.create_task(self._lease_loop()), asyncio.create_task(self._fire_loop())]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if not self._buckets:
+            return
+        # отдаём бакеты сразу, не дожидаясь истечения аренды
+        async with AsyncSessionLocal() as session:
+            await session.execute(
+                update(DeadlineLease).where(DeadlineLease.owner == self.owner).values(owner=None, lease_until=None)
+            )
+            await session.execute(delete(DeadlineWorker).where(DeadlineWorker.owner == self.owner))
+            await session.commit()
+        self._buckets = set()
+
+
+deadline_scheduler = DeadlineScheduler()
+
+Gauge("order_deadlines_tracked", "Order deadlines in this process's heap", fn=deadline_scheduler.size)
+Gauge("order_deadline_buckets_owned", "Deadline buckets leased by this process", fn=deadline_scheduler.buckets)
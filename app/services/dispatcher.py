@@ -1,23 +1,237 @@
-from app.services.trader import get_free_trader, send_order
+from time import perf_counter
+
+from sqlalchemy import func, literal_column, select, tuple_
+from sqlalchemy.dialects.postgresql import insert
+
+from app.services.trader import (
+    freeze_batch,
+    lock_traders_for_batch,
+    order_notification_kb,
+    order_notification_text,
+    reserve_trader,
+)
+from app.services.outbox import enqueue_notification, enqueue_notifications
+from app.services.idempotency import recent_orders, duplicate_result
+from app.services.deadlines import announce_deadlines, order_deadline
+from app.services.ledger import entry, record
 from app.database import AsyncSessionLocal
 from app.models import Order
-from sqlalchemy.ext.asyncio import AsyncSession
+from app.metrics import Counter, Histogram
+
+# asyncpg ограничивает число параметров в запросе (32767), поэтому большие пачки режем
+INSERT_CHUNK = 1000
+
+orders_total = Counter("merchant_orders_total", "Merchant orders by endpoint and outcome", ("endpoint", "outcome"))
+dispatch_seconds = Histogram("dispatch_order_seconds", "dispatch_order latency by endpoint", ("endpoint",))
+dispatch_phase_seconds = Histogram(
+    "dispatch_order_phase_seconds",
+    "dispatch_order latency by phase (reserve, insert, notify, freeze, commit)",
+    ("endpoint", "phase"),
+)
+
+# ключ идемпотентности: merchant_order_id уникален только в пределах мерчанта (uq_orders_merchant_order)
+# (0 — литералом: с параметром Postgres не сопоставит ON CONFLICT с выражением индекса)
+ORDER_KEY = [Order.merchant_order_id, func.coalesce(Order.merchant_id, literal_column("0"))]
+
+def _order_key(order_data):
+    return order_data.get("merchant_id"), order_data["id"]
+
+async def _load_existing(session, keys):
+    # keys — пары (merchant_id, merchant_order_id)
+    r = await session.execute(
+        select(Order.id, Order.merchant_id, Order.merchant_order_id, Order.status, Order.trader_id)
+        .where(tuple_(*ORDER_KEY).in_([
+            (merchant_order_id, merchant_id or 0) for merchant_id, merchant_order_id in keys
+        ]))
+    )
+    found = {}
+    for row in r.all():
+        recent_orders.remember(row.merchant_id, row.merchant_order_id, row.id, row.status, row.trader_id)
+        found[(row.merchant_id, row.merchant_order_id)] = recent_orders.get(row.merchant_id, row.merchant_order_id)
+    return found
 
 async def dispatch_order(order_data):
-    trader = await get_free_trader()
-    if not trader:
-        return False
+    start = perf_counter()
+    try:
+        result = await _dispatch_order(order_data)
+    except Exception:
+        orders_total.inc("single", "error")
+        raise
+    finally:
+        dispatch_seconds.observe(perf_counter() - start, "single")
+    orders_total.inc("single", result["status"])
+    return result
+
+async def _dispatch_order(order_data):
+    merchant_order_id = order_data["id"]
+    key = _order_key(order_data)
+
+    # повтор от мерчанта (например, после таймаута) — отвечаем тем же, без БД и без нового уведомления
+    seen = recent_orders.get(*key)
+    if seen:
+        return duplicate_result(merchant_order_id, seen)
 
-    # сохраняем заявку в БД
+    # резерв трейдера, заявка и уведомление — одной транзакцией,
+    # отправка в Telegram уже после ответа мерчанту
     async with AsyncSessionLocal() as session:
-        new_order = Order(
-            merchant_order_id=order_data["id"],
-            amount=order_data["amount"],
-            currency=order_data["currency"],
-            trader_id=trader.id
+        t0 = perf_counter()
+        trader = await reserve_trader(session, order_data["amount"], order_data["currency"])
+        t1 = perf_counter()
+        dispatch_phase_seconds.observe(t1 - t0, "single", "reserve")
+        if not trader:
+            await session.rollback()
+            return {"id": merchant_order_id, "status": "no_trader"}
+
+        deadline = order_deadline()
+        r = await session.execute(
+            insert(Order)
+            .values(
+                merchant_order_id=merchant_order_id,
+                amount=order_data["amount"],
+                currency=order_data["currency"],
+                trader_id=trader.id,
+                merchant_id=order_data.get("merchant_id"),
+                expires_at=deadline,
+            )
+            .on_conflict_do_nothing(index_elements=ORDER_KEY)
+            .returning(Order.id)
         )
-        session.add(new_order)
+        order_id = r.scalar()
+        t2 = perf_counter()
+        dispatch_phase_seconds.observe(t2 - t1, "single", "insert")
+        if order_id is None:
+            # rollback снимает и заморозку суммы
+            existing = await _load_existing(session, [key])
+            await session.rollback()
+            return duplicate_result(merchant_order_id, existing[key])
+
+        # заморозка уже в снапшоте (UPDATE в reserve_trader), в журнал — для сверки
+        await record(session, [entry(trader.id, "frozen_rur", order_data["amount"], "order_freeze", order_id, applied=True)])
+        await announce_deadlines(session, [order_id], deadline)
+        await enqueue_notification(
+            session,
+            trader.tg_id,
+            order_notification_text(order_data),
+            order_notification_kb(order_id),
+        )
+        t3 = perf_counter()
+        dispatch_phase_seconds.observe(t3 - t2, "single", "notify")
         await session.commit()
+        dispatch_phase_seconds.observe(perf_counter() - t3, "single", "commit")
+
+    recent_orders.remember(*key, order_id, "new", trader.id)
+    return {"id": merchant_order_id, "status": "ok", "order_id": order_id, "trader_id": trader.id}
+
+async def dispatch_orders_batch(orders):
+    start = perf_counter()
+    try:
+        results = await _dispatch_orders_batch(orders)
+    except Exception:
+        orders_total.inc("batch", "error", amount=len(orders))
+        raise
+    finally:
+        dispatch_seconds.observe(perf_counter() - start, "batch")
+    for item in results:
+        orders_total.inc("batch", item["status"])
+    return results
+
+async def _dispatch_orders_batch(orders):
+    results = {}
+    pending = []
+    for order_data in orders:
+        key = _order_key(order_data)
+        if key in results:
+            continue  # повтор внутри пачки — ответ как у первого вхождения
+        seen = recent_orders.get(*key)
+        if seen:
+            results[key] = duplicate_result(order_data["id"], seen)
+            continue
+        results[key] = None
+        pending.append(order_data)
+
+    if pending:
+        # трейдеры на всю пачку за один проход, вставка и заморозка одной транзакцией
+        async with AsyncSessionLocal() as session:
+            t0 = perf_counter()
+            traders = await lock_traders_for_batch(
+                session, [o["amount"] for o in pending], [o["currency"] for o in pending]
+            )
+            t1 = perf_counter()
+            dispatch_phase_seconds.observe(t1 - t0, "batch", "reserve")
+            rows = []
+            by_key = {}
+            deadline = order_deadline()
+            for order_data, trader in zip(pending, traders):
+                if trader is None:
+                    results[_order_key(order_data)] = {"id": order_data["id"], "status": "no_trader"}
+                    continue
+                rows.append({
+                    "merchant_order_id": order_data["id"],
+                    "amount": order_data["amount"],
+                    "currency": order_data["currency"],
+                    "trader_id": trader.id,
+                    "merchant_id": order_data.get("merchant_id"),
+                    "expires_at": deadline,
+                })
+                by_key[_order_key(order_data)] = (order_data, trader)
+
+            inserted = {}
+            notify_time = 0.0
+            for i in range(0, len(rows), INSERT_CHUNK):
+                r = await session.execute(
+                    insert(Order)
+                    .values(rows[i:i + INSERT_CHUNK])
+                    .on_conflict_do_nothing(index_elements=ORDER_KEY)
+                    .returning(Order.id, Order.merchant_id, Order.merchant_order_id)
+                )
+                chunk_ids = {(row.merchant_id, row.merchant_order_id): row.id for row in r.all()}
+                inserted.update(chunk_ids)
+                tn = perf_counter()
+                notifications = []
+                for key, order_id in chunk_ids.items():
+                    order_data, trader = by_key[key]
+                    notifications.append((
+                        trader.tg_id,
+                        order_notification_text(order_data),
+                        order_notification_kb(order_id),
+                    ))
+                await enqueue_notifications(session, notifications)
+                notify_time += perf_counter() - tn
+
+            t2 = perf_counter()
+            dispatch_phase_seconds.observe(t2 - t1 - notify_time, "batch", "insert")
+            dispatch_phase_seconds.observe(notify_time, "batch", "notify")
+
+            # морозим только то, что реально вставилось
+            await freeze_batch(session, [
+                (by_key[key][1].id, by_key[key][0]["amount"])
+                for key in inserted
+            ])
+            await record(session, [
+                entry(by_key[key][1].id, "frozen_rur", by_key[key][0]["amount"],
+                      "order_freeze", order_id, applied=True)
+                for key, order_id in inserted.items()
+            ])
+            await announce_deadlines(session, list(inserted.values()), deadline)
+
+            conflicts = [key for key in by_key if key not in inserted]
+            existing = await _load_existing(session, conflicts) if conflicts else {}
+            t3 = perf_counter()
+            dispatch_phase_seconds.observe(t3 - t2, "batch", "freeze")
+            await session.commit()
+            dispatch_phase_seconds.observe(perf_counter() - t3, "batch", "commit")
+
+        for key, (order_data, trader) in by_key.items():
+            merchant_order_id = order_data["id"]
+            if key in inserted:
+                recent_orders.remember(*key, inserted[key], "new", trader.id)
+                results[key] = {
+                    "id": merchant_order_id,
+                    "status": "ok",
+                    "order_id": inserted[key],
+                    "trader_id": trader.id,
+                }
+            else:
+                results[key] = duplicate_result(merchant_order_id, existing[key])
 
-    await send_order(trader.tg_id, order_data)
-    return True
+    return [results[_order_key(order_data)] for order_data in orders]
@@ -0,0 +1,132 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import uuid
+from typing import Awaitable, Callable, Dict, List
+
+import asyncpg
+from sqlalchemy import text
+
+from app.database import asyncpg_dsn
+
+log = logging.getLogger(__name__)
+
+# Каналы межпроцессных событий
+TRADERS_CHANNEL = "traders_changed"
+CAPACITY_CHANNEL = "trader_capacity"
+OUTBOX_CHANNEL = "outbox"
+ORDER_STATUS_CHANNEL = "order_status"
+RATES_CHANNEL = "exchange_rates"
+ORDER_DEADLINES_CHANNEL = "order_deadlines"
+
+# метка процесса в событиях: свои уведомления подписчик узнаёт и не обрабатывает повторно
+PROCESS_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+async def notify(session, channel: str, payload: dict) -> None:
+    # NOTIFY внутри транзакции доставляется только после commit (и пропадает при rollback)
+    await session.execute(
+        text("SELECT pg_notify(:channel, :payload)"),
+        {"channel": channel, "payload": json.dumps(payload)},
+    )
+
+
+async def notify_many(session, channel: str, payloads) -> None:
+    # пачка событий одним запросом (например, смена статуса сотен заявок)
+    if not payloads:
+        return
+    await session.execute(
+        text("SELECT pg_notify(:channel, p) FROM unnest(CAST(:payloads AS text[])) AS p"),
+        {"channel": channel, "payloads": [json.dumps(payload) for payload in payloads]},
+    )
+
+
+class PgListener:
+    # Одно соединение asyncpg на процесс, слушает все каналы и раздаёт события подписчикам.
+    # После каждого (пере)подключения вызываются on_connect-колбэки, чтобы
+    # подписчики перечитали состояние и не потеряли события, пришедшие во время разрыва.
+
+    def __init__(self) -> None:
+        self._handlers: Dict[str, List[Callable]] = {}
+        self._on_connect: List[Callable[[], Awaitable]] = []
+        self._conn = None
+        self._task = None
+        # LISTEN на живом соединении и его (пере)подключение не должны пересекаться
+        self._lock = asyncio.Lock()
+
+    async def subscribe(self, channel: str, handler: Callable) -> None:
+        async with self._lock:
+            first = channel not in self._handlers
+            self._handlers.setdefault(channel, []).append(handler)
+            if first and self._conn is not None:
+                try:
+                    await self._conn.add_listener(channel, self._dispatch)
+                except Exception:
+                    # соединение рвётся — канал подпишет переподключение
+                    log.exception("LISTEN %s failed", channel)
+
+    async def on_connect(self, callback: Callable[[], Awaitable]) -> None:
+        async with self._lock:
+            self._on_connect.append(callback)
+            connected = self._conn is not None
+        if connected:
+            # подключение уже было — иначе колбэк дождался бы только следующего
+            await callback()
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(asyncpg_dsn())
+                closed = asyncio.Event()
+                conn.add_termination_listener(lambda c: closed.set())
+                async with self._lock:
+                    for channel in self._handlers:
+                        await conn.add_listener(channel, self._dispatch)
+                    self._conn = conn
+                    callbacks = list(self._on_connect)
+                for callback in callbacks:
+                    await callback()
+                await closed.wait()
+                log.warning("LISTEN connection lost, reconnecting")
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("LISTEN connection failed")
+            finally:
+                self._conn = None
+                if conn is not None and not conn.is_closed():
+                    await conn.close()
+            await asyncio.sleep(1)
+
+    def _dispatch(self, conn, pid, channel, payload) -> None:
+        try:
+            data = json.loads(payload) if payload else {}
+        except ValueError:
+            log.warning("bad payload on %s: %r", channel, payload)
+            return
+        for handler in self._handlers.get(channel, ()):
+            try:
+                res = handler(data)
+                if asyncio.iscoroutine(res):
+                    asyncio.create_task(res)
+            except Exception:
+                log.exception("handler for %s failed", channel)
+
+
+listener = PgListener()
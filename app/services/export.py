@@ -0,0 +1,96 @@
+import csv
+import io
+import json
+import os
+from datetime import date, datetime, time, timedelta
+from typing import AsyncIterator, Optional
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import select
+
+from app.database import AsyncSessionLocal
+from app.models import TURNOVER_TZ, Order, Payout, Ticket
+
+# строк на одну выборку из серверного курсора; память экспорта от объёма не зависит
+EXPORT_CHUNK = int(os.getenv("EXPORT_CHUNK", "5000"))
+FORMATS = ("csv", "jsonl")
+
+# что выгружаем по каждой таблице (порядок колонок = порядок в файле)
+EXPORTS = {
+    "orders": (Order, ("id", "merchant_order_id", "amount", "currency", "status", "trader_id",
+                       "created_at", "expires_at", "reassign_count")),
+    "payouts": (Payout, ("id", "trader_id", "amount", "currency", "status", "created_at", "processed_at")),
+    "tickets": (Ticket, ("id", "trader_id", "status", "created_at", "text")),
+}
+
+_tz = ZoneInfo(TURNOVER_TZ)
+
+
+def parse_day(value: Optional[str]) -> Optional[date]:
+    # YYYY-MM-DD; ValueError — пусть решает вызывающий
+    return date.fromisoformat(value) if value else None
+
+
+def _bounds(date_from: Optional[date], date_to: Optional[date]):
+    # даты — в таймзоне оборотов, date_to включительно
+    start = datetime.combine(date_from, time.min, _tz) if date_from else None
+    end = datetime.combine(date_to + timedelta(days=1), time.min, _tz) if date_to else None
+    return start, end
+
+
+def export_filename(kind: str, fmt: str, date_from: Optional[date], date_to: Optional[date], part: int = 0) -> str:
+    span = f"{date_from or 'start'}_{date_to or 'now'}"
+    suffix = f"-part{part}" if part else ""
+    return f"{kind}-{span}{suffix}.{fmt}"
+
+
+async def export_rows(kind: str, date_from: Optional[date] = None, date_to: Optional[date] = None) -> AsyncIterator[list]:
+    # пачки строк (кортежей) по EXPORT_CHUNK из серверного курсора
+    model, columns = EXPORTS[kind]
+    stmt = select(*(getattr(model, name) for name in columns)).order_by(model.id)
+    start, end = _bounds(date_from, date_to)
+    if start is not None:
+        stmt = stmt.where(model.created_at >= start)
+    if end is not None:
+        stmt = stmt.where(model.created_at < end)
+
+    async with AsyncSessionLocal() as session:
+        result = await session.stream(stmt.execution_options(yield_per=EXPORT_CHUNK))
+        async for partition in result.partitions():
+            yield partition
+
+
+def _value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return "" if value is None else str(value)
+
+
+def header(kind: str, fmt: str) -> str:
+    if fmt != "csv":
+        return ""
+    buf = io.StringIO()
+    csv.writer(buf).writerow(EXPORTS[kind][1])
+    return buf.getvalue()
+
+
+def format_rows(kind: str, fmt: str, rows) -> str:
+    columns = EXPORTS[kind][1]
+    if fmt == "jsonl":
+        return "".join(
+            json.dumps({name: (None if value is None else _value(value)) for name, value in zip(columns, row)},
+                       ensure_ascii=False) + "\n"
+            for row in rows
+        )
+    buf = io.StringIO()
+    csv.writer(buf).writerows([_value(value) for value in row] for row in rows)
+    return buf.getvalue()
+
+
+async def export_text(kind: str, fmt: str, date_from: Optional[date] = None, date_to: Optional[date] = None) -> AsyncIterator[str]:
+    # готовые куски файла: заголовок (для csv), затем по куску на пачку строк
+    head = header(kind, fmt)
+    if head:
+        yield head
+    async for rows in export_rows(kind, date_from, date_to):
+        yield format_rows(kind, fmt, rows)
@@ -0,0 +1,52 @@
+import os
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "100000"))
+
+
+class RecentOrders:
+    # LRU недавно принятых (merchant_id, merchant_order_id) -> {order_id, order_status, trader_id}.
+    # merchant_order_id уникален только в пределах мерчанта, поэтому ключ — пара.
+    # Отвечает на повторы без БД; авторитетная проверка — ON CONFLICT в dispatcher.
+
+    def __init__(self, maxsize: int = CACHE_SIZE) -> None:
+        self.maxsize = maxsize
+        self._items: "OrderedDict[Tuple[Optional[int], str], dict]" = OrderedDict()
+
+    def get(self, merchant_id: Optional[int], merchant_order_id: str) -> Optional[dict]:
+        key = (merchant_id, merchant_order_id)
+        item = self._items.get(key)
+        if item is not None:
+            self._items.move_to_end(key)
+        return item
+
+    def remember(
+        self, merchant_id: Optional[int], merchant_order_id: str, order_id: int, order_status: str, trader_id
+    ) -> None:
+        key = (merchant_id, merchant_order_id)
+        self._items[key] = {
+            "order_id": order_id,
+            "order_status": order_status,
+            "trader_id": trader_id,
+        }
+        self._items.move_to_end(key)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def update_status(
+        self, merchant_id: Optional[int], merchant_order_id: str, order_status: str, trader_id=None
+    ) -> None:
+        # trader_id — при переназначении заявки другому трейдеру
+        item = self._items.get((merchant_id, merchant_order_id))
+        if item is not None:
+            item["order_status"] = order_status
+            if trader_id is not None:
+                item["trader_id"] = trader_id
+
+
+recent_orders = RecentOrders()
+
+
+def duplicate_result(merchant_order_id: str, item: dict) -> dict:
+    return {"id": merchant_order_id, "status": "duplicate", **item}
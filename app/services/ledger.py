@@ -0,0 +1,229 @@
+import asyncio
+import logging
+import os
+from collections import defaultdict
+from decimal import Decimal
+
+from sqlalchemy import Integer, Numeric, column, func, insert, select, text, update, values
+
+from app.database import AsyncSessionLocal
+from app.metrics import Counter
+from app.models import BalanceEntry, Trader
+from app.services.events import CAPACITY_CHANNEL, PROCESS_ID, notify_many
+from app.services.pool import commit_trader_state, trader_pool
+
+log = logging.getLogger(__name__)
+
+# Журнал движений балансов. Баланс трейдера = снапшот (колонки traders) + ещё не свёрнутые записи.
+# Записи с проверкой остатка (заморозка под заявку, списание выплат) пишутся под блокировкой строки
+# трейдера сразу в снапшот (applied=true). Записи без проверки (закрытие заявки) — только INSERT
+# в журнал (applied=false), без блокировки строки; их периодически сворачивает compact_balances.
+# Свёртка только увеличивает доступный остаток (done списывает и депозит, и заморозку), поэтому
+# резервирование по снапшоту консервативно и никогда не перерезервирует.
+ACCOUNTS = ("deposit_rub", "frozen_rur", "reserved_usdt", "referral_usdt")
+
+LEDGER_COMPACT_INTERVAL = float(os.getenv("LEDGER_COMPACT_INTERVAL", "1"))
+LEDGER_COMPACT_BATCH = int(os.getenv("LEDGER_COMPACT_BATCH", "10000"))
+# asyncpg ограничивает число параметров в запросе (32767)
+LEDGER_CHUNK = 1000
+# остатков в одном уведомлении trader_capacity (NOTIFY ограничен 8000 байт)
+CAPACITY_NOTIFY_CHUNK = 200
+# колонки балансов — Numeric(18, 2)
+BALANCE_LIMIT = Decimal(10) ** 16
+# свёртку в каждый момент делает один процесс
+COMPACT_LOCK_ID = 7340002
+
+ledger_folded_total = Counter("ledger_folded_entries_total", "Balance journal entries folded into trader snapshots")
+
+
+def entry(trader_id: int, account: str, amount, reason: str, ref_id=None, applied: bool = False) -> dict:
+    return {
+        "trader_id": trader_id,
+        "account": account,
+        "amount": amount,
+        "reason": reason,
+        "ref_id": ref_id,
+        "applied": applied,
+    }
+
+
+async def record(session, entries) -> None:
+    # в транзакции вызывающего, multi-row INSERT
+    for i in range(0, len(entries), LEDGER_CHUNK):
+        await session.execute(insert(BalanceEntry).values(entries[i:i + LEDGER_CHUNK]))
+
+
+async def adjust_balance(trader_id: int, account: str, amount, reason: str = "adjustment", ref_id=None):
+    # ручное движение баланса (пополнение или списание депозита, корректировка USDT-счетов):
+    # запись журнала и снапшот меняются в одной транзакции под блокировкой строки трейдера,
+    # поэтому сверка сходится. Заморозка двигается только заявками. None — трейдера нет.
+    if account not in ACCOUNTS or account == "frozen_rur":
+        raise ValueError(f"account must be one of {', '.join(a for a in ACCOUNTS if a != 'frozen_rur')}")
+    amount = Decimal(str(amount))
+    if not amount or abs(amount) >= BALANCE_LIMIT:
+        raise ValueError(f"amount must be non-zero and below {BALANCE_LIMIT} in absolute value")
+    async with AsyncSessionLocal() as session:
+        trader = (await session.execute(select(Trader).where(Trader.id == trader_id).with_for_update())).scalar()
+        if trader is None:
+            return None
+        balance = (getattr(trader, account) or 0) + amount
+        # несвёрнутые записи только увеличивают свободный остаток, так что проверка по снапшоту строже нужной
+        if balance < 0 or balance >= BALANCE_LIMIT or (account == "deposit_rub" and balance < (trader.frozen_rur or 0)):
+            raise ValueError(f"{account} would drop below zero or below frozen funds")
+        setattr(trader, account, balance)
+        await record(session, [entry(trader_id, account, amount, reason, ref_id, applied=True)])
+        # commit + новый свободный остаток в пул подбора всех процессов
+        await commit_trader_state(session, trader)
+    return trader
+
+
+async def trader_balances(trader_id: int) -> dict:
+    # снапшот + дельта из несвёрнутых записей одним запросом (частичный индекс по NOT applied)
+    pending = (
+        select(
+            BalanceEntry.trader_id,
+            *(
+                func.coalesce(func.sum(BalanceEntry.amount).filter(BalanceEntry.account == account), 0).label(account)
+                for account in ACCOUNTS
+            ),
+        )
+        .where(BalanceEntry.trader_id == trader_id, BalanceEntry.applied.is_(False))
+        .group_by(BalanceEntry.trader_id)
+        .subquery()
+    )
+    async with AsyncSessionLocal() as session:
+        r = await session.execute(
+            select(*(
+                (func.coalesce(getattr(Trader, account), 0) + func.coalesce(getattr(pending.c, account), 0)).label(account)
+                for account in ACCOUNTS
+            ))
+            .select_from(Trader)
+            .outerjoin(pending, pending.c.trader_id == Trader.id)
+            .where(Trader.id == trader_id)
+        )
+        row = r.first()
+    if row is None:
+        return {account: Decimal(0) for account in ACCOUNTS}
+    return {account: Decimal(getattr(row, account)) for account in ACCOUNTS}
+
+
+async def compact_balances(limit: int = LEDGER_COMPACT_BATCH) -> int:
+    # сворачивает до limit несвёрнутых записей в колонки traders; возвращает их число
+    async with AsyncSessionLocal() as session:
+        if not (await session.execute(text(f"SELECT pg_try_advisory_xact_lock({COMPACT_LOCK_ID})"))).scalar():
+            return 0
+
+        pick = (
+            select(BalanceEntry.id)
+            .where(BalanceEntry.applied.is_(False))
+            .order_by(BalanceEntry.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        r = await session.execute(
+            update(BalanceEntry)
+            .where(BalanceEntry.id.in_(pick))
+            .values(applied=True)
+            .returning(BalanceEntry.trader_id, BalanceEntry.account, BalanceEntry.amount)
+            .execution_options(synchronize_session=False)
+        )
+        deltas = defaultdict(lambda: dict.fromkeys(ACCOUNTS, Decimal(0)))
+        folded = 0
+        for row in r:
+            deltas[row.trader_id][row.account] += row.amount
+            folded += 1
+        if not folded:
+            await session.rollback()
+            return 0
+
+        # строки трейдеров — в порядке id, как и в пакетных выплатах, чтобы не ловить дедлоки
+        trader_ids = sorted(deltas)
+        available = {}
+        for i in range(0, len(trader_ids), LEDGER_CHUNK):
+            chunk = trader_ids[i:i + LEDGER_CHUNK]
+            await session.execute(select(Trader.id).where(Trader.id.in_(chunk)).order_by(Trader.id).with_for_update())
+            v = values(
+                column("id", Integer), *(column(account, Numeric(18, 2)) for account in ACCOUNTS), name="v"
+            ).data([(trader_id, *(deltas[trader_id][account] for account in ACCOUNTS)) for trader_id in chunk])
+            r = await session.execute(
+                update(Trader)
+                .where(Trader.id == v.c.id)
+                .values({
+                    account: func.coalesce(getattr(Trader, account), 0) + getattr(v.c, account)
+                    for account in ACCOUNTS
+                })
+                .returning(Trader.id, Trader.requisites_enabled, (Trader.deposit_rub - Trader.frozen_rur).label("available"))
+                .execution_options(synchronize_session=False)
+            )
+            available.update((row.id, float(row.available)) for row in r if row.requisites_enabled)
+        # снапшот поменялся — свободный остаток в индексах подбора всех процессов тоже
+        # (разморозки после закрытия заявок); доставится после commit
+        items = list(available.items())
+        await notify_many(session, CAPACITY_CHANNEL, [
+            {"origin": PROCESS_ID, "available": dict(items[i:i + CAPACITY_NOTIFY_CHUNK])}
+            for i in range(0, len(items), CAPACITY_NOTIFY_CHUNK)
+        ])
+        await session.commit()
+
+    for trader_id, value in available.items():
+        trader_pool.set_available(trader_id, value)
+    ledger_folded_total.inc(amount=folded)
+    return folded
+
+
+async def reconcile_balances(limit: int = 100) -> list:
+    # снапшот в traders должен совпадать с суммой свёрнутых записей журнала.
+    # Один запрос — один снимок данных, поэтому параллельная свёртка не даёт ложных расхождений.
+    sums = ", ".join(
+        f"coalesce(sum(amount) FILTER (WHERE account = '{account}'), 0) AS {account}" for account in ACCOUNTS
+    )
+    diff = " OR ".join(f"coalesce(t.{account}, 0) <> coalesce(j.{account}, 0)" for account in ACCOUNTS)
+    cols = ", ".join(f"coalesce(t.{account}, 0) AS {account}, coalesce(j.{account}, 0) AS journal_{account}" for account in ACCOUNTS)
+    async with AsyncSessionLocal() as session:
+        r = await session.execute(
+            text(
+                f"WITH j AS (SELECT trader_id, {sums} FROM balance_entries WHERE applied GROUP BY trader_id) "
+                f"SELECT t.id AS trader_id, {cols} FROM traders t LEFT JOIN j ON j.trader_id = t.id "
+                f"WHERE {diff} ORDER BY t.id LIMIT :limit"
+            ),
+            {"limit": limit},
+        )
+        return [dict(row._mapping) for row in r]
+
+
+async def pending_entries() -> int:
+    async with AsyncSessionLocal() as session:
+        return (await session.execute(
+            select(func.count()).select_from(BalanceEntry).where(BalanceEntry.applied.is_(False))
+        )).scalar()
+
+
+async def _compactor() -> None:
+    while True:
+        try:
+            # пока журнал не разобран — сворачиваем без паузы
+            while await compact_balances() >= LEDGER_COMPACT_BATCH:
+                pass
+        except Exception:
+            log.exception("ledger compaction failed")
+        await asyncio.sleep(LEDGER_COMPACT_INTERVAL)
+
+
+_compactor_task = None
+
+
+async def start_ledger_compactor() -> None:
+    global _compactor_task
+    if _compactor_task is None:
+        _compactor_task = asyncio.create_task(_compactor())
+
+
+async def stop_ledger_compactor() -> None:
+    global _compactor_task
+    if _compactor_task is not None:
+        _compactor_task.cancel()
+        try:
+            await _compactor_task
+        except asyncio.CancelledError:
+            pass
+        _compactor_task = None
@@ -0,0 +1,208 @@
+import os
+import random
+from typing import List, Optional
+
+# Как выбирать трейдера среди тех, чей свободный остаток (deposit_rub - frozen_rur) покрывает сумму:
+#   best_fit     — с наименьшим достаточным остатком (крупные остатки остаются под крупные заявки)
+#   least_loaded — с наибольшим остатком (нагрузка размазывается по всем)
+#   weighted     — случайно, с вероятностью пропорционально остатку
+POLICIES = ("best_fit", "least_loaded", "weighted")
+MATCH_POLICY = os.getenv("MATCH_POLICY", "least_loaded")
+if MATCH_POLICY not in POLICIES:
+    raise RuntimeError(f"MATCH_POLICY must be one of {', '.join(POLICIES)}")
+
+# сколько случайных проб делает weighted на одного кандидата, прежде чем добрать остальных по остатку
+WEIGHTED_DRAWS_PER_PICK = 3
+
+
+class _Node:
+    __slots__ = ("key", "prio", "left", "right", "weight", "total", "size")
+
+    def __init__(self, key: tuple, prio: float) -> None:
+        self.key = key
+        self.prio = prio
+        self.left: Optional["_Node"] = None
+        self.right: Optional["_Node"] = None
+        self.weight = max(key[0], 0.0)
+        self.total = self.weight
+        self.size = 1
+
+
+def _update(node: _Node) -> _Node:
+    total, size = node.weight, 1
+    if node.left is not None:
+        total += node.left.total
+        size += node.left.size
+    if node.right is not None:
+        total += node.right.total
+        size += node.right.size
+    node.total, node.size = total, size
+    return node
+
+
+def _split(node: Optional[_Node], key: tuple):
+    # (ключи < key, ключи >= key)
+    if node is None:
+        return None, None
+    if node.key < key:
+        left, right = _split(node.right, key)
+        node.right = left
+        return _update(node), right
+    left, right = _split(node.left, key)
+    node.left = right
+    return left, _update(node)
+
+
+def _merge(a: Optional[_Node], b: Optional[_Node]) -> Optional[_Node]:
+    # все ключи a меньше ключей b
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if a.prio > b.prio:
+        a.right = _merge(a.right, b)
+        return _update(a)
+    b.left = _merge(a, b.left)
+    return _update(b)
+
+
+class CapacityBook:
+    # Трейдеры одной валюты по ключу (available, trader_id) в декартовом дереве (treap):
+    # вставка, удаление и поиск границы "хватает на сумму" — O(log n). В каждом узле хранится
+    # сумма остатков поддерева, поэтому weighted выбирает узел по префиксной сумме, тоже за O(log n).
+
+    def __init__(self, rng=random) -> None:
+        self._root: Optional[_Node] = None
+        self._rng = rng
+
+    def __len__(self) -> int:
+        return self._root.size if self._root is not None else 0
+
+    def add(self, trader_id: int, available: float) -> None:
+        node = _Node((available, trader_id), self._rng.random())
+        left, right = _split(self._root, node.key)
+        self._root = _merge(_merge(left, node), right)
+
+    def remove(self, trader_id: int, available: float) -> None:
+        left, rest = _split(self._root, (available, trader_id))
+        _, right = _split(rest, (available, trader_id + 1))
+        self._root = _merge(left, right)
+
+    def _below(self, bound: tuple):
+        # (число, сумма остатков) ключей < bound
+        count, weight = 0, 0.0
+        node = self._root
+        while node is not None:
+            if node.key < bound:
+                if node.left is not None:
+                    count += node.left.size
+                    weight += node.left.total
+                count += 1
+                weight += node.weight
+                node = node.right
+            else:
+                node = node.left
+        return count, weight
+
+    def eligible(self, amount: float) -> int:
+        # сколько трейдеров покрывают amount
+        return len(self) - self._below((amount, -1))[0]
+
+    def _ascending(self, bound: tuple):
+        stack = []
+        node = self._root
+        while node is not None:
+            if node.key >= bound:
+                stack.append(node)
+                node = node.left
+            else:
+                node = node.right
+        while stack:
+            node = stack.pop()
+            yield node.key[1]
+            node = node.right
+            while node is not None:
+                stack.append(node)
+                node = node.left
+
+    def _descending(self, bound: tuple):
+        stack = []
+        node = self._root
+        while node is not None:
+            stack.append(node)
+            node = node.right
+        while stack:
+            node = stack.pop()
+            if node.key < bound:
+                return
+            yield node.key[1]
+            node = node.left
+            while node is not None:
+                stack.append(node)
+                node = node.right
+
+    def _at_weight(self, r: float) -> Optional[_Node]:
+        # узел, на чей отрезок [префикс, префикс + остаток) попадает r
+        node = self._root
+        last = None
+        while node is not None:
+            if node.left is not None and r < node.left.total:
+                node = node.left
+                continue
+            if node.left is not None:
+                r -= node.left.total
+            if r < node.weight:
+                return node
+            r -= node.weight
+            if node.weight > 0:
+                last = node
+            node = node.right
+        # r упёрся в правый край из-за округления — берём последний узел с ненулевым остатком
+        return last
+
+    def pick(self, amount: float, limit: int, policy: str = MATCH_POLICY, rng=None) -> List[int]:
+        # до limit id трейдеров в порядке предпочтения политики; rng по умолчанию — переданный в конструктор
+        bound = (amount, -1)
+        if limit <= 0 or self._root is None:
+            return []
+        if policy == "best_fit":
+            source = self._ascending(bound)
+        elif policy == "least_loaded":
+            source = self._descending(bound)
+        else:
+            return self._weighted(bound, limit, rng or self._rng)
+        picked = []
+        for trader_id in source:
+            picked.append(trader_id)
+            if len(picked) >= limit:
+                break
+        return picked
+
+    def _weighted(self, bound: tuple, limit: int, rng) -> List[int]:
+        # Последовательный выбор без возвращения: каждая проба — точка, равномерная на сумме остатков
+        # подходящих трейдеров, т.е. трейдер выпадает с вероятностью пропорционально остатку.
+        # Повторы отбрасываются (среди оставшихся выбор остаётся пропорциональным); если проб не хватило,
+        # добираем по убыванию остатка.
+        count, low = self._below(bound)
+        eligible = len(self) - count
+        if eligible <= 0:
+            return []
+        span = self._root.total - low
+        want = min(limit, eligible)
+        picked: List[int] = []
+        seen = set()
+        if span > 0:
+            for _ in range(want * WEIGHTED_DRAWS_PER_PICK):
+                node = self._at_weight(low + rng.random() * span)
+                if node is None or node.key < bound or node.key[1] in seen:
+                    continue
+                seen.add(node.key[1])
+                picked.append(node.key[1])
+                if len(picked) >= want:
+                    return picked
+        for trader_id in self._descending(bound):
+            if trader_id not in seen:
+                picked.append(trader_id)
+                if len(picked) >= want:
+                    break
+        return picked
@@ -0,0 +1,147 @@
+import hashlib
+import hmac
+import os
+import secrets
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from sqlalchemy import select, update
+
+from app.database import AsyncSessionLocal
+from app.models import Merchant
+from app.services.ratelimit import TokenBucket
+
+# Подпись запроса мерчанта:
+#   X-Merchant-Key: <api_key>
+#   X-Timestamp:    <unix time, сек>
+#   X-Signature:    hex(HMAC-SHA256(secret, "<timestamp>\n<METHOD>\n<path>\n" + тело запроса))
+# Проверка — один HMAC по телу и словарь в памяти; в БД идём только за ещё не виденным ключом.
+
+# По умолчанию приём без подписи, как раньше (лимиты тогда считаются по IP клиента).
+# Включение MERCHANT_AUTH=1 ломает неподписанных клиентов, поэтому сначала выдать ключи:
+# POST /admin/merchants (ADMIN_API_TOKEN) для каждого мерчанта -> api_key и secret (secret показывается
+# один раз), мерчант подписывает запросы по схеме выше, и только потом включать проверку.
+MERCHANT_AUTH = os.getenv("MERCHANT_AUTH", "0") == "1"
+# допустимое расхождение X-Timestamp с часами сервера, сек (ограничивает повтор перехваченного запроса)
+MERCHANT_SIGNATURE_TTL = float(os.getenv("MERCHANT_SIGNATURE_TTL", "300"))
+# сколько держим ключ (и отсутствие ключа) в памяти; отключённый ключ перестаёт работать не позже
+MERCHANT_CACHE_TTL = float(os.getenv("MERCHANT_CACHE_TTL", "30"))
+MERCHANT_CACHE_SIZE = int(os.getenv("MERCHANT_CACHE_SIZE", "10000"))
+# неизвестные ключи помним отдельно и недолго — их поток не вытесняет настоящих мерчантов
+MERCHANT_NEGATIVE_CACHE_SIZE = int(os.getenv("MERCHANT_NEGATIVE_CACHE_SIZE", "10000"))
+# походов в БД за ещё не виденными ключами в секунду; сверх — ключ считаем неизвестным
+MERCHANT_LOOKUP_RATE = float(os.getenv("MERCHANT_LOOKUP_RATE", "50"))
+
+
+def sign(secret: str, timestamp: str, method: str, path: str, body: bytes) -> str:
+    msg = f"{timestamp}\n{method.upper()}\n{path}\n".encode() + body
+    return hmac.new(secret.encode(), msg, hashlib.sha256).hexdigest()
+
+
+def _as_dict(m: Merchant) -> dict:
+    return {
+        "id": m.id,
+        "name": m.name,
+        "api_key": m.api_key,
+        "secret": m.secret,
+        "rate_limit": float(m.rate_limit) if m.rate_limit is not None else None,
+        "burst": m.burst,
+    }
+
+
+class MerchantRegistry:
+    # api_key -> (мерчант, когда загружен) и отдельно api_key -> когда не нашли; оба LRU с TTL.
+    # Поток случайных ключей ограничен по памяти (размер LRU) и по нагрузке на БД (бакет поиска).
+
+    def __init__(self) -> None:
+        self._known: "OrderedDict[str, tuple]" = OrderedDict()
+        self._unknown: "OrderedDict[str, float]" = OrderedDict()
+        self._lookups = TokenBucket(MERCHANT_LOOKUP_RATE, MERCHANT_LOOKUP_RATE)
+
+    async def get(self, api_key: str) -> Optional[dict]:
+        now = time.monotonic()
+        cached = self._known.get(api_key)
+        if cached is not None and now - cached[1] < MERCHANT_CACHE_TTL:
+            self._known.move_to_end(api_key)
+            return cached[0]
+        missed = self._unknown.get(api_key)
+        if missed is not None and now - missed < MERCHANT_CACHE_TTL:
+            return None
+        if cached is None and self._lookups.try_acquire():
+            # поиск новых ключей исчерпан — не бьём БД; уже известные перечитываем всегда
+            return None
+
+        async with AsyncSessionLocal() as session:
+            m = (await session.execute(
+                select(Merchant).where(Merchant.api_key == api_key, Merchant.active.is_(True))
+            )).scalar()
+        self.invalidate(api_key)
+        if m is None:
+            _remember(self._unknown, api_key, now, MERCHANT_NEGATIVE_CACHE_SIZE)
+            return None
+        merchant = _as_dict(m)
+        _remember(self._known, api_key, (merchant, now), MERCHANT_CACHE_SIZE)
+        return merchant
+
+    def invalidate(self, api_key: str) -> None:
+        self._known.pop(api_key, None)
+        self._unknown.pop(api_key, None)
+
+
+def _remember(items: OrderedDict, key, value, maxsize: int) -> None:
+    items[key] = value
+    items.move_to_end(key)
+    while len(items) > maxsize:
+        items.popitem(last=False)
+
+
+merchant_registry = MerchantRegistry()
+
+
+async def verify_request(headers, method: str, path: str, body: bytes) -> Optional[dict]:
+    # мерчант, если подпись верна; иначе None. Дешёвые проверки — до обращения к реестру.
+    api_key = headers.get("X-Merchant-Key")
+    timestamp = headers.get("X-Timestamp")
+    signature = headers.get("X-Signature")
+    if not api_key or not timestamp or not signature:
+        return None
+    try:
+        skew = abs(time.time() - float(timestamp))
+    except ValueError:
+        return None
+    if skew > MERCHANT_SIGNATURE_TTL:
+        return None
+
+    merchant = await merchant_registry.get(api_key)
+    if merchant is None:
+        return None
+    if not hmac.compare_digest(sign(merchant["secret"], timestamp, method, path, body), signature):
+        return None
+    return merchant
+
+
+async def create_merchant(name: str, rate_limit: float = None, burst: int = None) -> dict:
+    # secret возвращается только здесь — показать мерчанту один раз
+    m = Merchant(
+        name=name,
+        api_key=secrets.token_hex(12),
+        secret=secrets.token_urlsafe(32),
+        rate_limit=rate_limit,
+        burst=burst,
+    )
+    async with AsyncSessionLocal() as session:
+        session.add(m)
+        await session.commit()
+        await session.refresh(m)
+    return _as_dict(m)
+
+
+async def deactivate_merchant(api_key: str) -> bool:
+    async with AsyncSessionLocal() as session:
+        r = await session.execute(
+            update(Merchant).where(Merchant.api_key == api_key, Merchant.active.is_(True)).values(active=False)
+        )
+        await session.commit()
+    merchant_registry.invalidate(api_key)
+    return r.rowcount > 0
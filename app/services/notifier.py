@@ -0,0 +1,227 @@
+import asyncio
+import logging
+import os
+from datetime import timedelta
+
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramRetryAfter,
+)
+from aiogram.types import InlineKeyboardMarkup
+from sqlalchemy import func, select, update
+
+from app.database import AsyncSessionLocal
+from app.models import Notification
+from app.services.events import OUTBOX_CHANNEL, listener
+from app.services.ratelimit import BucketMap, TokenBucket
+
+log = logging.getLogger(__name__)
+
+# Лимиты Telegram: ~30 сообщений/сек на бота и ~1/сек в один чат
+GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "25"))
+CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", "1"))
+CHAT_BURST = float(os.getenv("OUTBOX_CHAT_BURST", "3"))
+WORKERS = int(os.getenv("OUTBOX_WORKERS", "4"))
+BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "5"))
+LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", "60"))
+MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+# сколько готовых строк просматриваем на одну выдаваемую при отборе по чатам
+CLAIM_SCAN_FACTOR = 10
+
+
+
+def _backoff(attempts: int) -> int:
+    return min(2 ** attempts, 300)
+
+
+class OutboxSender:
+    def __init__(self, bot) -> None:
+        self.bot = bot
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+        self.chat_buckets = BucketMap(CHAT_RATE, CHAT_BURST)
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=BATCH_SIZE)
+        self.wakeup = asyncio.Event()
+        self.tasks = []
+
+    async def start(self) -> None:
+        await listener.subscribe(OUTBOX_CHANNEL, lambda data: self.wakeup.set())
+        await listener.start()
+        self.tasks.append(asyncio.create_task(self._fetch_loop()))
+        for _ in range(WORKERS):
+            self.tasks.append(asyncio.create_task(self._send_loop()))
+
+    async def stop(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def _claim(self, limit: int):
+        # берём пачку в аренду: next_attempt_at сдвигается на LEASE_SECONDS,
+        # поэтому при падении процесса сообщения сами вернутся в очередь.
+        # На чат — не больше CHAT_BURST сообщений за раз: остальные всё равно ждали бы его бакет,
+        # а аренда тем временем истекала бы.
+        async with AsyncSessionLocal() as session:
+            due = (
+                select(
+                    Notification.id,
+                    func.row_number().over(partition_by=Notification.chat_id, order_by=Notification.id).label("rn"),
+                )
+                .where(
+                    Notification.status == "pending",
+                    Notification.next_attempt_at <= func.now(),
+                )
+                .order_by(Notification.id)
+                .limit(limit * CLAIM_SCAN_FACTOR)
+                .subquery()
+            )
+            ids = (
+                select(Notification.id)
+                .where(Notification.id.in_(select(due.c.id).where(due.c.rn <= CHAT_BURST)))
+                .order_by(Notification.id)
+                .limit(limit)
+                .with_for_update(skip_locked=True)
+            )
+            r = await session.execute(
+                update(Notification)
+                .where(Notification.id.in_(ids))
+                .values(
+                    next_attempt_at=func.now() + timedelta(seconds=LEASE_SECONDS),
+                    attempts=Notification.attempts + 1,
+                )
+                .returning(
+                    Notification.id,
+                    Notification.chat_id,
+                    Notification.text,
+                    Notification.reply_markup,
+                    Notification.attempts,
+                    Notification.next_attempt_at.label("lease_until"),
+                )
+                .execution_options(synchronize_session=False)
+            )
+            rows = r.all()
+            await session.commit()
+        return rows
+
+    async def _fetch_loop(self) -> None:
+        while True:
+            try:
+                rows = await self._claim(BATCH_SIZE)
+                # put ждёт, пока воркеры разгребут очередь
+                for row in rows:
+                    await self.queue.put(row)
+                if len(rows) == BATCH_SIZE:
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("outbox fetch failed")
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+    async def _send_loop(self) -> None:
+        while True:
+            row = await self.queue.get()
+            try:
+                await self._send(row)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("outbox send failed for #%s", row.id)
+
+    async def _send(self, row) -> None:
+        chat_bucket = self.chat_buckets.get(row.chat_id)
+        wait = chat_bucket.try_acquire()
+        if wait:
+            # чат упёрся в лимит — не держим воркер, возвращаем сообщение в очередь к нужному моменту
+            await self._defer(row, wait)
+            return
+        await self.global_bucket.acquire()
+        if not await self._renew(row):
+            # аренда истекла и сообщение забрал другой воркер — не отправляем второй раз
+            return
+        try:
+            markup = InlineKeyboardMarkup.model_validate_json(row.reply_markup) if row.reply_markup else None
+            await self.bot.send_message(row.chat_id, row.text, reply_markup=markup)
+        except TelegramRetryAfter as e:
+            chat_bucket.pause(e.retry_after)
+            await self._retry(row, str(e), e.retry_after)
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            # бот заблокирован / чат не найден — повторять бессмысленно
+            await self._finish(row.id, "failed", str(e))
+        except Exception as e:
+            if row.attempts >= MAX_ATTEMPTS:
+                await self._finish(row.id, "failed", str(e))
+            else:
+                await self._retry(row, str(e), _backoff(row.attempts))
+        else:
+            await self._finish(row.id, "sent", None)
+
+    async def _finish(self, notification_id: int, status: str, error) -> None:
+        async with AsyncSessionLocal() as session:
+            await session.execute(
+                update(Notification)
+                .where(Notification.id == notification_id)
+                .values(
+                    status=status,
+                    last_error=error[:500] if error else None,
+                    sent_at=func.now() if status == "sent" else None,
+                )
+            )
+            await session.commit()
+
+    async def _renew(self, row) -> bool:
+        # продлеваем аренду прямо перед отправкой, только если она ещё наша
+        async with AsyncSessionLocal() as session:
+            r = await session.execute(
+                update(Notification)
+                .where(
+                    Notification.id == row.id,
+                    Notification.status == "pending",
+                    Notification.next_attempt_at == row.lease_until,
+                )
+                .values(next_attempt_at=func.now() + timedelta(seconds=LEASE_SECONDS))
+            )
+            await session.commit()
+        return r.rowcount > 0
+
+    async def _defer(self, row, delay: float) -> None:
+        # не попытка: возвращаем счётчик и снимаем аренду
+        async with AsyncSessionLocal() as session:
+            await session.execute(
+                update(Notification)
+                .where(Notification.id == row.id, Notification.next_attempt_at == row.lease_until)
+                .values(
+                    next_attempt_at=func.now() + timedelta(seconds=delay),
+                    attempts=Notification.attempts - 1,
+                )
+            )
+            await session.commit()
+
+    async def _retry(self, row, error: str, delay: float) -> None:
+        async with AsyncSessionLocal() as session:
+            await session.execute(
+                update(Notification)
+                .where(Notification.id == row.id)
+                .values(
+                    next_attempt_at=func.now() + timedelta(seconds=delay),
+                    last_error=error[:500],
+                )
+            )
+            await session.commit()
+
+
+_sender = None
+
+
+async def start_notifier(bot) -> OutboxSender:
+    global _sender
+    if _sender is None:
+        _sender = OutboxSender(bot)
+        await _sender.start()
+    return _sender
@@ -0,0 +1,153 @@
+import asyncio
+from typing import Dict, Optional, Set, Tuple
+
+from sqlalchemy import select
+
+from app.database import AsyncSessionLocal
+from app.metrics import Gauge
+from app.models import Order
+from app.services.events import ORDER_STATUS_CHANNEL, listener
+from app.services.idempotency import recent_orders
+
+FINAL_STATUSES = ("done", "cancel")
+
+
+class OrderWatchHub:
+    # подписчики на смену статуса: (merchant_id, merchant_order_id) -> очереди событий
+    # (merchant_order_id уникален только в пределах мерчанта).
+    # События приходят через LISTEN order_status, поэтому ожидание ничего не стоит для БД.
+
+    def __init__(self) -> None:
+        self._subscribers: Dict[Tuple[Optional[int], str], Set[asyncio.Queue]] = {}
+
+    def watch(self, merchant_id: Optional[int], merchant_order_id: str) -> asyncio.Queue:
+        # подписываемся ДО чтения текущего статуса, чтобы не пропустить смену между ними
+        q: asyncio.Queue = asyncio.Queue(maxsize=16)
+        self._subscribers.setdefault((merchant_id, merchant_order_id), set()).add(q)
+        return q
+
+    def unwatch(self, merchant_id: Optional[int], merchant_order_id: str, q: asyncio.Queue) -> None:
+        key = (merchant_id, merchant_order_id)
+        subscribers = self._subscribers.get(key)
+        if subscribers is not None:
+            subscribers.discard(q)
+            if not subscribers:
+                del self._subscribers[key]
+
+    def publish(self, data: dict) -> None:
+        key = (data.get("merchant_id"), data.get("merchant_order_id"))
+        recent_orders.update_status(*key, data["status"], data.get("trader_id"))
+        for q in self._subscribers.get(key, ()):
+            self._put(q, data)
+
+    async def resync(self) -> None:
+        # после переподключения LISTEN события могли потеряться — None означает "перечитай статус"
+        for subscribers in self._subscribers.values():
+            for q in subscribers:
+                self._put(q, None)
+
+    @staticmethod
+    def _put(q: asyncio.Queue, item) -> None:
+        try:
+            q.put_nowait(item)
+        except asyncio.QueueFull:
+            pass  # подписчик всё равно перечитает статус по первому событию
+
+    def waiting(self) -> int:
+        return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+
+order_hub = OrderWatchHub()
+
+Gauge("order_status_watchers", "Merchant connections waiting for an order status change", fn=order_hub.waiting)
+
+
+def status_query(merchant_order_id: str, merchant_id: Optional[int] = None):
+    # только заявки этого мерчанта (чужая выглядит как несуществующая);
+    # merchant_id None — заявки, принятые без подписи
+    merchant = Order.merchant_id.is_(None) if merchant_id is None else Order.merchant_id == merchant_id
+    return (
+        select(Order.id, Order.status, Order.trader_id, Order.amount, Order.currency)
+        .where(Order.merchant_order_id == merchant_order_id, merchant)
+    )
+
+
+async def load_order_status(merchant_order_id: str, merchant_id: Optional[int] = None) -> Optional[dict]:
+    async with AsyncSessionLocal() as session:
+        row = (await session.execute(status_query(merchant_order_id, merchant_id))).first()
+    if row is None:
+        return None
+    return {
+        "id": merchant_order_id,
+        "order_id": row.id,
+        "status": row.status,
+        "trader_id": row.trader_id,
+        "amount": float(row.amount),
+        "currency": row.currency,
+    }
+
+
+async def wait_status_change(
+    merchant_order_id: str, since: Optional[str], timeout: float, merchant_id: Optional[int] = None
+) -> Optional[dict]:
+    # long-poll: ждёт, пока статус станет отличным от since (по умолчанию — от текущего),
+    # но не дольше timeout; None — заявки нет
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    q = order_hub.watch(merchant_id, merchant_order_id)
+    try:
+        current = await load_order_status(merchant_order_id, merchant_id)
+        if current is not None and since is None:
+            since = current["status"]
+        while current is not None and current["status"] == since:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(q.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            # одно чтение на реальную смену статуса (или resync)
+            current = await load_order_status(merchant_order_id, merchant_id)
+        return current
+    finally:
+        order_hub.unwatch(merchant_id, merchant_order_id, q)
+
+
+async def stream_status(merchant_order_id: str, timeout: float, heartbeat: float, merchant_id: Optional[int] = None):
+    # SSE: текущий статус, затем каждое изменение до финального статуса или таймаута.
+    # Между событиями в БД не ходим; None в выдаче — heartbeat.
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    q = order_hub.watch(merchant_id, merchant_order_id)
+    try:
+        current = await load_order_status(merchant_order_id, merchant_id)
+        if current is None:
+            return
+        yield current
+        while current["status"] not in FINAL_STATUSES:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return
+            try:
+                event = await asyncio.wait_for(q.get(), min(remaining, heartbeat))
+            except asyncio.TimeoutError:
+                yield None
+                continue
+            if event is None:
+                fresh = await load_order_status(merchant_order_id, merchant_id)
+                if fresh is None or fresh["status"] == current["status"]:
+                    continue
+                current = fresh
+            else:
+                # переназначение приходит с тем же статусом, но новым трейдером
+                current = {**current, "status": event["status"], "trader_id": event.get("trader_id", current["trader_id"])}
+            yield current
+    finally:
+        order_hub.unwatch(merchant_id, merchant_order_id, q)
+
+
+async def start_order_watch() -> None:
+    await listener.subscribe(ORDER_STATUS_CHANNEL, order_hub.publish)
+    await listener.on_connect(order_hub.resync)
+    await listener.start()
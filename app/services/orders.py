@@ -0,0 +1,52 @@
+from sqlalchemy import update
+
+from app.database import AsyncSessionLocal
+from app.models import Order
+from app.services.events import ORDER_STATUS_CHANNEL, notify
+from app.services.idempotency import recent_orders
+from app.services.ledger import entry, record
+from app.services.turnover import add_turnover
+
+OPEN_STATUSES = ("new", "in_work")
+
+
+async def close_order(order_id: int, status: str, trader_id=None):
+    # new/in_work -> done/cancel с разморозкой суммы; done ещё и списывает её с депозита.
+    # Условие на статус в UPDATE не даёт закрыть заявку дважды. Балансы меняются записями
+    # в журнал (без блокировки строки трейдера), в снапшот их сворачивает ledger.compact_balances.
+    if status not in ("done", "cancel"):
+        raise ValueError(f"unexpected final status {status!r}")
+    conditions = [Order.id == order_id, Order.status.in_(OPEN_STATUSES)]
+    if trader_id is not None:
+        conditions.append(Order.trader_id == trader_id)
+
+    async with AsyncSessionLocal() as session:
+        r = await session.execute(
+            update(Order)
+            .where(*conditions)
+            .values(status=status)
+            .returning(Order.id, Order.merchant_id, Order.merchant_order_id, Order.trader_id, Order.amount, Order.created_at)
+            .execution_options(synchronize_session=False)
+        )
+        row = r.first()
+        if row is None:
+            return None
+
+        if row.trader_id is not None:
+            entries = [entry(row.trader_id, "frozen_rur", -row.amount, f"order_{status}", row.id)]
+            if status == "done":
+                entries.append(entry(row.trader_id, "deposit_rub", -row.amount, "order_done", row.id))
+            await record(session, entries)
+            if status == "done":
+                await add_turnover(session, row.trader_id, row.created_at, row.amount)
+        # мерчанты, ждущие статус (long-poll/SSE), узнают о смене после commit
+        await notify(session, ORDER_STATUS_CHANNEL, {
+            "merchant_id": row.merchant_id,
+            "merchant_order_id": row.merchant_order_id,
+            "order_id": row.id,
+            "status": status,
+        })
+        await session.commit()
+
+    recent_orders.update_status(row.merchant_id, row.merchant_order_id, status)
+    return row
@@ -0,0 +1,23 @@
+from sqlalchemy import insert
+
+from app.models import Notification
+from app.services.events import OUTBOX_CHANNEL, notify
+
+
+async def enqueue_notification(session, chat_id, text: str, reply_markup=None) -> None:
+    # пишем в outbox в транзакции вызывающего; отправка — после commit, воркерами из app.services.notifier
+    session.add(Notification(chat_id=str(chat_id), text=text, reply_markup=reply_markup))
+    await notify(session, OUTBOX_CHANNEL, {})
+
+
+async def enqueue_notifications(session, items) -> None:
+    # items: [(chat_id, text, reply_markup), ...] — одним multi-row INSERT
+    if not items:
+        return
+    await session.execute(
+        insert(Notification).values([
+            {"chat_id": str(chat_id), "text": text, "reply_markup": reply_markup}
+            for chat_id, text, reply_markup in items
+        ])
+    )
+    await notify(session, OUTBOX_CHANNEL, {})
@@ -0,0 +1,36 @@
+from typing import List, NamedTuple, Optional
+
+
+class Page(NamedTuple):
+    rows: List
+    has_newer: bool
+    has_older: bool
+
+    @property
+    def first_id(self) -> Optional[int]:
+        return self.rows[0].id if self.rows else None
+
+    @property
+    def last_id(self) -> Optional[int]:
+        return self.rows[-1].id if self.rows else None
+
+
+async def keyset_page(session, stmt, id_col, cursor: Optional[int] = None, direction: str = "n", limit: int = 20) -> Page:
+    # keyset по id (новые сверху): "n" — старее курсора, "p" — новее курсора.
+    # Вместе с индексом (фильтр, id) каждая страница — range scan, без OFFSET.
+    if cursor is None:
+        q = stmt.order_by(id_col.desc())
+    elif direction == "p":
+        q = stmt.where(id_col > cursor).order_by(id_col.asc())
+    else:
+        q = stmt.where(id_col < cursor).order_by(id_col.desc())
+
+    r = await session.execute(q.limit(limit + 1))
+    rows = list(r.scalars().all())
+    extra = len(rows) > limit
+    rows = rows[:limit]
+
+    if cursor is not None and direction == "p":
+        rows.reverse()
+        return Page(rows, has_newer=extra, has_older=True)
+    return Page(rows, has_newer=cursor is not None, has_older=extra)
@@ -0,0 +1,184 @@
+import os
+from collections import defaultdict
+from decimal import Decimal
+
+from sqlalchemy import Integer, Numeric, column, func, select, update, values
+
+from app.database import AsyncSessionLocal
+from app.models import Payout, Trader
+from app.services.ledger import entry, record
+from app.services.outbox import enqueue_notifications
+from app.services.rates import rates
+from app.services.trader_cache import trader_cache
+
+# сколько выплат одобряем за одну транзакцию и размер пачки в одном UPDATE
+PAYOUT_BATCH_MAX = int(os.getenv("PAYOUT_BATCH_MAX", "5000"))
+PAYOUT_CHUNK = 1000
+
+
+def _chunks(items, size: int = PAYOUT_CHUNK):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _conditions(status: str, ids=None, id_range=None):
+    conditions = [Payout.status == status]
+    if ids is not None:
+        conditions.append(Payout.id.in_(ids))
+    if id_range is not None:
+        conditions.append(Payout.id.between(*id_range))
+    return conditions
+
+
+def payout_notification_text(title: str, payouts) -> str:
+    # одно сообщение трейдеру на всю пачку: payouts = [(id, amount), ...]
+    total = sum(amount for _, amount in payouts)
+    ids = ", ".join(f"#{pid}" for pid, _ in payouts[:10])
+    if len(payouts) > 10:
+        ids += f" и ещё {len(payouts) - 10}"
+    rub = rates.convert(total)
+    rub_text = f" (≈ {float(rub):.2f} RUB)" if rub is not None else ""
+    return f"💸 {title}: {len(payouts)} шт. на {float(total):.2f} USDT{rub_text}\n{ids}"
+
+
+async def approve_payouts(ids=None, id_range=None, limit: int = PAYOUT_BATCH_MAX) -> dict:
+    # new -> approved пачкой в одной транзакции: выплаты и трейдеры блокируются двумя SELECT,
+    # покрытие считается в памяти, балансы списываются одним UPDATE ... FROM (VALUES) на пачку.
+    # Списываем сначала reserved_usdt, остаток — с referral_usdt; выплаты без покрытия остаются new.
+    # Остаток проверяем по снапшоту: несвёрнутых записей по USDT-счетам не бывает (все пишутся applied).
+    async with AsyncSessionLocal() as session:
+        payouts = (await session.execute(
+            select(Payout.id, Payout.trader_id, Payout.amount)
+            .where(*_conditions("new", ids, id_range))
+            .order_by(Payout.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )).all()
+        if not payouts:
+            return {"approved": 0, "skipped": 0, "amount": 0.0, "traders": 0}
+
+        # трейдеров блокируем в порядке id — параллельные пачки не встанут в дедлок
+        trader_ids = sorted({p.trader_id for p in payouts if p.trader_id is not None})
+        traders = {}
+        for chunk in _chunks(trader_ids):
+            r = await session.execute(
+                select(Trader.id, Trader.tg_id, Trader.reserved_usdt, Trader.referral_usdt)
+                .where(Trader.id.in_(chunk))
+                .order_by(Trader.id)
+                .with_for_update()
+            )
+            traders.update((t.id, t) for t in r)
+
+        left = {t.id: [Decimal(t.reserved_usdt or 0), Decimal(t.referral_usdt or 0)] for t in traders.values()}
+        debits = defaultdict(lambda: [Decimal(0), Decimal(0)])
+        approved = defaultdict(list)
+        entries = []
+        for p in payouts:
+            balance = left.get(p.trader_id)
+            amount = Decimal(p.amount or 0)
+            if balance is None or amount <= 0 or balance[0] + balance[1] < amount:
+                continue
+            from_reserved = min(balance[0], amount)
+            balance[0] -= from_reserved
+            balance[1] -= amount - from_reserved
+            debits[p.trader_id][0] += from_reserved
+            debits[p.trader_id][1] += amount - from_reserved
+            approved[p.trader_id].append((p.id, amount))
+            if from_reserved:
+                entries.append(entry(p.trader_id, "reserved_usdt", -from_reserved, "payout", p.id, applied=True))
+            if amount - from_reserved:
+                entries.append(entry(p.trader_id, "referral_usdt", from_reserved - amount, "payout", p.id, applied=True))
+
+        if not approved:
+            return {"approved": 0, "skipped": len(payouts), "amount": 0.0, "traders": 0}
+
+        for chunk in _chunks(list(debits.items())):
+            v = values(
+                column("id", Integer), column("reserved", Numeric(18, 2)), column("referral", Numeric(18, 2)), name="v"
+            ).data([(trader_id, reserved, referral) for trader_id, (reserved, referral) in chunk])
+            await session.execute(
+                update(Trader)
+                .where(Trader.id == v.c.id)
+                .values(
+                    reserved_usdt=Trader.reserved_usdt - v.c.reserved,
+                    referral_usdt=Trader.referral_usdt - v.c.referral,
+                )
+                .execution_options(synchronize_session=False)
+            )
+
+        # списание уже в снапшоте (UPDATE выше), в журнал — для сверки
+        await record(session, entries)
+
+        approved_ids = [pid for items in approved.values() for pid, _ in items]
+        for chunk in _chunks(approved_ids):
+            await session.execute(
+                update(Payout)
+                .where(Payout.id.in_(chunk))
+                .values(status="approved", processed_at=func.now())
+                .execution_options(synchronize_session=False)
+            )
+
+        await enqueue_notifications(session, [
+            (traders[trader_id].tg_id, payout_notification_text("Выплаты одобрены", items), None)
+            for trader_id, items in approved.items()
+        ])
+        await session.commit()
+
+    # балансы поменялись — снапшоты трейдеров в кэше больше не актуальны
+    for trader_id in approved:
+        trader_cache.invalidate(traders[trader_id].tg_id)
+
+    return {
+        "approved": len(approved_ids),
+        "skipped": len(payouts) - len(approved_ids),
+        "amount": float(sum(amount for items in approved.values() for _, amount in items)),
+        "traders": len(approved),
+    }
+
+
+async def _transition(from_status: str, to_status: str, title: str, ids=None, id_range=None, limit: int = PAYOUT_BATCH_MAX) -> dict:
+    # смена статуса без движения балансов (reject: new -> rejected, paid: approved -> paid)
+    async with AsyncSessionLocal() as session:
+        pick = (
+            select(Payout.id)
+            .where(*_conditions(from_status, ids, id_range))
+            .order_by(Payout.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        r = await session.execute(
+            update(Payout)
+            .where(Payout.id.in_(pick))
+            .values(status=to_status, processed_at=func.now())
+            .returning(Payout.id, Payout.amount, Payout.trader_id)
+            .execution_options(synchronize_session=False)
+        )
+        rows = r.all()
+        if not rows:
+            await session.rollback()
+            return {to_status: 0, "traders": 0}
+
+        by_trader = defaultdict(list)
+        for row in rows:
+            if row.trader_id is not None:
+                by_trader[row.trader_id].append((row.id, Decimal(row.amount or 0)))
+
+        tg_ids = {}
+        for chunk in _chunks(list(by_trader)):
+            r = await session.execute(select(Trader.id, Trader.tg_id).where(Trader.id.in_(chunk)))
+            tg_ids.update((t.id, t.tg_id) for t in r)
+        await enqueue_notifications(session, [
+            (tg_ids[trader_id], payout_notification_text(title, sorted(items)), None)
+            for trader_id, items in by_trader.items() if trader_id in tg_ids
+        ])
+        await session.commit()
+
+    return {to_status: len(rows), "traders": len(by_trader)}
+
+
+async def reject_payouts(ids=None, id_range=None, limit: int = PAYOUT_BATCH_MAX) -> dict:
+    return await _transition("new", "rejected", "Выплаты отклонены", ids, id_range, limit)
+
+
+async def mark_payouts_paid(ids=None, id_range=None, limit: int = PAYOUT_BATCH_MAX) -> dict:
+    return await _transition("approved", "paid", "Выплаты отправлены", ids, id_range, limit)
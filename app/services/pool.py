@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import os
+from typing import Dict, List, NamedTuple
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+from app.database import AsyncSessionLocal
+from app.metrics import Gauge
+from app.models import Trader
+from app.services.events import CAPACITY_CHANNEL, PROCESS_ID, TRADERS_CHANNEL, listener, notify
+from app.services.matching import MATCH_POLICY, CapacityBook
+from app.services.trader_cache import trader_cache
+
+log = logging.getLogger(__name__)
+
+# полная перечитка индекса из БД — страховка на случай потерянных уведомлений;
+# в обычной работе индекс держат в актуальном состоянии traders_changed и trader_capacity
+MATCH_RESYNC_INTERVAL = float(os.getenv("MATCH_RESYNC_INTERVAL", "60"))
+
+# ключ в session.info: изменения индекса, которые применятся после commit этой сессии
+_PENDING = "trader_pool_pending"
+
+
+class PooledTrader(NamedTuple):
+    id: int
+    tg_id: str
+
+
+def _available(trader) -> float:
+    return float((trader.deposit_rub or 0) - (trader.frozen_rur or 0))
+
+
+class TraderPool:
+    # Трейдеры с включёнными реквизитами, по валютам, отсортированные по свободному остатку
+    # (app.services.matching). Выбор кандидатов — в памяти, без БД. Индекс — подсказка:
+    # окончательно остаток проверяет резервирование в БД (UPDATE ... WHERE available >= amount).
+    # Свои заморозки попадают в индекс после commit резервирования (rollback их отбрасывает),
+    # остатки после свёртки журнала приходят всем процессам через trader_capacity.
+    # Чужие заморозки индекс видит с опозданием — это безопасно: кандидата с завышенным
+    # остатком отсеет проверка в БД.
+
+    def __init__(self) -> None:
+        # id -> [tg_id, currency, available]
+        self._traders: Dict[int, list] = {}
+        self._books: Dict[str, CapacityBook] = {}
+        self._loaded = False
+        self._load_lock = asyncio.Lock()
+        self._task = None
+
+    def __len__(self) -> int:
+        return len(self._traders)
+
+    def count(self, currency: str) -> int:
+        book = self._books.get(currency.upper())
+        return len(book) if book is not None else 0
+
+    async def load(self) -> None:
+        async with self._load_lock:
+            async with AsyncSessionLocal() as session:
+                r = await session.execute(
+                    select(Trader.id, Trader.tg_id, Trader.currency, Trader.deposit_rub, Trader.frozen_rur)
+                    .where(Trader.requisites_enabled.is_(True))
+                )
+                rows = r.all()
+            traders = {}
+            books = {}
+            for row in rows:
+                currency = (row.currency or "RUB").upper()
+                available = _available(row)
+                traders[row.id] = [row.tg_id, currency, available]
+                books.setdefault(currency, CapacityBook()).add(row.id, available)
+            self._traders = traders
+            self._books = books
+            self._loaded = True
+
+    async def ensure_loaded(self) -> None:
+        if not self._loaded:
+            await self.load()
+
+    def apply(self, trader_id: int, tg_id: str, enabled: bool, currency: str = "RUB", available: float = None) -> None:
+        prev = self._drop(trader_id)
+        if enabled:
+            if available is None:
+                # остаток не прислали — оставляем известный, уточнит пересинхронизация
+                available = prev[2] if prev is not None else 0.0
+            currency = currency.upper()
+            self._traders[trader_id] = [tg_id, currency, float(available)]
+            self._books.setdefault(currency, CapacityBook()).add(trader_id, float(available))
+
+    def _drop(self, trader_id: int):
+        item = self._traders.pop(trader_id, None)
+        if item is not None:
+            self._books[item[1]].remove(trader_id, item[2])
+        return item
+
+    def set_available(self, trader_id: int, available) -> None:
+        item = self._traders.get(trader_id)
+        if item is None:
+            return
+        book = self._books[item[1]]
+        book.remove(trader_id, item[2])
+        item[2] = float(available)
+        book.add(trader_id, item[2])
+
+    def adjust(self, trader_id: int, delta) -> None:
+        # заморозка (delta < 0) или разморозка (delta > 0) суммы
+        item = self._traders.get(trader_id)
+        if item is not None:
+            self.set_available(trader_id, item[2] + float(delta))
+
+    def on_commit(self, session, trader_id: int, available=None, delta=None) -> None:
+        # изменение остатка в индексе вступает в силу только после commit транзакции session:
+        # available — точный остаток (из RETURNING), delta — заморозка (< 0) или разморозка (> 0)
+        session.info.setdefault(_PENDING, []).append((trader_id, available, delta))
+
+    def _apply_pending(self, pending) -> None:
+        for trader_id, available, delta in pending:
+            if available is not None:
+                self.set_available(trader_id, available)
+            else:
+                self.adjust(trader_id, delta)
+
+    def candidates(self, currency: str, amount, limit: int, policy: str = MATCH_POLICY) -> List[PooledTrader]:
+        # до limit трейдеров, чей остаток (по индексу) покрывает amount, в порядке политики;
+        # кто реально получит заявку, решает резервирование в БД (SKIP LOCKED)
+        book = self._books.get(currency.upper())
+        if book is None:
+            return []
+        return [PooledTrader(tid, self._traders[tid][0]) for tid in book.pick(float(amount), limit, policy)]
+
+    def _on_event(self, data: dict) -> None:
+        if data.get("origin") == PROCESS_ID:
+            # своё изменение уже применено в commit_trader_state
+            return
+        self.apply(
+            int(data["id"]), data["tg_id"], bool(data["enabled"]),
+            data.get("currency") or "RUB", data.get("available"),
+        )
+
+    def _on_capacity(self, data: dict) -> None:
+        # остатки после свёртки журнала; свои процесс уже применил
+        if data.get("origin") == PROCESS_ID:
+            return
+        for trader_id, available in data["available"].items():
+            self.set_available(int(trader_id), available)
+
+    async def _resync(self) -> None:
+        while True:
+            await asyncio.sleep(MATCH_RESYNC_INTERVAL)
+            try:
+                await self.load()
+            except Exception:
+                log.exception("trader pool resync failed")
+
+    def start_resync(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._resync())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+trader_pool = TraderPool()
+
+Gauge("trader_pool_size", "Enabled traders in the matching index", fn=lambda: len(trader_pool))
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_on_commit(session) -> None:
+    pending = session.info.pop(_PENDING, None)
+    if pending:
+        trader_pool._apply_pending(pending)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _drop_on_rollback(session, previous_transaction) -> None:
+    session.info.pop(_PENDING, None)
+
+
+async def commit_trader_state(session, trader: Trader) -> None:
+    # commit изменений трейдера + рассылка нового состояния всем процессам (пул, кэш бота)
+    await session.flush()
+    enabled = bool(trader.requisites_enabled)
+    currency = trader.currency or "RUB"
+    available = _available(trader)
+    await notify(session, TRADERS_CHANNEL, {
+        "id": trader.id, "tg_id": trader.tg_id, "enabled": enabled, "currency": currency, "available": available,
+        "origin": PROCESS_ID,
+    })
+    await session.commit()
+    trader_pool.apply(trader.id, trader.tg_id, enabled, currency, available)
+    trader_cache.put(trader)
+
+
+async def start_trader_pool() -> None:
+    await listener.subscribe(TRADERS_CHANNEL, trader_pool._on_event)
+    await listener.subscribe(CAPACITY_CHANNEL, trader_pool._on_capacity)
+    await listener.on_connect(trader_pool.load)
+    await listener.start()
+    trader_pool.start_resync()
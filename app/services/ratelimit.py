@@ -0,0 +1,80 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class TokenBucket:
+    # rate токенов в секунду, не больше capacity накопленных
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens: float = 1.0) -> float:
+        # 0 — токен взят, иначе сколько секунд ждать
+        now = time.monotonic()
+        self._refill(now)
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return 0.0
+        return (tokens - self.tokens) / self.rate
+
+    async def acquire(self, tokens: float = 1.0) -> None:
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        # например после 429 retry_after
+        self._refill(time.monotonic())
+        self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+
+    def is_full(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+
+class BucketMap:
+    # по бакету на ключ (чат, мерчант); простаивающие (полные) бакеты вытесняются при переполнении
+
+    def __init__(self, rate: float, capacity: float, max_keys: int = 10000) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[object, TokenBucket]" = OrderedDict()
+
+    def get(self, key, rate: float = None, capacity: float = None) -> TokenBucket:
+        # rate/capacity — свои лимиты ключа (например, из настроек мерчанта) вместо общих
+        rate = rate or self.rate
+        capacity = capacity or self.capacity
+        b = self._buckets.get(key)
+        if b is None:
+            if len(self._buckets) >= self.max_keys:
+                self._evict()
+            b = self._buckets[key] = TokenBucket(rate, capacity)
+        else:
+            self._buckets.move_to_end(key)
+            if b.rate != rate or b.capacity != capacity:
+                # лимиты поменяли — накопленное не больше нового запаса
+                b._refill(time.monotonic())
+                b.rate = rate
+                b.capacity = capacity
+                b.tokens = min(b.tokens, capacity)
+        return b
+
+    def _evict(self) -> None:
+        for key in list(self._buckets):
+            if len(self._buckets) < self.max_keys:
+                return
+            if self._buckets[key].is_full():
+                del self._buckets[key]
+        while len(self._buckets) >= self.max_keys:
+            self._buckets.popitem(last=False)
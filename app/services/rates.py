@@ -0,0 +1,274 @@
+import asyncio
+import importlib
+import json
+import logging
+import os
+import time
+from decimal import Decimal, InvalidOperation
+from typing import Dict, Optional
+
+from sqlalchemy import func, select, text
+from sqlalchemy.dialects.postgresql import insert
+
+from app.database import AsyncSessionLocal
+from app.metrics import Counter, Gauge
+from app.models import ExchangeRate, ExchangeRateHistory
+from app.services.events import RATES_CHANNEL, listener, notify
+
+log = logging.getLogger(__name__)
+
+RATE_PROVIDER = os.getenv("RATE_PROVIDER", "stub")  # stub | http | <module>:<factory>
+RATE_PROVIDER_URL = os.getenv("RATE_PROVIDER_URL", "")
+# stub: JSON-файл {"USDT_RUB": "80.74"}, перечитывается при каждом обновлении
+RATES_FILE = os.getenv("RATES_FILE", "")
+RATE_REFRESH_INTERVAL = float(os.getenv("RATE_REFRESH_INTERVAL", "60"))
+# курс провайдера старше этого — тревога (лог + метрика exchange_rate_stale)
+RATE_STALE_SECONDS = float(os.getenv("RATE_STALE_SECONDS", "600"))
+# обновлением в каждый момент занимается один процесс
+REFRESH_LOCK_ID = 7340003
+
+USDT_RUB = "USDT_RUB"
+STUB_RATES = {USDT_RUB: "80.74"}
+
+rate_refresh_total = Counter("exchange_rate_refresh_total", "Exchange rate refreshes by outcome", ("outcome",))
+rate_stale_alarms_total = Counter("exchange_rate_stale_alarms_total", "Times the exchange rate went stale")
+
+# -------------------- PROVIDERS --------------------
+
+
+class StubProvider:
+    # локальный источник для разработки и бенчей: файл RATES_FILE или фиксированные значения
+
+    def __init__(self, path: str = RATES_FILE) -> None:
+        self.path = path
+
+    async def fetch(self) -> Dict[str, Decimal]:
+        if not self.path:
+            return {pair: Decimal(rate) for pair, rate in STUB_RATES.items()}
+        with open(self.path) as f:
+            return {pair: Decimal(str(rate)) for pair, rate in json.load(f).items()}
+
+
+class HttpProvider:
+    # GET RATE_PROVIDER_URL -> {"USDT_RUB": 80.74, ...}
+
+    def __init__(self, url: str = RATE_PROVIDER_URL, timeout: float = 10) -> None:
+        if not url:
+            raise RuntimeError("RATE_PROVIDER_URL is not set")
+        self.url = url
+        self.timeout = timeout
+
+    async def fetch(self) -> Dict[str, Decimal]:
+        import aiohttp
+
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout)) as http:
+            async with http.get(self.url) as resp:
+                resp.raise_for_status()
+                data = await resp.json()
+        return {pair: Decimal(str(rate)) for pair, rate in data.items()}
+
+
+def make_rate_provider():
+    if RATE_PROVIDER == "stub":
+        return StubProvider()
+    if RATE_PROVIDER == "http":
+        return HttpProvider()
+    if ":" in RATE_PROVIDER:
+        # свой провайдер: "package.module:factory", factory() -> объект с async fetch()
+        module, attr = RATE_PROVIDER.split(":", 1)
+        return getattr(importlib.import_module(module), attr)()
+    raise RuntimeError(f"unknown RATE_PROVIDER: {RATE_PROVIDER}")
+
+# -------------------- SERVICE --------------------
+
+
+class RateService:
+    # Текущие курсы в памяти процесса: чтение без I/O. Обновляет провайдер в фоне (один процесс
+    # под advisory-локом), остальные узнают новые значения через NOTIFY exchange_rates.
+    # Ручной курс админа (override) действует, пока его не сбросят.
+
+    def __init__(self, provider=None) -> None:
+        self.provider = provider
+        self._rates: Dict[str, dict] = {}
+        self._task = None
+        self._stale = False
+
+    def get(self, pair: str = USDT_RUB) -> Optional[Decimal]:
+        item = self._rates.get(pair)
+        if item is None:
+            return None
+        return item["override"] if item["override"] is not None else item["rate"]
+
+    def convert(self, amount, pair: str = USDT_RUB) -> Optional[Decimal]:
+        # amount в базовой валюте пары (USDT для USDT_RUB) -> в котируемой
+        rate = self.get(pair)
+        return None if rate is None else Decimal(amount) * rate
+
+    def convert_back(self, amount, pair: str = USDT_RUB) -> Optional[Decimal]:
+        rate = self.get(pair)
+        return None if not rate else Decimal(amount) / rate
+
+    def snapshot(self) -> Dict[str, dict]:
+        return {pair: dict(item) for pair, item in self._rates.items()}
+
+    def age(self) -> float:
+        # возраст самого старого курса провайдера, сек (ручной курс провайдера не освежает)
+        updated = [item["updated_at"] for item in self._rates.values() if item["source"] != "admin"]
+        if not updated:
+            return float("inf")
+        return time.time() - min(updated)
+
+    def is_stale(self) -> bool:
+        return self.age() > RATE_STALE_SECONDS
+
+    def apply(self, data: dict) -> None:
+        self._rates[data["pair"]] = {
+            "rate": Decimal(data["rate"]),
+            "override": Decimal(data["override"]) if data.get("override") is not None else None,
+            "source": data["source"],
+            "updated_at": float(data["updated_at"]),
+        }
+
+    async def load(self) -> None:
+        async with AsyncSessionLocal() as session:
+            r = await session.execute(select(ExchangeRate))
+            for row in r.scalars():
+                self.apply(_payload(row))
+
+    async def refresh(self, force: bool = False) -> bool:
+        # True — курсы обновлены этим процессом; False — обновил кто-то другой или ещё рано.
+        # Провайдер опрашиваем до транзакции: медленный HTTP не держит соединение из пула и лок.
+        if not force:
+            async with AsyncSessionLocal() as session:
+                if not await _refresh_due(session):
+                    return False
+        if self.provider is None:
+            self.provider = make_rate_provider()
+        fetched = await self.provider.fetch()
+
+        async with AsyncSessionLocal() as session:
+            if not (await session.execute(text(f"SELECT pg_try_advisory_xact_lock({REFRESH_LOCK_ID})"))).scalar():
+                return False
+            # пока ходили к провайдеру, мог успеть другой процесс
+            if not force and not await _refresh_due(session):
+                return False
+            payloads = []
+            for pair, rate in fetched.items():
+                stmt = insert(ExchangeRate).values(pair=pair, rate=rate, source=RATE_PROVIDER, updated_at=func.now())
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[ExchangeRate.pair],
+                    set_={"rate": stmt.excluded.rate, "source": stmt.excluded.source, "updated_at": stmt.excluded.updated_at},
+                ).returning(ExchangeRate)
+                row = (await session.execute(select(ExchangeRate).from_statement(stmt))).scalar_one()
+                session.add(ExchangeRateHistory(pair=pair, rate=rate, source=RATE_PROVIDER))
+                payloads.append(_payload(row))
+                await notify(session, RATES_CHANNEL, payloads[-1])
+            await session.commit()
+        for payload in payloads:
+            self.apply(payload)
+        return True
+
+    async def set_override(self, pair: str, rate: Optional[Decimal], admin_id) -> None:
+        # rate=None — сбросить ручной курс
+        async with AsyncSessionLocal() as session:
+            row = (await session.execute(
+                select(ExchangeRate).where(ExchangeRate.pair == pair).with_for_update()
+            )).scalar()
+            if row is None:
+                if rate is None:
+                    return
+                # провайдер пары ещё не знает — ручной курс становится и базовым
+                row = ExchangeRate(pair=pair, rate=rate, source="admin")
+                session.add(row)
+            row.override_rate = rate
+            row.override_by = str(admin_id) if rate is not None else None
+            await session.flush()
+            await session.refresh(row)
+            if rate is not None:
+                session.add(ExchangeRateHistory(pair=pair, rate=rate, source=f"admin:{admin_id}"))
+            else:
+                session.add(ExchangeRateHistory(pair=pair, rate=row.rate, source=f"admin_clear:{admin_id}"))
+            await notify(session, RATES_CHANNEL, _payload(row))
+            await session.commit()
+        self.apply(_payload(row))
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                if await self.refresh():
+                    rate_refresh_total.inc("ok")
+            except Exception:
+                rate_refresh_total.inc("error")
+                log.exception("exchange rate refresh failed")
+            self._check_stale()
+            await asyncio.sleep(RATE_REFRESH_INTERVAL / 2)
+
+    def _check_stale(self) -> None:
+        stale = self.is_stale()
+        if stale and not self._stale:
+            rate_stale_alarms_total.inc()
+            log.error("exchange rates are stale: last provider update %.0fs ago", self.age())
+        elif self._stale and not stale:
+            log.warning("exchange rates are fresh again")
+        self._stale = stale
+
+    async def start(self) -> None:
+        if self._task is None:
+            if self.provider is None:
+                self.provider = make_rate_provider()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+async def _refresh_due(session) -> bool:
+    oldest = (await session.execute(
+        text("SELECT extract(epoch FROM now() - min(updated_at)) FROM exchange_rates WHERE source <> 'admin'")
+    )).scalar()
+    return oldest is None or oldest >= RATE_REFRESH_INTERVAL
+
+
+def _payload(row: ExchangeRate) -> dict:
+    return {
+        "pair": row.pair,
+        "rate": str(row.rate),
+        "override": str(row.override_rate) if row.override_rate is not None else None,
+        "source": row.source,
+        "updated_at": row.updated_at.timestamp(),
+    }
+
+
+def parse_rate(value: str) -> Optional[Decimal]:
+    try:
+        rate = Decimal(value.strip().replace(",", "."))
+    except InvalidOperation:
+        return None
+    return rate if rate.is_finite() and rate > 0 else None
+
+
+rates = RateService()
+
+Gauge("exchange_rate_age_seconds", "Seconds since the oldest provider rate was refreshed", fn=lambda: min(rates.age(), 10 ** 9))
+Gauge("exchange_rate_stale", "1 if provider rates are older than RATE_STALE_SECONDS", fn=lambda: float(rates.is_stale()))
+
+
+_started = False
+
+
+async def start_rates() -> None:
+    global _started
+    if _started:
+        return
+    _started = True
+    await listener.subscribe(RATES_CHANNEL, rates.apply)
+    await listener.on_connect(rates.load)
+    await listener.start()
+    await rates.load()
+    await rates.start()
@@ -0,0 +1,66 @@
+import asyncio
+import hashlib
+import os
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+
+from app.metrics import Counter
+
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "50000"))
+
+render_edits_total = Counter("bot_message_edits_total", "Dashboard edits by outcome (sent / skipped / superseded)", ("outcome",))
+
+
+def render_hash(text: str, markup_json: str = "") -> str:
+    return hashlib.blake2b(f"{text}\x00{markup_json}".encode(), digest_size=16).hexdigest()
+
+
+class RenderCache:
+    # (chat_id, message_id) -> хэш последнего показанного текста и клавиатуры.
+    # Если новый рендер совпадает — edit не отправляем (Telegram всё равно ответит "message is not modified").
+
+    def __init__(self, maxsize: int = RENDER_CACHE_SIZE) -> None:
+        self.maxsize = maxsize
+        self._items: "OrderedDict[tuple, str]" = OrderedDict()
+
+    def get(self, chat_id, message_id) -> Optional[str]:
+        return self._items.get((chat_id, message_id))
+
+    def remember(self, chat_id, message_id, digest: str) -> None:
+        key = (chat_id, message_id)
+        self._items[key] = digest
+        self._items.move_to_end(key)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def unchanged(self, chat_id, message_id, digest: str) -> bool:
+        return self._items.get((chat_id, message_id)) == digest
+
+
+class TapCoalescer:
+    # Серия быстрых нажатий одного пользователя: выполняется текущее и самое последнее,
+    # промежуточные (пришедшие, пока обрабатывается предыдущее) пропускаются.
+    # Одиночное нажатие выполняется сразу, без задержки.
+
+    def __init__(self) -> None:
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._latest: Dict[int, int] = {}
+
+    @asynccontextmanager
+    async def latest(self, user_id: int):
+        seq = self._latest.get(user_id, 0) + 1
+        self._latest[user_id] = seq
+        lock = self._locks.setdefault(user_id, asyncio.Lock())
+        async with lock:
+            try:
+                yield self._latest[user_id] == seq
+            finally:
+                if self._latest.get(user_id) == seq:
+                    # новее никого нет — освобождаем память
+                    self._latest.pop(user_id, None)
+                    self._locks.pop(user_id, None)
+
+
+render_cache = RenderCache()
+tap_coalescer = TapCoalescer()
@@ -0,0 +1,107 @@
+import os
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Optional
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects.postgresql import insert
+
+from app.database import AsyncSessionLocal
+from app.models import BotState
+
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")  # memory | postgres
+# брошенный диалог (ждём реквизиты/тикет/сумму) живёт не дольше STATE_TTL секунд
+STATE_TTL = int(os.getenv("STATE_TTL", "900"))
+STATE_MAX_ENTRIES = int(os.getenv("STATE_MAX_ENTRIES", "10000"))
+# postgres: чистим просроченные строки раз в столько записей
+STATE_CLEANUP_EVERY = int(os.getenv("STATE_CLEANUP_EVERY", "500"))
+
+
+class StateStore(ABC):
+    # что бот ждёт от пользователя следующим сообщением: "requisites" | "ticket" | "payout" | "rate:<pair>" | "currency:<id>"
+
+    @abstractmethod
+    async def get(self, user_id: int) -> Optional[str]:
+        ...
+
+    @abstractmethod
+    async def set(self, user_id: int, mode: str) -> None:
+        ...
+
+    @abstractmethod
+    async def pop(self, user_id: int) -> None:
+        ...
+
+
+class MemoryStateStore(StateStore):
+    # LRU с TTL: память ограничена max_entries, брошенные диалоги вытесняются
+
+    def __init__(self, ttl: int = STATE_TTL, max_entries: int = STATE_MAX_ENTRIES) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._items: "OrderedDict[int, tuple]" = OrderedDict()
+
+    async def get(self, user_id: int) -> Optional[str]:
+        item = self._items.get(user_id)
+        if item is None:
+            return None
+        if item[0] < time.monotonic():
+            del self._items[user_id]
+            return None
+        return item[1]
+
+    async def set(self, user_id: int, mode: str) -> None:
+        self._items[user_id] = (time.monotonic() + self.ttl, mode)
+        self._items.move_to_end(user_id)
+        while len(self._items) > self.max_entries:
+            self._items.popitem(last=False)
+
+    async def pop(self, user_id: int) -> None:
+        self._items.pop(user_id, None)
+
+
+class PgStateStore(StateStore):
+    # общая для всех реплик бота таблица bot_states; память процесса не растёт
+
+    def __init__(self, ttl: int = STATE_TTL) -> None:
+        self.ttl = ttl
+        self._writes = 0
+
+    async def get(self, user_id: int) -> Optional[str]:
+        async with AsyncSessionLocal() as session:
+            r = await session.execute(
+                select(BotState.mode).where(BotState.user_id == user_id, BotState.expires_at > func.now())
+            )
+            return r.scalar()
+
+    async def set(self, user_id: int, mode: str) -> None:
+        expires_at = func.now() + timedelta(seconds=self.ttl)
+        stmt = insert(BotState).values(user_id=user_id, mode=mode, expires_at=expires_at)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[BotState.user_id],
+            set_={"mode": stmt.excluded.mode, "expires_at": stmt.excluded.expires_at},
+        )
+        async with AsyncSessionLocal() as session:
+            await session.execute(stmt)
+            self._writes += 1
+            if self._writes % STATE_CLEANUP_EVERY == 0:
+                await session.execute(delete(BotState).where(BotState.expires_at <= func.now()))
+            await session.commit()
+
+    async def pop(self, user_id: int) -> None:
+        async with AsyncSessionLocal() as session:
+            await session.execute(delete(BotState).where(BotState.user_id == user_id))
+            await session.commit()
+
+
+def make_state_store() -> StateStore:
+    if STATE_BACKEND == "postgres":
+        return PgStateStore()
+    if STATE_BACKEND == "memory":
+        return MemoryStateStore()
+    raise RuntimeError(f"unknown STATE_BACKEND: {STATE_BACKEND}")
+
+
+state_store = make_state_store()
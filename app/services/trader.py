@@ -1,18 +1,166 @@
-from app.database import AsyncSessionLocal
+import json
+import os
+from collections import defaultdict
+from decimal import Decimal
+
+from sqlalchemy import Integer, Numeric, column, func, select, update, values
+from sqlalchemy.dialects.postgresql import array
+
 from app.models import Trader
-from sqlalchemy.future import select
-from app.bot import bot
+from app.services.matching import CapacityBook
+from app.services.pool import PooledTrader, trader_pool
+
+# сколько кандидатов из индекса остатков (trader_pool) предлагаем БД на одну заявку
+RESERVE_CANDIDATES = int(os.getenv("RESERVE_CANDIDATES", "20"))
+# суммы хранятся в Numeric(18, 2): не больше 16 знаков до запятой
+MAX_ORDER_AMOUNT = 10 ** 16 - 1
+
+
+def check_amount(amount) -> None:
+    # отрицательная сумма прошла бы проверку остатка и уменьшила frozen_rur
+    if not 0 < amount <= MAX_ORDER_AMOUNT:
+        raise ValueError(f"order amount out of range: {amount}")
+
+
+def _available():
+    return Trader.deposit_rub - Trader.frozen_rur
+
+
+async def reserve_trader(session, amount, currency: str = "RUB"):
+    # выбор трейдера и заморозка суммы одним UPDATE: строки, занятые параллельными
+    # запросами, пропускаются (SKIP LOCKED), поэтому воркеры расходятся по разным трейдерам.
+    # Кандидатов даёт индекс остатков (trader_pool) — в порядке политики MATCH_POLICY.
+    # Блокировка держится до commit/rollback транзакции вызывающего.
+    check_amount(amount)
+    await trader_pool.ensure_loaded()
+    currency = currency.upper()
+    candidates = [t.id for t in trader_pool.candidates(currency, amount, RESERVE_CANDIDATES)]
+
+    row = None
+    if candidates:
+        pick = (
+            select(Trader.id)
+            .where(
+                Trader.id.in_(candidates),
+                Trader.requisites_enabled.is_(True),
+                Trader.currency == currency,
+                _available() >= amount,
+            )
+            .order_by(func.array_position(array(candidates), Trader.id))
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        )
+        row = await _freeze(session, pick, amount)
+    if row is None and trader_pool.count(currency) > len(candidates):
+        # индекс мог отстать (разморозки других процессов) — ищем среди всех включённых в этой валюте
+        pick = (
+            select(Trader.id)
+            .where(Trader.requisites_enabled.is_(True), Trader.currency == currency, _available() >= amount)
+            .order_by(_available().desc())
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        )
+        row = await _freeze(session, pick, amount)
+    if row is None:
+        return None
+
+    # остаток после заморозки — точный, из RETURNING; в индекс — только если транзакция закоммитится
+    trader_pool.on_commit(session, row.id, available=row.available)
+    return PooledTrader(row.id, row.tg_id)
 
-async def get_free_trader():
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(select(Trader).where(Trader.is_active==1))
-        traders = result.scalars().all()
-        return traders[0] if traders else None
 
-async def send_order(tg_id, order):
-    text = f"""
+async def _freeze(session, pick, amount):
+    r = await session.execute(
+        update(Trader)
+        .where(Trader.id == pick.scalar_subquery())
+        .values(frozen_rur=Trader.frozen_rur + amount)
+        .returning(Trader.id, Trader.tg_id, _available().label("available"))
+        .execution_options(synchronize_session=False)
+    )
+    return r.first()
+
+
+async def lock_traders_for_batch(session, amounts, currencies, exclude=None):
+    # пачка: блокируем кандидатов одним SELECT ... FOR UPDATE SKIP LOCKED на валюту и раскладываем
+    # суммы по свободному остатку в памяти той же политикой, что и одиночные заявки.
+    # Возвращает трейдера (или None) на каждую сумму.
+    # exclude — id трейдера, которому эту сумму отдавать нельзя (переназначение), по позиции в amounts.
+    for amount in amounts:
+        check_amount(amount)
+    await trader_pool.ensure_loaded()
+    by_currency = defaultdict(list)
+    for n, currency in enumerate(currencies):
+        by_currency[currency.upper()].append(n)
+
+    assigned = [None] * len(amounts)
+    for currency, positions in by_currency.items():
+        sums = [Decimal(amounts[n]) for n in positions]
+        limit = max(RESERVE_CANDIDATES, len(positions))
+        # кандидаты и под самую мелкую, и под самую крупную сумму пачки
+        ids = list(dict.fromkeys(
+            t.id for amount in (min(sums), max(sums)) for t in trader_pool.candidates(currency, amount, limit)
+        ))
+        if not ids:
+            continue
+
+        r = await session.execute(
+            select(Trader.id, Trader.tg_id, _available().label("available"))
+            .where(Trader.id.in_(ids), Trader.requisites_enabled.is_(True), Trader.currency == currency)
+            .order_by(Trader.id)
+            .with_for_update(skip_locked=True)
+        )
+        locked = {}
+        book = CapacityBook()
+        available = {}
+        for row in r.all():
+            locked[row.id] = PooledTrader(row.id, row.tg_id)
+            available[row.id] = Decimal(row.available or 0)
+            book.add(row.id, float(available[row.id]))
+            # заодно уточняем индекс точным остатком
+            trader_pool.set_available(row.id, available[row.id])
+
+        for n, amount in zip(positions, sums):
+            skip = exclude[n] if exclude is not None else None
+            for trader_id in book.pick(float(amount), 2 if skip is not None else 1):
+                if trader_id != skip and available[trader_id] >= amount:
+                    book.remove(trader_id, float(available[trader_id]))
+                    available[trader_id] -= amount
+                    book.add(trader_id, float(available[trader_id]))
+                    assigned[n] = locked[trader_id]
+                    break
+    return assigned
+
+
+async def freeze_batch(session, assigned):
+    # assigned: [(trader_id, amount), ...] только реально вставленные заявки; один UPDATE ... FROM (VALUES)
+    totals = defaultdict(Decimal)
+    for trader_id, amount in assigned:
+        check_amount(amount)
+        totals[trader_id] += Decimal(amount)
+    if not totals:
+        return
+    v = values(column("id", Integer), column("amount", Numeric(18, 2)), name="v").data(list(totals.items()))
+    await session.execute(
+        update(Trader)
+        .where(Trader.id == v.c.id)
+        .values(frozen_rur=Trader.frozen_rur + v.c.amount)
+        .execution_options(synchronize_session=False)
+    )
+    for trader_id, total in totals.items():
+        trader_pool.on_commit(session, trader_id, delta=-total)
+
+
+def order_notification_text(order) -> str:
+    return f"""
 💸 Новая заявка
 Сумма: {order['amount']} {order['currency']}
-ID заявки: {order['merchant_order_id']}
+ID заявки: {order['id']}
 """
-    await bot.send_message(tg_id, text)
+
+
+def order_notification_kb(order_id: int) -> str:
+    # inline-клавиатура в JSON (API-процессу не нужен aiogram)
+    return json.dumps({"inline_keyboard": [[
+        {"text": "✅ Оплата получена", "callback_data": f"o:done:{order_id}"},
+        {"text": "❌ Отменить", "callback_data": f"o:cancel:{order_id}"},
+    ]]})
@@ -0,0 +1,89 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from app.metrics import Counter, Gauge
+from app.models import Trader
+from app.services.events import PROCESS_ID, TRADERS_CHANNEL, listener
+
+CACHE_SIZE = int(os.getenv("TRADER_CACHE_SIZE", "10000"))
+CACHE_TTL = float(os.getenv("TRADER_CACHE_TTL", "60"))
+
+trader_cache_hits_total = Counter("trader_cache_hits_total", "Bot trader cache hits")
+trader_cache_misses_total = Counter("trader_cache_misses_total", "Bot trader cache misses")
+trader_cache_evictions_total = Counter("trader_cache_evictions_total", "Bot trader cache LRU evictions")
+
+
+class TraderCache:
+    # снапшоты Trader для хендлеров бота по tg_id: LRU с ограничением размера и TTL.
+    # Пишущие хелперы обновляют кэш сразу после commit (write-through),
+    # изменения из других процессов сбрасывают запись через traders_changed.
+
+    def __init__(self, maxsize: int = CACHE_SIZE, ttl: float = CACHE_TTL) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, tg_id) -> Optional[Trader]:
+        key = str(tg_id)
+        item = self._items.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self._items[key]
+            self.misses += 1
+            trader_cache_misses_total.inc()
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        trader_cache_hits_total.inc()
+        return item[1]
+
+    def put(self, trader: Trader) -> None:
+        key = str(trader.tg_id)
+        self._items[key] = (time.monotonic() + self.ttl, trader)
+        self._items.move_to_end(key)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+            self.evictions += 1
+            trader_cache_evictions_total.inc()
+
+    def invalidate(self, tg_id) -> None:
+        self._items.pop(str(tg_id), None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._items),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / total if total else 0.0,
+        }
+
+
+trader_cache = TraderCache()
+
+Gauge("trader_cache_size", "Entries in the bot trader cache", fn=lambda: len(trader_cache._items))
+
+_started = False
+
+
+def _on_traders_changed(data: dict) -> None:
+    # своё изменение кэш уже получил через put() — сбрасывать его незачем
+    if data.get("origin") != PROCESS_ID:
+        trader_cache.invalidate(data["tg_id"])
+
+
+async def start_trader_cache() -> None:
+    # изменения трейдеров из других процессов сбрасывают записи кэша
+    global _started
+    if _started:
+        return
+    _started = True
+    await listener.subscribe(TRADERS_CHANNEL, _on_traders_changed)
+    await listener.start()
@@ -0,0 +1,68 @@
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert
+
+from app.database import AsyncSessionLocal
+from app.models import TURNOVER_TZ, TraderTurnoverDaily, TraderTurnoverTotal
+
+_tz = ZoneInfo(TURNOVER_TZ)
+
+
+def turnover_day(created_at: datetime) -> date:
+    return created_at.astimezone(_tz).date()
+
+
+async def add_turnover(session, trader_id: int, created_at: datetime, amount) -> None:
+    # вызывается в транзакции перевода заявки в done
+    daily = insert(TraderTurnoverDaily).values(
+        trader_id=trader_id, day=turnover_day(created_at), amount=amount, orders_count=1
+    )
+    await session.execute(daily.on_conflict_do_update(
+        index_elements=[TraderTurnoverDaily.trader_id, TraderTurnoverDaily.day],
+        set_={
+            "amount": TraderTurnoverDaily.amount + daily.excluded.amount,
+            "orders_count": TraderTurnoverDaily.orders_count + 1,
+        },
+    ))
+    total = insert(TraderTurnoverTotal).values(trader_id=trader_id, amount=amount, orders_count=1)
+    await session.execute(total.on_conflict_do_update(
+        index_elements=[TraderTurnoverTotal.trader_id],
+        set_={
+            "amount": TraderTurnoverTotal.amount + total.excluded.amount,
+            "orders_count": TraderTurnoverTotal.orders_count + 1,
+        },
+    ))
+
+
+async def turnover_summary(trader_id: int) -> dict:
+    # не больше ~37 дневных строк + одна итоговая, независимо от длины истории
+    today = datetime.now(_tz).date()
+    week_start = today - timedelta(days=today.weekday())
+    month_start = today.replace(day=1)
+
+    amount = TraderTurnoverDaily.amount
+    total = (
+        select(TraderTurnoverTotal.amount)
+        .where(TraderTurnoverTotal.trader_id == trader_id)
+        .scalar_subquery()
+    )
+    q = select(
+        func.coalesce(func.sum(amount).filter(TraderTurnoverDaily.day >= today), 0),
+        func.coalesce(func.sum(amount).filter(TraderTurnoverDaily.day >= week_start), 0),
+        func.coalesce(func.sum(amount).filter(TraderTurnoverDaily.day >= month_start), 0),
+        func.coalesce(total, 0),
+    ).where(
+        TraderTurnoverDaily.trader_id == trader_id,
+        TraderTurnoverDaily.day >= min(week_start, month_start),
+    )
+    async with AsyncSessionLocal() as session:
+        row = (await session.execute(q)).one()
+
+    return {
+        "today": float(row[0]),
+        "week": float(row[1]),
+        "month": float(row[2]),
+        "all_time": float(row[3]),
+    }
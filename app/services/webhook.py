@@ -0,0 +1,71 @@
+import asyncio
+import hmac
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling | webhook
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")  # публичный https-адрес API
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# сколько апдейтов обрабатываем одновременно и сколько держим в очереди;
+# при переполнении отвечаем 503 и Telegram пришлёт апдейт повторно
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", "32"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+
+
+def check_secret(token) -> bool:
+    return bool(WEBHOOK_SECRET) and hmac.compare_digest(token or "", WEBHOOK_SECRET)
+
+
+class UpdateQueue:
+    def __init__(self) -> None:
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+        self.tasks = []
+
+    def submit(self, data: dict) -> bool:
+        try:
+            self.queue.put_nowait(data)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    async def start(self) -> None:
+        if self.tasks:
+            return
+        for _ in range(WEBHOOK_CONCURRENCY):
+            self.tasks.append(asyncio.create_task(self._worker()))
+
+    async def stop(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def _worker(self) -> None:
+        from aiogram.types import Update
+        from app.bot import bot, dp
+
+        while True:
+            data = await self.queue.get()
+            try:
+                update = Update.model_validate(data, context={"bot": bot})
+                await dp.feed_update(bot, update)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("webhook update %s failed", data.get("update_id"))
+
+
+update_queue = UpdateQueue()
+
+
+async def setup_webhook(bot) -> None:
+    if not WEBHOOK_BASE_URL or not WEBHOOK_SECRET:
+        raise RuntimeError("BOT_MODE=webhook requires WEBHOOK_BASE_URL and WEBHOOK_SECRET")
+    await bot.set_webhook(
+        WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        max_connections=min(WEBHOOK_CONCURRENCY, 100),
+    )
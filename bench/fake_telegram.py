@@ -0,0 +1,55 @@
+import asyncio
+import itertools
+import os
+import time
+from collections import Counter
+
+from fastapi import FastAPI, Request
+
+# Фейковый Telegram Bot API: отвечает правдоподобными объектами на методы, которые зовёт бот.
+# Бот направляется сюда через TELEGRAM_API_URL. Задержка ответа — FAKE_TG_LATENCY_MS.
+
+LATENCY = float(os.getenv("FAKE_TG_LATENCY_MS", "0")) / 1000
+
+app = FastAPI()
+calls = Counter()
+_message_ids = itertools.count(1)
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+
+
+def _message(chat_id, text):
+    return {
+        "message_id": next(_message_ids),
+        "date": int(time.time()),
+        "chat": {"id": int(chat_id), "type": "private"},
+        "from": BOT_USER,
+        "text": text or "",
+    }
+
+
+async def _params(request: Request) -> dict:
+    if request.headers.get("content-type", "").startswith("application/json"):
+        return await request.json()
+    return dict(await request.form())
+
+
+@app.post("/bot{token}/{method}")
+async def bot_method(token: str, method: str, request: Request):
+    params = await _params(request)
+    calls[method] += 1
+    if LATENCY:
+        await asyncio.sleep(LATENCY)
+
+    if method == "getMe":
+        result = BOT_USER
+    elif method in ("sendMessage", "editMessageText"):
+        result = _message(params.get("chat_id") or 0, params.get("text"))
+    elif method == "sendDocument":
+        result = _message(params.get("chat_id") or 0, "")
+    elif method == "getUpdates":
+        result = []
+    else:
+        # answerCallbackQuery, setWebhook, deleteWebhook, ...
+        result = True
+    return {"ok": True, "result": result}
@@ -3,10 +3,28 @@ import asyncio
 import uvicorn
 
 from app.bot import dp, bot
+from app.database import init_engine
+from app.models import DB_MIGRATE, init_models
+from app.services.notifier import start_notifier
+from app.services.rates import start_rates
+from app.services.trader_cache import start_trader_cache
+from app.services.webhook import BOT_MODE, setup_webhook
 
 async def start_bot():
+    init_engine()
+    # курсы нужны дашборду трейдера; в одном процессе с API повторный старт ничего не делает
+    await start_rates()
+    await start_trader_cache()
+    if BOT_MODE == "webhook":
+        # апдейты принимает API (app.main), здесь только регистрируем вебхук и outbox
+        print(">>> BOT: webhook mode, registering webhook...")
+        await setup_webhook(bot)
+        await start_notifier(bot)
+        return
+
     print(">>> BOT: deleting webhook and starting polling...")
     await bot.delete_webhook(drop_pending_updates=True)
+    await start_notifier(bot)
     await dp.start_polling(bot)
 
 async def start_api():
@@ -17,6 +35,10 @@ async def start_api():
     await server.serve()
 
 async def main():
+    if DB_MIGRATE:
+        # один раз до старта API и бота, а не в lifespan
+        init_engine()
+        await init_models()
     await asyncio.gather(start_api(), start_bot())
 
 if __name__ == "__main__":
@@ -0,0 +1,161 @@
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+import uvicorn
+
+# Многопроцессный режим: N процессов API на общем сокете + один процесс бота/outbox.
+# Процессы общаются только через Postgres (LISTEN/NOTIFY: traders_changed, outbox),
+# поэтому медленный хендлер бота не тормозит приём заявок и наоборот.
+# Пул БД у каждого процесса свой: соединений до API_WORKERS * (DB_POOL_SIZE + DB_POOL_MAX_OVERFLOW).
+
+API_WORKERS = int(os.getenv("API_WORKERS", str(os.cpu_count() or 1)))
+PORT = int(os.environ.get("PORT", "8000"))
+# порт /metrics процесса бота (0 — не поднимать)
+BOT_METRICS_PORT = int(os.getenv("BOT_METRICS_PORT", "0"))
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "20"))
+# перезапуски упавших процессов: не чаще MAX_RESTARTS за RESTART_WINDOW секунд
+MAX_RESTARTS = int(os.getenv("MAX_RESTARTS", "5"))
+RESTART_WINDOW = float(os.getenv("RESTART_WINDOW", "60"))
+
+ctx = multiprocessing.get_context("spawn")
+
+
+def api_worker(sock: socket.socket) -> None:
+    config = uvicorn.Config("app.main:app", log_level="info")
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def bot_worker() -> None:
+    from run import start_bot
+    from app.services.webhook import BOT_MODE
+
+    async def main():
+        metrics_task = asyncio.create_task(_serve_bot_metrics()) if BOT_METRICS_PORT else None
+        # polling: start_bot работает до SIGTERM (aiogram сам ловит сигналы)
+        await start_bot()
+        if BOT_MODE == "webhook":
+            # вебхук зарегистрирован, outbox работает — ждём сигнала
+            stop = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                loop.add_signal_handler(sig, stop.set)
+            await stop.wait()
+        if metrics_task:
+            metrics_task.cancel()
+
+    asyncio.run(main())
+
+
+async def _serve_bot_metrics():
+    from fastapi import FastAPI
+    from fastapi.responses import PlainTextResponse
+    from app.metrics import render_prometheus
+
+    metrics_app = FastAPI()
+
+    @metrics_app.get("/metrics", response_class=PlainTextResponse)
+    async def metrics():
+        return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4")
+
+    config = uvicorn.Config(metrics_app, host="0.0.0.0", port=BOT_METRICS_PORT, log_level="warning")
+    server = uvicorn.Server(config)
+    # сигналы обрабатывает бот, не uvicorn
+    server.install_signal_handlers = lambda: None
+    await server.serve()
+
+
+async def migrate_schema() -> None:
+    # до запуска воркеров, один раз: их lifespan схему только сверяет
+    from app.database import dispose_engine, init_engine
+    from app.models import init_models
+
+    init_engine()
+    try:
+        await init_models()
+    finally:
+        await dispose_engine()
+
+
+class Child:
+    def __init__(self, name: str, target, args=()) -> None:
+        self.name = name
+        self.target = target
+        self.args = args
+        self.process = None
+        self.restarts = []
+
+    def start(self) -> None:
+        self.process = ctx.Process(target=self.target, args=self.args, name=self.name)
+        self.process.start()
+        print(f">>> SUPERVISOR: started {self.name} (pid {self.process.pid})")
+
+    def can_restart(self) -> bool:
+        now = time.monotonic()
+        self.restarts = [t for t in self.restarts if now - t < RESTART_WINDOW]
+        return len(self.restarts) < MAX_RESTARTS
+
+    def restart(self) -> None:
+        self.restarts.append(time.monotonic())
+        self.start()
+
+
+def main() -> None:
+    from app.models import DB_MIGRATE
+
+    if DB_MIGRATE:
+        print(">>> SUPERVISOR: migrating DB schema...")
+        asyncio.run(migrate_schema())
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("0.0.0.0", PORT))
+    sock.set_inheritable(True)
+    print(f">>> SUPERVISOR: {API_WORKERS} API workers on 0.0.0.0:{PORT} + bot worker")
+
+    children = [Child(f"api-{i}", api_worker, (sock,)) for i in range(API_WORKERS)]
+    children.append(Child("bot", bot_worker))
+    for child in children:
+        child.start()
+
+    stopping = False
+
+    def on_signal(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+
+    while not stopping:
+        time.sleep(1)
+        for child in children:
+            if stopping or child.process.is_alive():
+                continue
+            print(f">>> SUPERVISOR: {child.name} exited with code {child.process.exitcode}")
+            if not child.can_restart():
+                print(f">>> SUPERVISOR: {child.name} is crash-looping, shutting down")
+                stopping = True
+                break
+            child.restart()
+
+    # graceful: SIGTERM (uvicorn дорабатывает текущие запросы), по таймауту — SIGKILL
+    print(">>> SUPERVISOR: shutting down...")
+    for child in children:
+        if child.process.is_alive():
+            child.process.terminate()
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+    for child in children:
+        child.process.join(max(0.0, deadline - time.monotonic()))
+        if child.process.is_alive():
+            print(f">>> SUPERVISOR: killing {child.name}")
+            child.process.kill()
+            child.process.join()
+    sock.close()
+
+
+if __name__ == "__main__":
+    main()
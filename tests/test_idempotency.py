@@ -0,0 +1,95 @@
+from sqlalchemy import text
+
+from app.services.deadlines import expire_orders
+from app.services.dispatcher import dispatch_order, dispatch_orders_batch
+from app.services.idempotency import RecentOrders, recent_orders
+from app.services.merchants import create_merchant
+
+
+def test_recent_orders_is_bounded_lru():
+    cache = RecentOrders(maxsize=2)
+    cache.remember(None, "a", 1, "new", 10)
+    cache.remember(None, "b", 2, "new", 10)
+    cache.get(None, "a")
+    cache.remember(None, "c", 3, "new", 10)
+
+    assert cache.get(None, "b") is None
+    assert cache.get(None, "a")["order_id"] == 1
+    assert cache.get(None, "c")["order_id"] == 3
+    assert cache.get(7, "a") is None
+
+
+async def test_repeated_order_is_not_dispatched_twice(db, seed_traders):
+    await seed_traders(2, 1000)
+    order = {"id": "m-1", "amount": 100, "currency": "RUB"}
+
+    first = await dispatch_order(order)
+    repeat = await dispatch_order(order)
+    # без кэша процесса повтор ловит ON CONFLICT
+    recent_orders._items.clear()
+    after_restart = await dispatch_order(order)
+
+    assert first["status"] == "ok"
+    for result in (repeat, after_restart):
+        assert result["status"] == "duplicate"
+        assert result["order_id"] == first["order_id"]
+    async with db.connect() as conn:
+        assert (await conn.execute(text("SELECT count(*) FROM orders"))).scalar() == 1
+        frozen = (await conn.execute(text("SELECT sum(frozen_rur) FROM traders"))).scalar()
+    assert frozen == 100
+
+
+async def test_batch_deduplicates_within_and_across_requests(db, seed_traders):
+    await seed_traders(2, 1000)
+    first = await dispatch_order({"id": "m-1", "amount": 100, "currency": "RUB"})
+    recent_orders._items.clear()
+
+    results = await dispatch_orders_batch([
+        {"id": "m-1", "amount": 100, "currency": "RUB"},
+        {"id": "m-2", "amount": 100, "currency": "RUB"},
+        {"id": "m-2", "amount": 100, "currency": "RUB"},
+    ])
+
+    assert results[0]["status"] == "duplicate"
+    assert results[0]["order_id"] == first["order_id"]
+    assert results[1]["status"] == "ok"
+    assert results[2] == results[1]
+    async with db.connect() as conn:
+        assert (await conn.execute(text("SELECT count(*) FROM orders"))).scalar() == 2
+        assert (await conn.execute(text("SELECT sum(frozen_rur) FROM traders"))).scalar() == 200
+
+
+async def test_duplicate_after_reassignment_reports_new_trader(db, seed_traders):
+    await seed_traders(2, 1000)
+    first = await dispatch_order({"id": "m-1", "amount": 100, "currency": "RUB"})
+    async with db.begin() as conn:
+        await conn.execute(text("UPDATE orders SET expires_at = now() - interval '1 second'"))
+
+    await expire_orders([first["order_id"]])
+
+    repeat = await dispatch_order({"id": "m-1", "amount": 100, "currency": "RUB"})
+    async with db.connect() as conn:
+        trader_id = (await conn.execute(text("SELECT trader_id FROM orders"))).scalar()
+    assert trader_id != first["trader_id"]
+    assert repeat["status"] == "duplicate"
+    assert repeat["trader_id"] == trader_id
+
+
+async def test_same_order_id_from_two_merchants_is_two_orders(db, seed_traders):
+    await seed_traders(2, 1000)
+    first, second = await create_merchant("first"), await create_merchant("second")
+
+    a = await dispatch_order({"id": "m-1", "amount": 100, "currency": "RUB", "merchant_id": first["id"]})
+    b = await dispatch_order({"id": "m-1", "amount": 100, "currency": "RUB", "merchant_id": second["id"]})
+    recent_orders._items.clear()
+    repeats = await dispatch_orders_batch([
+        {"id": "m-1", "amount": 100, "currency": "RUB", "merchant_id": second["id"]},
+        {"id": "m-1", "amount": 100, "currency": "RUB", "merchant_id": first["id"]},
+    ])
+
+    assert a["status"] == b["status"] == "ok"
+    assert a["order_id"] != b["order_id"]
+    assert [r["status"] for r in repeats] == ["duplicate", "duplicate"]
+    assert [r["order_id"] for r in repeats] == [b["order_id"], a["order_id"]]
+    async with db.connect() as conn:
+        assert (await conn.execute(text("SELECT count(*) FROM orders"))).scalar() == 2
@@ -0,0 +1,64 @@
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import text
+
+from app.services.dispatcher import dispatch_order
+from app.services.ledger import adjust_balance, compact_balances, pending_entries, reconcile_balances, trader_balances
+from app.services.orders import close_order
+from app.services.pool import trader_pool
+
+
+async def _compact():
+    while await compact_balances():
+        pass
+
+
+async def test_closed_orders_fold_into_snapshot(db, seed_traders):
+    [trader_id] = await seed_traders(1, 1000)
+    done = await dispatch_order({"id": "o-done", "amount": 300, "currency": "RUB"})
+    cancel = await dispatch_order({"id": "o-cancel", "amount": 200, "currency": "RUB"})
+
+    await close_order(done["order_id"], "done")
+    await close_order(cancel["order_id"], "cancel")
+
+    # до свёртки баланс уже учитывает журнал
+    assert await pending_entries() == 3
+    balances = await trader_balances(trader_id)
+    assert balances["deposit_rub"] == Decimal("700")
+    assert balances["frozen_rur"] == Decimal("0")
+
+    await _compact()
+    assert await pending_entries() == 0
+    assert await trader_balances(trader_id) == balances
+    assert await reconcile_balances() == []
+
+
+async def test_reconcile_reports_unjournaled_edits(db, seed_traders):
+    [trader_id] = await seed_traders(1, 1000)
+    async with db.begin() as conn:
+        await conn.execute(text("UPDATE traders SET deposit_rub = deposit_rub + 50 WHERE id = :id"), {"id": trader_id})
+
+    drift = await reconcile_balances()
+
+    assert [row["trader_id"] for row in drift] == [trader_id]
+    assert drift[0]["deposit_rub"] == Decimal("1050")
+    assert drift[0]["journal_deposit_rub"] == Decimal("1000")
+
+
+async def test_adjust_balance_is_journaled(db, seed_traders):
+    [trader_id] = await seed_traders(1, 1000)
+    await dispatch_order({"id": "o-frozen", "amount": 600, "currency": "RUB"})
+
+    trader = await adjust_balance(trader_id, "deposit_rub", 500)
+    assert trader.deposit_rub == Decimal("1500")
+    assert trader_pool.candidates("RUB", 900, 1) == [(trader_id, trader.tg_id)]
+    # списать ниже замороженного нельзя
+    with pytest.raises(ValueError):
+        await adjust_balance(trader_id, "deposit_rub", -1000)
+    with pytest.raises(ValueError):
+        await adjust_balance(trader_id, "frozen_rur", 100)
+    assert await adjust_balance(trader_id + 1, "deposit_rub", 100) is None
+
+    assert (await trader_balances(trader_id))["deposit_rub"] == Decimal("1500")
+    assert await reconcile_balances() == []
@@ -0,0 +1,61 @@
+import random
+from collections import Counter
+
+from app.services.matching import CapacityBook
+
+
+def _book(capacities):
+    book = CapacityBook(rng=random.Random(1))
+    for trader_id, available in capacities.items():
+        book.add(trader_id, available)
+    return book
+
+
+def test_policies_order_and_bound():
+    book = _book({1: 50.0, 2: 300.0, 3: 100.0, 4: 1000.0, 5: 100.0})
+
+    assert len(book) == 5
+    assert book.eligible(100) == 4
+    assert book.pick(100, 10, "best_fit") == [3, 5, 2, 4]
+    assert book.pick(100, 2, "least_loaded") == [4, 2]
+    assert book.pick(2000, 5, "least_loaded") == []
+    assert sorted(book.pick(100, 10, "weighted", rng=random.Random(2))) == [2, 3, 4, 5]
+
+
+def test_updates_keep_book_consistent():
+    rng = random.Random(3)
+    book = CapacityBook(rng=rng)
+    model = {}
+    for _ in range(5000):
+        trader_id = rng.randrange(200)
+        if trader_id in model:
+            book.remove(trader_id, model.pop(trader_id))
+        else:
+            model[trader_id] = float(rng.randrange(1000))
+            book.add(trader_id, model[trader_id])
+
+    expected = sorted(((a, t) for t, a in model.items() if a >= 500))
+    assert len(book) == len(model)
+    assert book.eligible(500) == len(expected)
+    assert book.pick(500, len(model), "best_fit") == [t for _, t in expected]
+    assert book.pick(500, len(model), "least_loaded") == [t for _, t in reversed(expected)]
+
+
+def test_weighted_first_pick_is_proportional_to_capacity():
+    # 4 подходящих трейдера с остатками 1:2:3:4 и один, кому сумма не по силам
+    book = _book({1: 100.0, 2: 200.0, 3: 300.0, 4: 400.0, 5: 10.0})
+    rng = random.Random(4)
+    draws = 40000
+
+    first = Counter(book.pick(50, 3, "weighted", rng=rng)[0] for _ in range(draws))
+
+    assert 5 not in first
+    for trader_id, share in ((1, 0.1), (2, 0.2), (3, 0.3), (4, 0.4)):
+        assert abs(first[trader_id] / draws - share) < 0.01
+
+
+def test_weighted_uses_book_rng_by_default():
+    capacities = {trader_id: float(trader_id * 10) for trader_id in range(1, 50)}
+    first, second = _book(capacities), _book(capacities)
+
+    assert [first.pick(100, 5, "weighted") for _ in range(20)] == [second.pick(100, 5, "weighted") for _ in range(20)]
@@ -0,0 +1,141 @@
+import time
+
+import httpx
+import pytest
+
+from app.main import create_app
+from app.services import admission, merchants
+from app.services.merchants import MerchantRegistry, sign, verify_request
+
+MERCHANT = {"id": 1, "name": "test", "api_key": "key-1", "secret": "s3cret", "rate_limit": None, "burst": None}
+
+
+@pytest.fixture(autouse=True)
+def known_merchant(monkeypatch):
+    async def get(api_key):
+        return MERCHANT if api_key == MERCHANT["api_key"] else None
+
+    monkeypatch.setattr(merchants.merchant_registry, "get", get)
+
+
+def _headers(body: bytes, path: str = "/merchant/order", ts: float = None, secret: str = MERCHANT["secret"]) -> dict:
+    ts = str(int(ts if ts is not None else time.time()))
+    return {
+        "X-Merchant-Key": MERCHANT["api_key"],
+        "X-Timestamp": ts,
+        "X-Signature": sign(secret, ts, "POST", path, body),
+    }
+
+
+async def test_valid_signature_is_accepted():
+    body = b'{"id": "1"}'
+    assert await verify_request(_headers(body), "POST", "/merchant/order", body) == MERCHANT
+
+
+@pytest.mark.parametrize("case", ["tampered_body", "wrong_secret", "stale", "other_path", "unknown_key", "missing"])
+async def test_bad_requests_are_rejected(case):
+    body = b'{"id": "1"}'
+    headers = _headers(body)
+    path = "/merchant/order"
+    if case == "tampered_body":
+        body = b'{"id": "2"}'
+    elif case == "wrong_secret":
+        headers = _headers(body, secret="other")
+    elif case == "stale":
+        headers = _headers(body, ts=time.time() - merchants.MERCHANT_SIGNATURE_TTL - 60)
+    elif case == "other_path":
+        path = "/merchant/orders/batch"
+    elif case == "unknown_key":
+        headers["X-Merchant-Key"] = "nope"
+    elif case == "missing":
+        del headers["X-Signature"]
+
+    assert await verify_request(headers, "POST", path, body) is None
+
+
+def test_registry_caches_are_bounded(monkeypatch):
+    monkeypatch.setattr(merchants, "MERCHANT_NEGATIVE_CACHE_SIZE", 3)
+    registry = MerchantRegistry()
+    for i in range(10):
+        merchants._remember(registry._unknown, f"k{i}", 0.0, merchants.MERCHANT_NEGATIVE_CACHE_SIZE)
+
+    assert list(registry._unknown) == ["k7", "k8", "k9"]
+
+
+@pytest.fixture
+def client(monkeypatch):
+    async def fake_dispatch(order):
+        return {"id": order["id"], "status": "ok", "merchant_id": order["merchant_id"]}
+
+    async def fake_dispatch_batch(orders):
+        return [await fake_dispatch(order) for order in orders]
+
+    monkeypatch.setattr("app.main.dispatch_order", fake_dispatch)
+    monkeypatch.setattr("app.main.dispatch_orders_batch", fake_dispatch_batch)
+    monkeypatch.setattr(merchants, "MERCHANT_AUTH", True)
+    monkeypatch.setattr("app.main.MERCHANT_AUTH", True)
+    monkeypatch.setattr(admission, "merchant_buckets", admission.BucketMap(1, 2))
+    transport = httpx.ASGITransport(app=create_app())
+    return httpx.AsyncClient(transport=transport, base_url="http://test")
+
+
+async def test_api_requires_signature_and_rate_limits(client):
+    body = b'{"id": "o-1", "amount": 100, "currency": "rub"}'
+    async with client:
+        unsigned = await client.post("/merchant/order", content=body, headers={"Content-Type": "application/json"})
+        assert unsigned.status_code == 401
+
+        statuses = []
+        for _ in range(3):
+            r = await client.post(
+                "/merchant/order", content=body, headers={"Content-Type": "application/json", **_headers(body)}
+            )
+            statuses.append(r.status_code)
+
+    # бакет на 2 токена: третий запрос подряд — 429 с Retry-After
+    assert statuses == [200, 200, 429]
+    assert int(r.headers["Retry-After"]) >= 1
+
+
+async def test_api_rejects_bad_amounts(client, monkeypatch):
+    # лимит проверяется раньше тела — здесь он не должен мешать
+    monkeypatch.setattr(admission, "merchant_buckets", admission.BucketMap(100, 100))
+    async with client:
+        for amount in (0, -5000, 10 ** 20):
+            body = f'{{"id": "o-1", "amount": {amount}, "currency": "RUB"}}'.encode()
+            r = await client.post(
+                "/merchant/order", content=body, headers={"Content-Type": "application/json", **_headers(body)}
+            )
+            assert r.status_code == 422
+
+
+async def test_oversized_batch_is_rejected_before_validation(client, monkeypatch):
+    monkeypatch.setattr("app.main.BATCH_MAX_SIZE", 2)
+    # заявки невалидны, но до их проверки дело не доходит
+    body = b'[{"id": 1}, {"id": 2}, {"id": 3}]'
+    path = "/merchant/orders/batch"
+    async with client:
+        r = await client.post(path, content=body, headers={"Content-Type": "application/json", **_headers(body, path)})
+    assert r.status_code == 413
+
+
+async def test_batch_spends_a_token_per_order(client, monkeypatch):
+    monkeypatch.setattr(admission, "merchant_buckets", admission.BucketMap(1, 3))
+    path = "/merchant/orders/batch"
+
+    async def post(count):
+        body = ("[" + ", ".join(f'{{"id": "b-{i}", "amount": 100, "currency": "RUB"}}' for i in range(count)) + "]").encode()
+        return await client.post(path, content=body, headers={"Content-Type": "application/json", **_headers(body, path)})
+
+    async with client:
+        over_burst = await post(4)
+        first = await post(2)
+        second = await post(2)
+
+    # больше запаса — 429 без Retry-After (ждать бесполезно)
+    assert over_burst.status_code == 429
+    assert "Retry-After" not in over_burst.headers
+    assert first.status_code == 200
+    # в бакете остался один токен на две заявки
+    assert second.status_code == 429
+    assert int(second.headers["Retry-After"]) >= 1
@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+from sqlalchemy import text
+
+from app.database import AsyncSessionLocal
+from app.services.dispatcher import dispatch_order, dispatch_orders_batch
+from app.services.ledger import compact_balances, reconcile_balances
+from app.services.pool import trader_pool
+from app.services.trader import reserve_trader
+
+
+async def _check_invariants(db):
+    while await compact_balances():
+        pass
+    async with db.connect() as conn:
+        over = (await conn.execute(text("SELECT count(*) FROM traders WHERE frozen_rur > deposit_rub"))).scalar()
+        mismatched = (await conn.execute(text(
+            "SELECT count(*) FROM traders t WHERE t.frozen_rur <> "
+            "(SELECT coalesce(sum(amount), 0) FROM orders o WHERE o.trader_id = t.id AND o.status IN ('new', 'in_work'))"
+        ))).scalar()
+    assert over == 0
+    assert mismatched == 0
+    assert await reconcile_balances() == []
+
+
+async def test_concurrent_reservations_never_over_reserve(db, seed_traders):
+    # 10 трейдеров по 1000, 300 параллельных заявок по 100: принять можно не больше 100
+    await seed_traders(10, 1000)
+
+    results = await asyncio.gather(*(
+        dispatch_order({"id": f"stress-{i}", "amount": 100, "currency": "RUB"}) for i in range(300)
+    ))
+
+    accepted = [r for r in results if r["status"] == "ok"]
+    assert len(accepted) <= 100
+    assert {r["status"] for r in results} <= {"ok", "no_trader"}
+    async with db.connect() as conn:
+        stored = (await conn.execute(text("SELECT count(*) FROM orders"))).scalar()
+    assert stored == len(accepted)
+    await _check_invariants(db)
+
+
+async def test_concurrent_batches_never_over_reserve(db, seed_traders):
+    await seed_traders(5, 1000)
+
+    await asyncio.gather(*(
+        dispatch_orders_batch([{"id": f"b{b}-{i}", "amount": 100, "currency": "RUB"} for i in range(30)])
+        for b in range(5)
+    ))
+
+    await _check_invariants(db)
+
+
+async def test_currency_is_matched(db, seed_traders):
+    await seed_traders(1, 1000, currency="KZT")
+
+    assert (await dispatch_order({"id": "rub-1", "amount": 100, "currency": "RUB"}))["status"] == "no_trader"
+    result = await dispatch_order({"id": "kzt-1", "amount": 100, "currency": "KZT"})
+    assert result["status"] == "ok"
+
+
+@pytest.mark.parametrize("amount", [0, -5000, 10 ** 20])
+async def test_out_of_range_amount_is_rejected(db, seed_traders, amount):
+    await seed_traders(1, 1000)
+
+    async with AsyncSessionLocal() as session:
+        with pytest.raises(ValueError):
+            await reserve_trader(session, amount)
+        await session.rollback()
+    await _check_invariants(db)
+
+
+async def test_pool_index_changes_only_on_commit(db, seed_traders):
+    [trader_id] = await seed_traders(1, 1000)
+    await trader_pool.load()
+
+    async with AsyncSessionLocal() as session:
+        assert (await reserve_trader(session, 700)).id == trader_id
+        await session.rollback()
+    # откаченная заморозка индекс не трогает
+    assert trader_pool.candidates("RUB", 1000, 1) == [(trader_id, trader_pool._traders[trader_id][0])]
+
+    async with AsyncSessionLocal() as session:
+        await reserve_trader(session, 700)
+        await session.commit()
+    assert trader_pool.candidates("RUB", 301, 1) == []
+    assert [t.id for t in trader_pool.candidates("RUB", 300, 1)] == [trader_id]